@@ -2,7 +2,15 @@ from pathlib import Path
 
 import pandas as pd
 
-from nnunetpaper.data import read_json
+from nnunetpaper.data import read_json, read_score_times, read_timings
+
+
+def _group_methods(methods: list[tuple[str, Path]]) -> dict[str, list[Path]]:
+    method_dict: dict[str, list[Path]] = {}
+    for method_name, scores_path in methods:
+        method_dict[method_name] = method_dict.get(method_name, [])
+        method_dict[method_name].append(scores_path)
+    return method_dict
 
 
 def get_multi_method_dataframe(
@@ -14,22 +22,30 @@ def get_multi_method_dataframe(
             print(f"Collecting anatomies for {name}")
             subdirs = [x for x in path.iterdir() if x.is_dir()]
             for subdir in subdirs:
-                p = subdir / "scores.json"
-                if p.exists():
+                candidates = [subdir / "scores.json", subdir / "scores.jsonl"]
+                p = next((x for x in candidates if x.exists()), None)
+                if p is not None:
                     print(f"\t{subdir.name}")
-                    tmp.append((name, subdir / "scores.json"))
+                    tmp.append((name, p))
                 else:
                     print(f"\t{subdir.name} (skipped)")
 
         methods = tmp
 
-    method_dict: dict[str, list[Path]] = {}
-    for method_name, scores_path in methods:
-        method_dict[method_name] = method_dict.get(method_name, [])
-        method_dict[method_name].append(scores_path)
+    method_dict = _group_methods(methods)
 
     method_data: dict[str, pd.DataFrame] = {}
     for method_name in method_dict.keys():
         method_data[method_name] = read_json(method_dict[method_name])
         method_data[method_name]["methods"] = method_name
     return pd.concat(method_data.values(), ignore_index=True)
+
+
+def get_multi_method_timings(methods: list[tuple[str, Path]], from_scores: bool = False) -> pd.DataFrame:
+    # Either timing tables, or the times stored in scores files
+    reader = read_score_times if from_scores else read_timings
+    method_data: dict[str, pd.DataFrame] = {}
+    for method_name, paths in _group_methods(methods).items():
+        method_data[method_name] = reader(paths)
+        method_data[method_name]["methods"] = method_name
+    return pd.concat(method_data.values(), ignore_index=True)
@@ -0,0 +1,70 @@
+"""
+Benchmarks for the nnunetpaper tooling itself.
+
+These tools are invoked thousands of times from job schedulers, so start-up time
+matters as much as the time spent on the actual work.
+"""
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+
+def _command_paths() -> list[list[str]]:
+    from nnunetpaper.cli import LazyGroup
+    from nnunetpaper.cli import main as cli
+
+    paths = [[]]
+    for name, command in sorted(cli.commands.items()):
+        paths.append([name])
+        if isinstance(command, LazyGroup):
+            paths += [[name, x] for x in sorted(command.lazy_subcommands.keys())]
+    return paths
+
+
+def _time_invocation(args: list[str], repeats: int) -> list[float]:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "nnunetpaper", *args, "--help"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@click.group()
+def main():
+    ...
+
+
+@main.command()
+@click.option("-n", "--repeats", required=False, type=int, default=5, show_default=True)
+@click.option(
+    "-c",
+    "--command",
+    "commands",
+    required=False,
+    multiple=True,
+    type=str,
+    help='Only time these commands, e.g. -c "stats mean"',
+)
+def startup(repeats: int = 5, commands: list[str] = ()):
+    if len(commands) > 0:
+        paths = [x.split() for x in commands]
+    else:
+        paths = _command_paths()
+
+    print(f"{'Command':<40} | {'Min (s)':<10} | {'Median (s)':<10}")
+    for path in paths:
+        timings = _time_invocation(path, repeats)
+        name = " ".join(["nnunetpaper", *path])
+        print(f"{name:<40} | {min(timings):<10.3f} | {statistics.median(timings):<10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Single entry point for all nnunetpaper commands.
+
+Subcommands are registered by their import path and short help, and only imported
+once they are invoked, so `--help` of any group and small commands don't pay for
+importing every dependency of every other command.
+"""
+import importlib
+
+import click
+
+
+class LazyGroup(click.Group):
+    def __init__(self, *args, lazy_subcommands: dict[str, tuple[str, str]] | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Maps command name to "module.path:attribute" and its short help
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted(super().list_commands(ctx) + list(self.lazy_subcommands.keys()))
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> click.Command | None:
+        if cmd_name in self.lazy_subcommands:
+            return self._load(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter) -> None:
+        # Same as click.Group, but with the short help of the table for lazy commands
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.lazy_subcommands:
+                rows.append((name, self.lazy_subcommands[name][1]))
+                continue
+            command = super().get_command(ctx, name)
+            if command is not None and not command.hidden:
+                rows.append((name, command.get_short_help_str(formatter.width - 6 - len(name))))
+
+        if len(rows) > 0:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+    def _load(self, cmd_name: str) -> click.Command:
+        module_name, attribute = self.lazy_subcommands[cmd_name][0].split(":")
+        command = getattr(importlib.import_module(module_name), attribute)
+        if not isinstance(command, click.Command):
+            raise ValueError(f"{module_name}:{attribute} is not a click command")
+        return command
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "benchmark": ("nnunetpaper.benchmark:main", "Benchmark the start-up and run time of the commands."),
+    },
+)
+def main():
+    ...
+
+
+@main.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "binary": (
+            "nnunetpaper.data.convert_binary_to_nifti:main",
+            "Convert binary volumes to NIfTI.",
+        ),
+        "disior-reference": (
+            "nnunetpaper.data.create_disior_reference:main",
+            "Combine brain, tumor and ventricle masks into DISIOR references.",
+        ),
+        "nnunet-dataset": (
+            "nnunetpaper.data.prepare_nnunet_dataset:main",
+            "Build an nnU-Net dataset from NIfTI images or DICOM series.",
+        ),
+        "scores-csv": (
+            "nnunetpaper.data.scores_to_csv:main",
+            "Convert the scores of several methods to a CSV table.",
+        ),
+    },
+)
+def convert():
+    """Convert datasets and scores between formats."""
+
+
+@main.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "audit": (
+            "nnunetpaper.data.audit_dataset:main",
+            "Audit an nnU-Net dataset for incomplete cases.",
+        ),
+        "copy-times": (
+            "nnunetpaper.data.copy_times:main",
+            "Copy the prediction times of one segmentation to all others.",
+        ),
+        "describe-dicom": (
+            "nnunetpaper.data.dicom_dataset_descriptor:main",
+            "Describe the scanners and segmentations of a DICOM archive.",
+        ),
+        "index-dicom": (
+            "nnunetpaper.data.series_index:main",
+            "Index the DICOM series of an archive.",
+        ),
+        "missing-labels": (
+            "nnunetpaper.data.ident_missing_labels:main",
+            "List the cases of an nnU-Net dataset without a label.",
+        ),
+    },
+)
+def data():
+    """Inspect and manage dataset and score files."""
+
+
+@main.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "bodymask": (
+            "nnunetpaper.process.create_bodymask:main",
+            "Create body masks.",
+        ),
+        "combine-labels": (
+            "nnunetpaper.process.combine_labels:main",
+            "Combine binary labels into a single label map.",
+        ),
+        "fill-holes": (
+            "nnunetpaper.process.fill_holes_in_mask:main",
+            "Fill the holes in masks.",
+        ),
+        "largest-island": (
+            "nnunetpaper.process.keep_largest_island:main",
+            "Keep the largest connected component of masks.",
+        ),
+    },
+)
+def process():
+    """Post-process segmentation masks."""
+
+
+@main.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "compare": (
+            "nnunetpaper.measure.compare:main",
+            "Score several methods against the same references in one pass.",
+        ),
+        "metrics": (
+            "nnunetpaper.measure.collect_metrics:main",
+            "Score binary segmentations against references.",
+        ),
+        "multiclass-metrics": (
+            "nnunetpaper.measure.collect_multiclass_metrics:main",
+            "Score multiclass segmentations against references.",
+        ),
+        "shards": (
+            "nnunetpaper.measure.shards:main",
+            "Split metric collection over several processes or machines.",
+        ),
+        "timings": (
+            "nnunetpaper.measure.collect_timings:main",
+            "Collect the prediction times and merge them into the scores.",
+        ),
+        "validate-backend": (
+            "nnunetpaper.measure.validate_backend:main",
+            "Compare the NumPy metric backend against MONAI.",
+        ),
+    },
+)
+def measure():
+    """Measure the performance of the segmentation algorithms."""
+
+
+@main.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "difference": (
+            "nnunetpaper.stats.difference:main",
+            "Compare the scores of two methods per patient.",
+        ),
+        "mannwhitney": (
+            "nnunetpaper.stats.run_mannwhitney:main",
+            "Run Mann-Whitney U tests between centers and methods.",
+        ),
+        "mean": (
+            "nnunetpaper.stats.mean:main",
+            "Compute the mean of the scores.",
+        ),
+        "multiclass-mean": (
+            "nnunetpaper.stats.multiclass_mean:main",
+            "Compute the mean of the multiclass scores.",
+        ),
+    },
+)
+def stats():
+    """Run the statistical analyses."""
+
+
+@main.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "metrics": (
+            "nnunetpaper.plot.plot_metrics:main",
+            "Plot the scores of the binary segmentations.",
+        ),
+        "multiclass-metrics": (
+            "nnunetpaper.plot.plot_multiclass_metrics:main",
+            "Plot the scores of the multiclass segmentations.",
+        ),
+        "times": (
+            "nnunetpaper.plot.plot_times:main",
+            "Plot the prediction times.",
+        ),
+    },
+)
+def plot():
+    """Generate the plots used in the article."""
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,7 @@
-from nnunetpaper.data.utils import read_json
+# read_json pulls in pandas, so only import it when it is used
+def __getattr__(name: str):
+    if name in ("read_json", "read_score_times", "read_timings"):
+        from nnunetpaper.data import utils
+
+        return getattr(utils, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
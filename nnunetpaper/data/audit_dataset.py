@@ -0,0 +1,261 @@
+"""
+Audits an nnU-Net dataset for incomplete cases.
+
+Every images and labels folder is listed once, and files are grouped into cases by
+stripping the channel suffix (_0000.nii.gz), so case IDs may contain underscores.
+Every case is checked for missing channels, a missing label, and channels or labels
+whose geometry (size, spacing, origin and direction) disagrees with the first channel.
+Only image headers are read, concurrently. The result is written to a manifest, which
+also serves as a cache of headers for files that did not change, and which the next
+audit is compared against.
+"""
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import click
+
+from nnunetpaper.data.utils import write_json
+
+SPLITS = {"Tr": ("imagesTr", "labelsTr"), "Ts": ("imagesTs", "labelsTs")}
+AUDIT_MANIFEST = "audit.json"
+
+_IMAGE_NAME = re.compile(r"^(?P<case>.+)_(?P<channel>\d{4})\.nii\.gz$")
+_LABEL_SUFFIX = ".nii.gz"
+# Headers store float32 geometry
+_GEOMETRY_ATOL = 1e-4
+
+
+class SplitIndex(NamedTuple):
+    # Case -> channel -> file name
+    images: dict[str, dict[int, str]]
+    # Case -> file name
+    labels: dict[str, str]
+    # Files that are neither a channel nor a label
+    unknown: list[str]
+
+
+def list_files(directory: Path) -> dict[str, tuple[int, int]]:
+    """
+    Returns the size and modification time of every file in directory, by name.
+    """
+    if not directory.is_dir():
+        return {}
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def index_split(image_files: list[str], label_files: list[str]) -> SplitIndex:
+    images: dict[str, dict[int, str]] = {}
+    unknown = []
+    for name in sorted(image_files):
+        match = _IMAGE_NAME.match(name)
+        if match is None:
+            unknown.append(name)
+            continue
+        images.setdefault(match["case"], {})[int(match["channel"])] = name
+
+    labels = {}
+    for name in sorted(label_files):
+        if name.endswith(_LABEL_SUFFIX):
+            labels[name[: -len(_LABEL_SUFFIX)]] = name
+        else:
+            unknown.append(name)
+    return SplitIndex(images, labels, unknown)
+
+
+def read_geometry(path: Path) -> dict[str, list[float]]:
+    import SimpleITK as sitk
+
+    # Only reads the header
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return {
+        "size": list(reader.GetSize()),
+        "spacing": list(reader.GetSpacing()),
+        "origin": list(reader.GetOrigin()),
+        "direction": list(reader.GetDirection()),
+    }
+
+
+def same_geometry(a: dict[str, list[float]], b: dict[str, list[float]]) -> bool:
+    # Plain Python, as numpy adds more overhead than it saves on a handful of values
+    return a["size"] == b["size"] and all(
+        abs(u - v) <= _GEOMETRY_ATOL for x in ["spacing", "origin", "direction"] for u, v in zip(a[x], b[x])
+    )
+
+
+def _case_problems(
+    case: str, index: SplitIndex, n_channels: int, geometries: dict[str, dict], require_label: bool
+) -> list[str]:
+    channels = index.images.get(case, {})
+    if len(channels) == 0:
+        return ["label without images"]
+
+    problems = [f"missing channel {x}" for x in range(n_channels) if x not in channels]
+    problems += [f"unexpected channel {x}" for x in channels.keys() if x >= n_channels]
+    if case not in index.labels and require_label:
+        problems.append("missing label")
+
+    files = list(channels.values()) + ([index.labels[case]] if case in index.labels else [])
+    reference = geometries.get(files[0])
+    for name in files[1:]:
+        geometry = geometries.get(name)
+        if reference is None or geometry is None:
+            continue
+        if not same_geometry(reference, geometry):
+            problems.append(f"geometry of {name} differs from {files[0]}")
+    return problems
+
+
+def _read_geometries(
+    dataset: Path, files: dict[str, tuple[int, int]], previous: dict[str, dict], workers: int
+) -> tuple[dict[str, dict], list[str]]:
+    # Headers are only read for files that changed since the previous audit
+    entries = {}
+    stale = []
+    for name, (n_bytes, mtime_ns) in files.items():
+        entry = previous.get(name)
+        if entry is not None and entry["bytes"] == n_bytes and entry["mtime_ns"] == mtime_ns:
+            entries[name] = entry
+        else:
+            stale.append(name)
+
+    unreadable = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(read_geometry, dataset / name) for name in stale}
+        for name, future in futures.items():
+            n_bytes, mtime_ns = files[name]
+            try:
+                entries[name] = {"bytes": n_bytes, "mtime_ns": mtime_ns, "geometry": future.result()}
+            except RuntimeError:
+                unreadable.append(name)
+    return entries, unreadable
+
+
+def audit(dataset: Path, previous: dict, workers: int, require_test_labels: bool = False) -> dict:
+    """
+    Returns the audit manifest of dataset, with the headers of all files, and the problems of
+    every case per split. previous is the manifest of an earlier audit, or empty.
+    """
+    try:
+        with open(dataset / "dataset.json", "r") as f:
+            n_channels = len(json.load(f)["modality"])
+    except (OSError, KeyError, json.JSONDecodeError):
+        n_channels = None
+
+    # Files are keyed by their path relative to the dataset, every folder is listed once
+    files = {}
+    indices = {}
+    for split, (image_dir, label_dir) in SPLITS.items():
+        image_files = list_files(dataset / image_dir)
+        label_files = list_files(dataset / label_dir)
+        index = index_split(list(image_files.keys()), list(label_files.keys()))
+        indices[split] = SplitIndex(
+            {x: {c: f"{image_dir}/{n}" for c, n in y.items()} for x, y in index.images.items()},
+            {x: f"{label_dir}/{y}" for x, y in index.labels.items()},
+            [f"{image_dir if x in image_files else label_dir}/{x}" for x in index.unknown],
+        )
+        files.update({f"{image_dir}/{x}": y for x, y in image_files.items() if x not in index.unknown})
+        files.update({f"{label_dir}/{x}": y for x, y in label_files.items() if x not in index.unknown})
+
+    entries, unreadable = _read_geometries(dataset, files, previous.get("files", {}), workers)
+    geometries = {x: y["geometry"] for x, y in entries.items()}
+
+    cases = {}
+    for split, index in indices.items():
+        split_channels = n_channels or max((max(x.keys()) + 1 for x in index.images.values()), default=0)
+        require_label = split == "Tr" or require_test_labels
+        cases[split] = {
+            case: _case_problems(case, index, split_channels, geometries, require_label)
+            for case in sorted(set(index.images.keys()) | set(index.labels.keys()))
+        }
+
+    return {
+        "files": dict(sorted(entries.items())),
+        "unreadable": sorted(unreadable),
+        "unknown": sorted(x for split in SPLITS for x in indices[split].unknown),
+        "cases": cases,
+    }
+
+
+def print_diff(previous: dict, current: dict) -> None:
+    for split in SPLITS.keys():
+        before = previous.get("cases", {}).get(split, {})
+        after = current["cases"][split]
+        added = sorted(set(after) - set(before))
+        removed = sorted(set(before) - set(after))
+        changed = sorted(x for x in set(after) & set(before) if after[x] != before[x])
+        if len(added) + len(removed) + len(changed) == 0:
+            continue
+
+        print(f"Changes in {split} since the previous audit")
+        for case in added:
+            print(f" + {case}")
+        for case in removed:
+            print(f" - {case}")
+        for case in changed:
+            print(f" ~ {case}: {', '.join(after[case]) or 'ok'}")
+
+
+@click.command()
+@click.argument("dataset", type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path))
+@click.option(
+    "-m",
+    "--manifest",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=None,
+    help=f"Where to write the audit, defaults to {AUDIT_MANIFEST} in the dataset",
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of headers read concurrently",
+)
+@click.option("--test-labels", is_flag=True, default=False, help="Also require labels for the test set")
+def main(dataset: Path, manifest: Path | None = None, workers: int = 16, test_labels: bool = False):
+    if manifest is None:
+        manifest = dataset / AUDIT_MANIFEST
+
+    previous = {}
+    if manifest.exists():
+        with open(manifest, "r") as f:
+            previous = json.load(f)
+
+    current = audit(dataset, previous, workers, test_labels)
+    write_json(manifest, current)
+    print_diff(previous, current)
+
+    n_problems = 0
+    for split, cases in current["cases"].items():
+        problems = {x: y for x, y in cases.items() if len(y) > 0}
+        print(f"{split}: {len(cases)} cases, {len(problems)} with problems")
+        for case, case_problems in problems.items():
+            print(f" - {case}: {', '.join(case_problems)}")
+        n_problems += len(problems)
+
+    for name in current["unreadable"]:
+        print(f"Could not read the header of {name}")
+    for name in current["unknown"]:
+        print(f"Not part of any case: {name}")
+
+    if n_problems + len(current["unreadable"]) > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,18 @@
 import gc
-import struct
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import click
-import nibabel as nib
 import numpy as np
 from tqdm import tqdm
 
+if TYPE_CHECKING:
+    import nibabel as nib
+
+
+def _axis_order(ref: "nib.Nifti1Image") -> tuple[list[int], list[int], list[int]]:
+    import nibabel as nib
 
-def _convert_bin(path: Path, reference: Path) -> nib.Nifti1Image:
-    ref = nib.load(reference)
     axcodes = nib.aff2axcodes(ref.affine)
 
     # The original .bin files are stored in LPS order, slice first
@@ -42,12 +45,18 @@ def _convert_bin(path: Path, reference: Path) -> nib.Nifti1Image:
         else:
             raise RuntimeError(f"Invalid axcode {c}")
 
-    with open(path, mode="rb") as file:
-        file_content = file.read()
+    return shape, order, flip
+
+
+def _convert_bin(path: Path, reference: Path) -> "nib.Nifti1Image":
+    import nibabel as nib
+
+    ref = nib.load(reference)
+    shape, order, flip = _axis_order(ref)
 
     # Now that we have the axes in L/R, A/P, I/S order, we can reshape our 1D binary vector
-    bin_data: tuple = struct.unpack("H" * (len(file_content) // 2), file_content)
-    bin_data: np.ndarray = np.reshape(bin_data, shape[::-1]).astype(np.uint8)
+    bin_data = np.fromfile(path, dtype=np.uint16)
+    bin_data = np.reshape(bin_data, shape[::-1]).astype(np.uint8)
 
     # And because we need to be in the same voxel order as our reference image
     # transpose and flip as needed
@@ -61,11 +70,75 @@ def _convert_bin(path: Path, reference: Path) -> nib.Nifti1Image:
     return output
 
 
+def _convert_bin_slabs(path: Path, reference: Path, output: Path, slab_size: int) -> None:
+    import nibabel as nib
+
+    from nnunetpaper.process.slabs import SlabWriter
+
+    ref = nib.load(reference)
+    shape, order, flip = _axis_order(ref)
+
+    # Same transpose and flip as above, but on a view of the file on disk,
+    # so only the slices of one slab are ever read into memory
+    bin_data = np.memmap(path, dtype=np.uint16, mode="r", shape=tuple(shape[::-1]))
+    bin_data = np.flip(np.transpose(bin_data, axes=order[::-1]), axis=flip)
+
+    header = nib.Nifti1Image(np.broadcast_to(np.uint8(0), bin_data.shape), ref.affine).header
+    with SlabWriter(output, header) as writer:
+        for start in range(0, bin_data.shape[2], slab_size):
+            writer.write(bin_data[:, :, start:start + slab_size].astype(np.uint8).T)
+
+
 @click.group()
 def main():
     ...
 
 
+def _find_references(images: list[Path], reference_path: Path) -> list[Path]:
+    references = []
+    for image in (prog_bar := tqdm(images, "Scanning for references...")):
+        stem = image.stem
+        prog_bar.set_description(f"Scanning for references... ({stem})")
+        ref_candidates = [
+            x
+            for x in reference_path.iterdir()
+            if x.is_file() and stem + "_0000" in x.stem
+        ]
+        if len(ref_candidates) > 1:
+            raise RuntimeError(
+                f"Too many candidate references for {image}:\n{ref_candidates}"
+            )
+        elif len(ref_candidates) == 0:
+            raise RuntimeError(f"No candidate references for {image}")
+        else:
+            references.append(ref_candidates[0])
+    return references
+
+
+def _output_paths(images: list[Path], output_path: Path | None) -> list[Path]:
+    if output_path is None:
+        return [x.parent / (x.stem + ".nii.gz") for x in images]
+    elif output_path.is_file():
+        return [output_path]
+    elif output_path.is_dir():
+        return [output_path / (x.stem + ".nii.gz") for x in images]
+    else:
+        raise ValueError(f"{output_path} is not a directory or a file!")
+
+
+def _convert_file(image: Path, reference: Path, output: Path, slab_size: int | None) -> None:
+    import nibabel as nib
+
+    if slab_size is not None:
+        _convert_bin_slabs(image, reference, output, slab_size)
+        return
+
+    result = _convert_bin(image, reference)
+    nib.save(result, output)
+    del result
+    gc.collect()
+
+
 @main.command()
 @click.option(
     "-i",
@@ -88,7 +161,16 @@ def main():
     required=False,
     type=click.Path(writable=True, path_type=Path),
 )
-def directory(input_path: Path, reference_path: Path, output_path: Path = None):
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Convert in slabs of this many slices, to bound memory use",
+)
+def directory(
+    input_path: Path, reference_path: Path, output_path: Path = None, slab_size: int | None = None
+):
     if input_path.is_file():
         images = [input_path]
     elif input_path.is_dir():
@@ -99,44 +181,18 @@ def directory(input_path: Path, reference_path: Path, output_path: Path = None):
     if reference_path.is_file():
         references = [reference_path]
     elif reference_path.is_dir():
-        references = []
-        for image in (prog_bar := tqdm(images, "Scanning for references...")):
-            stem = image.stem
-            prog_bar.set_description(f"Scanning for references... ({stem})")
-            ref_candidates = [
-                x
-                for x in reference_path.iterdir()
-                if x.is_file() and stem + "_0000" in x.stem
-            ]
-            if len(ref_candidates) > 1:
-                raise RuntimeError(
-                    f"Too many candidate references for {image}:\n{ref_candidates}"
-                )
-            elif len(ref_candidates) == 0:
-                raise RuntimeError(f"No candidate references for {image}")
-            else:
-                references.append(ref_candidates[0])
+        references = _find_references(images, reference_path)
     else:
         raise ValueError(f"{reference_path} is not a directory or a file!")
 
-    if output_path is None:
-        outputs = [x.parent / (x.stem + ".nii.gz") for x in images]
-    elif output_path.is_file():
-        outputs = [output_path]
-    elif output_path.is_dir():
-        outputs = [output_path / (x.stem + ".nii.gz") for x in images]
-    else:
-        raise ValueError(f"{output_path} is not a directory or a file!")
+    outputs = _output_paths(images, output_path)
 
     for im, ref, out in (
         prog_bar := tqdm(zip(images, references, outputs), total=len(images))
     ):
         prog_bar.set_description(f"Converting {im.name}")
         try:
-            result = _convert_bin(im, ref)
-            nib.save(result, out)
-            del result
-            gc.collect()
+            _convert_file(im, ref, out, slab_size)
         except MemoryError:
             print(f"Encountered a memory error for {im.name}")
             continue
@@ -164,10 +220,25 @@ def directory(input_path: Path, reference_path: Path, output_path: Path = None):
     required=False,
     type=click.Path(writable=True, dir_okay=False, path_type=Path),
 )
-def single(input_path: Path, reference_path: Path, output_path: Path = None):
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Convert in slabs of this many slices, to bound memory use",
+)
+def single(
+    input_path: Path, reference_path: Path, output_path: Path = None, slab_size: int | None = None
+):
+    import nibabel as nib
+
     if output_path is None:
         output_path = input_path.parent / (input_path.stem + ".nii.gz")
 
+    if slab_size is not None:
+        _convert_bin_slabs(input_path, reference_path, output_path, slab_size)
+        return
+
     result = _convert_bin(input_path, reference_path)
     nib.save(result, output_path)
 
@@ -3,36 +3,95 @@ The mesh-growing algorithm runs all segmentations in one go, so we can simply
 copy the times from the first segmentation to all others.
 
 Copying the times is less error-prone than manually copying them for each segmentation.
+The reference is read once, and all target files are patched concurrently. Directories
+are searched for scores.json and scores.jsonl files, so all anatomies of all methods can be
+done at once, and every file is written back in its own format.
+Every file is replaced atomically, so an interrupted run never leaves a broken file behind.
 """
 
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
 
+from nnunetpaper.data.utils import read_scores, write_scores
+
+
+def _collect_files(paths: list[Path], ref: Path) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files += sorted(x for x in path.rglob("scores.json*") if x.suffix in (".json", ".jsonl"))
+        else:
+            files.append(path)
+
+    # Never patch the reference itself, and every file only once
+    ref = ref.resolve()
+    return list(dict.fromkeys(x.resolve() for x in files if x.resolve() != ref))
+
+
+def _copy_times(file: Path, ref_times: dict[str, float], compact: bool) -> list[str]:
+    data = read_scores(file)
+
+    missing = []
+    for key in data.keys():
+        if key in ref_times:
+            data[key]["time"] = ref_times[key]
+        else:
+            missing.append(key)
+
+    write_scores(file, data, compact=compact)
+    return missing
+
 
 @click.command()
 @click.argument(
     "files",
     nargs=-1,
-    type=click.Path(dir_okay=False, readable=True, writable=True, path_type=Path),
+    type=click.Path(exists=True, readable=True, writable=True, path_type=Path),
 )
 @click.option(
     "-r", "--ref", required=True, type=click.Path(readable=True, path_type=Path)
 )
-def main(files: list[Path], ref: Path):
-    with open(ref, "r") as f:
-        ref_data = json.load(f)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    default=False,
+    help="Write the files without indentation and whitespace",
+)
+def main(files: list[Path], ref: Path, workers: int = 8, compact: bool = False):
+    ref_times = {k: v["time"] for k, v in read_scores(ref).items() if "time" in v}
+
+    files = _collect_files(files, ref)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {file: executor.submit(_copy_times, file, ref_times, compact) for file in files}
 
-    for file in files:
-        with open(file, "r") as f:
-            data = json.load(f)
+    failed = 0
+    for file, future in futures.items():
+        try:
+            missing = future.result()
+        except (OSError, KeyError, json.JSONDecodeError) as e:
+            print(f"Could not update {file}: {e}")
+            failed += 1
+            continue
 
-        for key, value in data.items():
-            data[key]["time"] = ref_data[key]["time"]
+        if len(missing) > 0:
+            print(f"No reference time in {file} for:")
+            for key in missing:
+                print(f"\t- {key}")
 
-        with open(file, "w") as f:
-            json.dump(data, f, indent=4)
+    print(f"Updated {len(files) - failed} of {len(files)} files")
+    if failed > 0:
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
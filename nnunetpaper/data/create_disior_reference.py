@@ -1,7 +1,6 @@
 from pathlib import Path
 
 import click
-import SimpleITK as sitk
 from tqdm import tqdm
 
 
@@ -21,6 +20,8 @@ from tqdm import tqdm
     type=click.Path(file_okay=False, writable=True, path_type=Path),
 )
 def main(input_path: Path, output_path: Path):
+    import SimpleITK as sitk
+
     brain_dir = input_path / "brain"
     tumor_dir = input_path / "tumor"
     ventricles_dir = input_path / "ventricles"
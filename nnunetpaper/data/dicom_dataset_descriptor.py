@@ -1,13 +1,111 @@
-from collections import Counter
-from pathlib import Path
+"""
+Describes the demographics and scanners of a DICOM dataset, per segmented anatomy.
 
-import click
-import pydicom
+The T1 GD series of every patient is looked up in the series index (see `data index-dicom`),
+which holds the headers we report, so the archive is only scanned when the index has not
+seen it yet, or when asked to with --update.
 
+Headers are collected into a DataFrame with a row per patient and anatomy, and counted per
+anatomy and field in one groupby. The counts can be exported as a CSV, Parquet or LaTeX table.
+"""
+from pathlib import Path
 
-def print_stats(counter: Counter) -> None:
-    for key, value in counter.items():
-        print(f"\t\t{key} - {value}")
+import click
+import pandas as pd
+
+from nnunetpaper.data.series_index import Series, SeriesIndex, default_index
+
+ANATOMIES = ["brain", "skin", "tumor", "ventricles"]
+
+# Reported name and column of the series index
+HEADER_COLUMNS = {
+    "institution": "institution",
+    "age": "birth_date",
+    "gender": "sex",
+    "scanner brand": "manufacturer",
+    "scanner model": "model",
+    "scan date": "date",
+}
+
+
+TABLE_FORMATS = {".csv": "csv", ".parquet": "parquet", ".tex": "latex"}
+
+
+def describe(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Counts every value of every header field per anatomy, along with the fraction of the
+    patients of that anatomy that it makes up.
+    """
+    fields = list(HEADER_COLUMNS.keys())
+    values = data.melt(id_vars=["anatomy"], value_vars=fields, var_name="field", value_name="value")
+    values["field"] = pd.Categorical(values["field"], categories=fields, ordered=True)
+
+    table = values.groupby(["anatomy", "field", "value"], observed=True).size().rename("count").reset_index()
+    table["fraction"] = table["count"] / table.groupby(["anatomy", "field"], observed=True)["count"].transform("sum")
+    return table
+
+
+def print_description(table: pd.DataFrame, numbers: pd.Series) -> None:
+    anatomies = ANATOMIES + sorted(x for x in numbers.index if x not in ANATOMIES)
+    for anatomy in anatomies:
+        print(f"{anatomy} - {numbers.get(anatomy, 0)}")
+        for field in HEADER_COLUMNS.keys():
+            print(f"\t{field.capitalize()}:")
+            rows = table[(table["anatomy"] == anatomy) & (table["field"] == field)]
+            for value, count in zip(rows["value"], rows["count"]):
+                print(f"\t\t{value} - {count}")
+
+
+def write_table(table: pd.DataFrame, output: Path) -> None:
+    table_format = TABLE_FORMATS.get(output.suffix)
+    if table_format == "csv":
+        table.to_csv(output, index=False)
+    elif table_format == "parquet":
+        # Needs pyarrow or fastparquet
+        table.to_parquet(output, index=False)
+    elif table_format == "latex":
+        table.to_latex(output, index=False, float_format="%.3f")
+    else:
+        raise click.UsageError(f"Unknown table format {output.suffix}, use one of {', '.join(TABLE_FORMATS)}")
+
+
+def _check_table_format(ctx: click.Context, param: click.Parameter, value: Path | None) -> Path | None:
+    # Fails before the archive is scanned, rather than after
+    if value is not None and value.suffix not in TABLE_FORMATS:
+        raise click.BadParameter(f"Unknown table format {value.suffix}, use one of {', '.join(TABLE_FORMATS)}")
+    return value
+
+
+def find_t1ce_series(series: list[Series]) -> Series | None:
+    # Series are ordered by directory, only those in the Imaging directory are considered
+    for x in series:
+        if x.relative.split("/")[0] == "Imaging" and (x.matches("t1", "gd") or x.matches("t1", "contrast")):
+            return x
+    return None
+
+
+def _describe_patient(
+    patient: Path, segmentation_dir: Path, series_index: SeriesIndex, dicom_dir: Path
+) -> tuple[list[str], dict[str, str] | None, set[str]]:
+    if not (segmentation_dir / patient.name).exists():
+        return [f"No segmentation dir found for {patient.name}"], None, set()
+
+    series = series_index.series(dicom_dir, patient.name)
+    if len(series) == 0:
+        return [f"No series of {patient.name} in the index, scan the archive with --update"], None, set()
+    if not any(x.relative.split("/")[0] == "Imaging" for x in series):
+        return [f"No Imaging dir found for {patient.name}"], None, set()
+    t1ce_series = find_t1ce_series(series)
+    if t1ce_series is None:
+        return [f"No T1 GD image found for {patient.name}"], None, set()
+
+    header = {name: t1ce_series.header[column] or "Unknown" for name, column in HEADER_COLUMNS.items()}
+    segmentations = {
+        x.stem.split("_")[-1]
+        for x in (segmentation_dir / patient.name).iterdir()
+        if x.is_file() and "label" in x.name.lower()
+    }
+    return [f"Found T1 GD image: {t1ce_series.relative}"], header, segmentations
 
 
 @click.command()
@@ -23,154 +121,69 @@ def print_stats(counter: Counter) -> None:
     type=click.Path(exists=True, readable=True, path_type=Path),
     required=True,
 )
-def main(dicom_dir: Path, segmentation_dir: Path) -> None:
+@click.option(
+    "-i",
+    "--index",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=default_index(),
+    show_default=True,
+    help="Series index, built by `data index-dicom`",
+)
+@click.option(
+    "-u/-U",
+    "--update/--no-update",
+    default=True,
+    help="Scan the archive for changes first (the default), which only reads new or changed series",
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of headers read concurrently when scanning",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=None,
+    callback=_check_table_format,
+    help=f"Write the counts as a table, one of {', '.join(TABLE_FORMATS)} by extension",
+)
+def main(
+    dicom_dir: Path,
+    segmentation_dir: Path,
+    index: Path,
+    update: bool = True,
+    workers: int = 16,
+    output: Path | None = None,
+) -> None:
     dicom_patients = [x for x in dicom_dir.iterdir() if x.is_dir()]
     dicom_patients.sort()
 
-    stats = {
-        "brain": {
-            "number": 0,
-            "institution": [],
-            "gender": [],
-            "age": [],
-            "scanner brand": [],
-            "scanner model": [],
-            "scan date": [],
-        },
-        "skin": {
-            "number": 0,
-            "institution": [],
-            "gender": [],
-            "age": [],
-            "scanner brand": [],
-            "scanner model": [],
-            "scan date": [],
-        },
-        "tumor": {
-            "number": 0,
-            "institution": [],
-            "gender": [],
-            "age": [],
-            "scanner brand": [],
-            "scanner model": [],
-            "scan date": [],
-        },
-        "ventricles": {
-            "number": 0,
-            "institution": [],
-            "gender": [],
-            "age": [],
-            "scanner brand": [],
-            "scanner model": [],
-            "scan date": [],
-        },
-    }
+    records = []
+    with SeriesIndex(index) as series_index:
+        if update:
+            series_index.update(dicom_dir, workers)
+
+        for patient in dicom_patients:
+            print(patient.name)
+            messages, header, segmentations = _describe_patient(patient, segmentation_dir, series_index, dicom_dir)
+            for message in messages:
+                print(message)
+
+            records += [{"patient": patient.name, "anatomy": x, **header} for x in sorted(segmentations)]
+
+    data = pd.DataFrame(records, columns=["patient", "anatomy", *HEADER_COLUMNS.keys()])
+    table = describe(data)
+    print_description(table, data.groupby("anatomy").size())
 
-    for patient in dicom_patients:
-        print(patient.name)
-
-        if not (segmentation_dir / patient.name).exists():
-            print(f"No segmentation dir found for {patient.name}")
-            continue
-
-        if not (patient / "Imaging").exists():
-            print(f"No Imaging dir found for {patient.name}")
-            continue
-
-        imaging_dir = patient / "Imaging"
-        # Find t1 GD image
-        images = [x for x in imaging_dir.iterdir() if x.is_dir()]
-
-        t1ce_image = None
-        for image in images:
-            if "t1" in image.name.lower():
-                if "gd" in image.name.lower():
-                    print(f"Found T1 GD image: {image.name}")
-                    t1ce_image = image
-                    break
-                elif "contrast" in image.name.lower():
-                    print(f"Found T1 GD image: {image.name}")
-                    t1ce_image = image
-                    break
-
-        if len([x for x in t1ce_image.iterdir() if x.is_file()]) > 0:
-            t1ce_image = pydicom.dcmread([x for x in t1ce_image.iterdir() if x.is_file()][0])
-        else:
-            # Sometimes the images are in a subdirectory
-            subdir = [x for x in t1ce_image.iterdir() if x.is_dir()][0]
-            t1ce_image = pydicom.dcmread([x for x in subdir.iterdir() if x.is_file()][0])
-
-        segmentations = [x.stem.split("_")[-1] for x in (segmentation_dir / patient.name).iterdir() if x.is_file() and "label" in x.name.lower()]
-        segmentations = set(segmentations)
-
-        for segmentation in segmentations:
-
-            try:
-                institution = t1ce_image[0x0008_0080].value
-            except KeyError:
-                institution = "Unknown"
-
-            try:
-                age = t1ce_image[0x0010_0030].value
-            except KeyError:
-                age = "Unknown"
-
-            try:
-                gender = t1ce_image[0x0010_0040].value
-            except KeyError:
-                gender = "Unknown"
-
-            try:
-                scanner_brand = t1ce_image[0x0008_0070].value
-            except KeyError:
-                scanner_brand = "Unknown"
-
-            try:
-                scanner_model = t1ce_image[0x0008_1090].value
-            except KeyError:
-                scanner_model = "Unknown"
-
-            try:
-                scan_date = t1ce_image[0x0008_0020].value
-            except KeyError:
-                scan_date = "Unknown"
-
-            stats[segmentation]["number"] += 1
-            stats[segmentation]["institution"].append(institution)
-            stats[segmentation]["age"].append(age)
-            stats[segmentation]["gender"].append(gender)
-            stats[segmentation]["scanner brand"].append(scanner_brand)
-            stats[segmentation]["scanner model"].append(scanner_model)
-            stats[segmentation]["scan date"].append(scan_date)
-
-    for anatomy in stats.keys():
-        print(f"{anatomy} - {stats[anatomy]['number']}")
-
-        institution_counter = Counter(stats[anatomy]["institution"])
-        print("\tInstitution:")
-        print_stats(institution_counter)
-
-        age_counter = Counter(stats[anatomy]["age"])
-        print("\tAge:")
-        print_stats(age_counter)
-
-        gender_counter = Counter(stats[anatomy]["gender"])
-        print("\tGender:")
-        print_stats(gender_counter)
-
-        brand_counter = Counter(stats[anatomy]["scanner brand"])
-        print("\tScanner brand:")
-        print_stats(brand_counter)
-
-        model_counter = Counter(stats[anatomy]["scanner model"])
-        print("\tScanner model:")
-        print_stats(model_counter)
-
-        date_counter = Counter(stats[anatomy]["scan date"])
-        date_counter = sorted(date_counter.items(), key=lambda x: x[0])
-        date_counter = {x[0]: x[1] for x in date_counter}
-        print("\tScan date:")
-        print_stats(date_counter)
+    if output is not None:
+        write_table(table, output)
 
 
 if __name__ == "__main__":
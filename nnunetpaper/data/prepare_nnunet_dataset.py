@@ -1,18 +1,43 @@
 # NOTE: This is designed for nnU-Net <v2.*
 # V2 changed some things around, so this script would need to be updated to work with v2
-
+"""
+Images can be NIfTI (or any other format SimpleITK reads) or DICOM series, which are converted
+straight into the dataset. An image glob that matches a directory reads it as a DICOM series,
+and --series looks series up by their description in the series index (see `data index-dicom`).
+
+Inputs are found first, since ambiguous globs are resolved interactively, after which patients
+are converted in parallel.
+
+The train/test split is kept in a manifest in the output directory. Rebuilding the dataset
+keeps every case in its set, assigns only new cases, stratified per dataset or scanner, and
+only writes cases whose inputs changed.
+"""
+import hashlib
 import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import click
 import numpy as np
-from SimpleITK import ReadImage, WriteImage, GetArrayFromImage
-from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
+from nnunetpaper.data.series_index import SeriesIndex, default_index
+from nnunetpaper.data.utils import write_json
+
+if TYPE_CHECKING:
+    import SimpleITK as sitk
+
+# Assignment of every case to the train or test set, along with what it was built from
+SPLIT_MANIFEST = "split.json"
+STRATIFY = ["none", "dataset", "scanner"]
+
 
-def _find_file(path: Path, glob: str) -> Path | None:
-    candidates = [x.resolve() for x in path.glob(glob) if x.is_file()]
+def _find_file(path: Path, glob: str, allow_dirs: bool = False) -> Path | None:
+    candidates = [x.resolve() for x in path.glob(glob) if x.is_file() or (allow_dirs and x.is_dir())]
 
     if len(candidates) == 1:
         return candidates[0]
@@ -27,97 +52,237 @@ def _find_file(path: Path, glob: str) -> Path | None:
         return None
 
 
-def _process_set(
-    samples: list[Path],
+def _find_series(sample: Path, keywords: str, series_index: SeriesIndex) -> Path | None:
+    # Keywords are comma separated, e.g. "t1,gd"
+    for series in series_index.series(sample.parent, sample.name):
+        if series.matches(*keywords.split(",")):
+            return series.directory
+    return None
+
+
+def _update_index(series_index: SeriesIndex, datasets: list[Path]) -> None:
+    # Only new or changed series are read, so this is cheap once the index is built
+    for dataset in datasets:
+        series_index.update(dataset)
+        if series_index.is_empty(dataset):
+            raise click.UsageError(f"No DICOM series found in {dataset}")
+
+
+def _find_inputs(
+    sample: Path,
     image_glob: list[str],
+    series: list[str],
+    series_index: SeriesIndex | None,
     label_glob: str,
-    output_base: Path,
-    output_dir_suffix: str,
     allow_missing_label: bool,
-    as_posix: bool,
-) -> tuple[dict[str, str], int]:
-    paths: list[dict[str, str]] = []
-    n_classes = 0
-
-    for sample in tqdm(samples, desc=f"Processing {output_dir_suffix}"):
-        image_base = Path(f"images{output_dir_suffix}")
-        label_base = Path(f"labels{output_dir_suffix}")
-
-        # Prepare output directories
-        if not output_base.exists():
-            output_base.mkdir(parents=True)
-        if not (output_base / image_base).exists():
-            (output_base / image_base).mkdir()
-        if not (output_base / label_base).exists():
-            (output_base / label_base).mkdir()
-
-        should_skip = False
-
-        # Find image(s)
-        images = []
-        for i in image_glob:
-            image = _find_file(sample, i)
-            if image is None:
-                print(
-                    f"Image could not be found for {i} in {sample.name}, skipping this patient"
-                )
-                should_skip = True
-            else:
-                images.append(image)
-
-        # If something is wrong with the images, skip to next patient
-        if should_skip:
-            continue
+) -> tuple[list[Path], Path | None] | None:
+    images = [_find_file(sample, x, allow_dirs=True) for x in image_glob]
+    images += [_find_series(sample, x, series_index) for x in series]
+    for name, image in zip(list(image_glob) + list(series), images):
+        if image is None:
+            print(f"Image could not be found for {name} in {sample.name}, skipping this patient")
+            return None
+
+    label = _find_file(sample, label_glob)
+    if label is None and not allow_missing_label:
+        print(f"Label could not be found for {label_glob} in {sample.name}, skipping this patient")
+        return None
 
-        # Find label
-        label = _find_file(sample, label_glob)
-        if label is None:
-            if not allow_missing_label:
-                print(
-                    f"Label could not be found for {label_glob} in {sample.name}, skipping this patient"
-                )
-                should_skip = True
-
-        # If something is wrong with the label, and we don't allow missing labels, skip
-        if should_skip:
-            continue
+    return images, label
 
-        # Now that we know our valid images, and label (if it exists)
-        # start writing to output!
-        # Image(s) first
-        for idx, image in enumerate(images):
-            output_name = sample.name + f"_{idx:04d}.nii.gz"
 
-            WriteImage(ReadImage(image), output_base / image_base / output_name)
+def read_image(path: Path, threads: int | None = None) -> "sitk.Image":
+    """
+    Reads an image file, or a directory as a DICOM series, with its slices read by multiple threads.
+    """
+    import SimpleITK as sitk
 
-        # Labels second
-        if label is not None:
-            output_name = sample.name + ".nii.gz"
+    if not path.is_dir():
+        return sitk.ReadImage(path)
 
-            label_image = ReadImage(label)
-            label_array = GetArrayFromImage(label_image)
+    reader = sitk.ImageSeriesReader()
+    file_names = reader.GetGDCMSeriesFileNames(str(path))
+    if len(file_names) == 0:
+        raise RuntimeError(f"No DICOM series found in {path}")
+    reader.SetFileNames(file_names)
+    if threads is not None:
+        reader.SetNumberOfThreads(threads)
+    return reader.Execute()
 
-            highest_class_no = int(np.max(label_array).item())
-            n_classes = max(n_classes, highest_class_no)
 
-            WriteImage(label_image, output_base / label_base / output_name)
+def _convert_sample(
+    name: str, images: list[Path], label: Path | None, image_dir: Path, label_dir: Path, threads: int
+) -> int:
+    # Returns the highest class in the label, every image is read and written exactly once
+    from SimpleITK import GetArrayViewFromImage, ReadImage, WriteImage
 
-        if as_posix:
-            paths.append(
-                {
-                    "image": (image_base / (sample.name + ".nii.gz")).as_posix(),
-                    "label": (label_base / (sample.name + ".nii.gz")).as_posix(),
-                }
-            )
+    for idx, image in enumerate(images):
+        WriteImage(read_image(image, threads), image_dir / f"{name}_{idx:04d}.nii.gz")
+
+    if label is None:
+        return 0
+
+    label_image = ReadImage(label)
+    WriteImage(label_image, label_dir / f"{name}.nii.gz")
+    return int(np.max(GetArrayViewFromImage(label_image)).item())
+
+
+def _inputs_hash(images: list[Path], label: Path | None) -> str:
+    # Paths, sizes and modification times of all inputs, including every file of a DICOM series
+    digest = hashlib.sha1()
+    for path in images + [label]:
+        if path is None:
+            digest.update(b"no label\n")
+            continue
+        for entry in sorted(os.scandir(path), key=lambda x: x.name) if path.is_dir() else [path]:
+            stat = os.stat(entry)
+            digest.update(f"{os.fspath(entry)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _stratum(sample: Path, stratify: str, series_index: SeriesIndex | None) -> str:
+    if stratify == "dataset":
+        return sample.parent.name
+    elif stratify == "scanner":
+        for series in series_index.series(sample.parent, sample.name):
+            if series.header["manufacturer"] is not None:
+                return f"{series.header['manufacturer']} {series.header['model']}"
+        return "Unknown"
+    return "all"
+
+
+def assign_sets(strata: dict[str, str], previous: dict[str, str], split: float, seed: int) -> dict[str, str]:
+    """
+    Cases keep the set they were in before. New cases are taken in a seeded random order, and
+    go to the test set while their stratum has fewer than `split` of its cases in there.
+    The order of a case does not depend on any other case, so adding cases never moves others.
+    """
+    sets = {name: previous[name] for name in strata.keys() if name in previous}
+    n_cases = Counter(strata[x] for x in sets.keys())
+    n_test = Counter(strata[x] for x, y in sets.items() if y == "Ts")
+
+    new_cases = sorted(
+        (x for x in strata.keys() if x not in sets),
+        key=lambda x: hashlib.sha1(f"{seed}:{x}".encode("utf-8")).hexdigest(),
+    )
+    for name in new_cases:
+        stratum = strata[name]
+        n_cases[stratum] += 1
+        if n_test[stratum] < int(split * n_cases[stratum] + 0.5):
+            sets[name] = "Ts"
+            n_test[stratum] += 1
         else:
-            paths.append(
-                {
-                    "image": str(image_base / (sample.name + ".nii.gz")),
-                    "label": str(label_base / (sample.name + ".nii.gz")),
-                }
-            )
+            sets[name] = "Tr"
+    return sets
+
+
+def _output_files(output: Path, name: str, case: dict) -> list[Path]:
+    files = [output / f"images{case['set']}" / f"{name}_{idx:04d}.nii.gz" for idx in range(case["n_images"])]
+    if case["has_label"]:
+        files.append(output / f"labels{case['set']}" / f"{name}.nii.gz")
+    return files
+
+
+def _find_cases(
+    samples: list[Path],
+    image_glob: list[str],
+    series: list[str],
+    series_index: SeriesIndex | None,
+    label_glob: str,
+    allow_missing_label: bool,
+    stratify: str,
+) -> dict[str, dict]:
+    cases = {}
+    for sample in tqdm(samples, desc="Finding samples"):
+        found = _find_inputs(sample, image_glob, series, series_index, label_glob, allow_missing_label)
+        if found is None:
+            continue
 
-    return paths, n_classes
+        images, label = found
+        cases[sample.name] = {
+            "source": str(sample),
+            "stratum": _stratum(sample, stratify, series_index),
+            "hash": _inputs_hash(images, label),
+            "n_images": len(images),
+            "has_label": label is not None,
+            "inputs": (images, label),
+        }
+    return cases
+
+
+def _is_current(output: Path, name: str, case: dict, previous: dict | None) -> bool:
+    # Outputs are only kept if they were written from the same inputs, into the same set
+    if previous is None or previous["hash"] != case["hash"] or previous["set"] != case["set"]:
+        return False
+    return all(x.exists() for x in _output_files(output, name, case))
+
+
+def _convert_cases(output: Path, cases: dict[str, dict], workers: int) -> tuple[dict[str, int], dict[str, str]]:
+    # Returns the classes of the converted cases, and the error of every case that failed
+    # Every worker gets its share of the threads for reading DICOM slices
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(
+                _convert_sample,
+                name,
+                *case["inputs"],
+                output / f"images{case['set']}",
+                output / f"labels{case['set']}",
+                threads,
+            )
+            for name, case in cases.items()
+        }
+
+        classes = {}
+        failed = {}
+        for name, future in tqdm(futures.items(), desc="Processing"):
+            try:
+                classes[name] = future.result()
+            except Exception as e:
+                failed[name] = f"{type(e).__name__}: {e}"
+    return classes, failed
+
+
+def update_dataset(
+    output: Path, cases: dict[str, dict], previous: dict[str, dict], workers: int
+) -> tuple[int, dict[str, str]]:
+    """
+    Brings the images and labels in output in line with cases. Only cases that are new, changed
+    or moved to the other set are written, and the outputs of cases that are gone or moved are
+    removed. Cases that fail to convert are removed from cases, along with their outputs.
+    Returns the number of cases written, and the error of every case that failed.
+    """
+    for case_set in ["Tr", "Ts"]:
+        (output / f"images{case_set}").mkdir(parents=True, exist_ok=True)
+        (output / f"labels{case_set}").mkdir(parents=True, exist_ok=True)
+
+    stale = {x: y for x, y in cases.items() if not _is_current(output, x, y, previous.get(x))}
+    for name, case in previous.items():
+        if name not in cases or cases[name]["set"] != case["set"]:
+            for file in _output_files(output, name, case):
+                file.unlink(missing_ok=True)
+
+    classes, failed = _convert_cases(output, stale, workers) if len(stale) > 0 else ({}, {})
+    for name in failed.keys():
+        # Half written outputs would otherwise end up in the dataset
+        for file in _output_files(output, name, cases.pop(name)):
+            file.unlink(missing_ok=True)
+    for name, case in cases.items():
+        case["classes"] = classes[name] if name in stale else previous[name]["classes"]
+    return len(stale) - len(failed), failed
+
+
+def _dataset_paths(cases: dict[str, dict], case_set: str, as_posix: bool) -> list[dict[str, str]]:
+    paths: list[dict[str, str]] = []
+    for name in sorted(x for x, y in cases.items() if y["set"] == case_set):
+        image = Path(f"images{case_set}") / (name + ".nii.gz")
+        label = Path(f"labels{case_set}") / (name + ".nii.gz")
+        if as_posix:
+            paths.append({"image": image.as_posix(), "label": label.as_posix()})
+        else:
+            paths.append({"image": str(image), "label": str(label)})
+    return paths
 
 
 @click.command()
@@ -135,9 +300,47 @@ def _process_set(
     required=True,
     type=click.Path(file_okay=False, writable=True, path_type=Path),
 )
-@click.option("-i", "--image", "image_glob", multiple=True, required=True, type=str)
+@click.option(
+    "-i",
+    "--image",
+    "image_glob",
+    multiple=True,
+    required=False,
+    type=str,
+    help="Glob of an image file, or of a DICOM series directory, for every channel",
+)
+@click.option(
+    "-S",
+    "--series",
+    multiple=True,
+    required=False,
+    type=str,
+    help="Comma separated keywords of a DICOM series in the series index, for every channel after the globs",
+)
+@click.option(
+    "--series-index",
+    required=False,
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=default_index(),
+    show_default=True,
+)
 @click.option("-l", "--label", "label_glob", required=True, type=str)
-@click.option("-s", "--split", required=False, type=float, default=0.2)
+@click.option("-s", "--split", required=False, type=click.FloatRange(0.0, 1.0), default=0.2, help="Test fraction")
+@click.option("--seed", required=False, type=int, default=0, show_default=True)
+@click.option(
+    "--stratify",
+    required=False,
+    type=click.Choice(STRATIFY),
+    default="dataset",
+    show_default=True,
+    help="Split every dataset directory, or every scanner (from the series index), separately",
+)
+@click.option(
+    "--reshuffle",
+    is_flag=True,
+    default=False,
+    help=f"Ignore the assignments in {SPLIT_MANIFEST}, instead of only assigning new cases",
+)
 @click.option(
     "-p", "--posix", "as_posix", is_flag=True, type=bool, required=False, default=False
 )
@@ -150,49 +353,74 @@ def _process_set(
     required=False,
     default=False,
 )
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of patients converted in parallel",
+)
 def main(
     datasets: list[Path],
     output: Path,
     image_glob: list[str],
+    series: list[str],
+    series_index: Path,
     label_glob: str,
     split: float,
     as_posix: bool,
     allow_missing_label: bool,
+    workers: int = 4,
+    seed: int = 0,
+    stratify: str = "dataset",
+    reshuffle: bool = False,
 ):
+    if len(image_glob) == 0 and len(series) == 0:
+        raise click.UsageError("Give at least one --image or --series")
+
     # If the user provided more than one source directory, append the samples from each one
+    datasets = [Path(x) for x in datasets]
     samples = []
-    for path in tqdm([Path(x) for x in datasets], "Finding samples"):
+    for path in tqdm(datasets, "Finding datasets"):
         samples += [y.resolve() for y in path.glob("*") if y.is_dir()]
 
-    if split > 0.0:
-        train_set, test_set = train_test_split(samples, test_size=split)
-    else:
-        train_set = samples
-        test_set = []
-
-    train_paths, n_classes = _process_set(
-        train_set,
-        image_glob=image_glob,
-        label_glob=label_glob,
-        output_base=output,
-        output_dir_suffix="Tr",
-        allow_missing_label=allow_missing_label,
-        as_posix=as_posix,
-    )
-    test_paths, test_n_classes = _process_set(
-        test_set,
-        image_glob=image_glob,
-        label_glob=label_glob,
-        output_base=output,
-        output_dir_suffix="Ts",
-        allow_missing_label=allow_missing_label,
-        as_posix=as_posix,
-    )
-
-    if n_classes == test_n_classes:
-        raise RuntimeError(
-            "We did not find the same amount of classes in the test and train set"
-        )
+    manifest_path = output / SPLIT_MANIFEST
+    previous = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            previous = json.load(f)["cases"]
+
+    needs_index = len(series) > 0 or stratify == "scanner"
+    with SeriesIndex(series_index) if needs_index else nullcontext() as index:
+        # Both --series and the scanner strata need an index that is up to date
+        if index is not None:
+            _update_index(index, datasets)
+        cases = _find_cases(samples, image_glob, series, index, label_glob, allow_missing_label, stratify)
+
+    strata = {x: y["stratum"] for x, y in cases.items()}
+    # The previous outputs are still cleaned up after a reshuffle
+    previous_sets = {} if reshuffle else {x: y["set"] for x, y in previous.items()}
+    sets = assign_sets(strata, previous_sets, split, seed)
+    for name, case in cases.items():
+        case["set"] = sets[name]
+
+    output.mkdir(parents=True, exist_ok=True)
+    n_written, failed = update_dataset(output, cases, previous, workers)
+    print(f"Wrote {n_written} of {len(cases) + len(failed)} cases, the others were up to date")
+
+    for case in cases.values():
+        del case["inputs"]
+    manifest = {"seed": seed, "split": split, "stratify": stratify, "cases": dict(sorted(cases.items()))}
+    write_json(manifest_path, manifest)
+
+    train_paths = _dataset_paths(cases, "Tr", as_posix)
+    test_paths = _dataset_paths(cases, "Ts", as_posix)
+    n_classes = max((x["classes"] for x in cases.values() if x["set"] == "Tr"), default=0)
+    test_n_classes = max((x["classes"] for x in cases.values() if x["set"] == "Ts"), default=0)
+    if len(test_paths) > 0 and n_classes != test_n_classes:
+        print(f"The train set has {n_classes} classes, but the test set has {test_n_classes}")
 
     data_description = {
         "name": "name",
@@ -201,7 +429,7 @@ def main(
         "license": "None, all rights reserved",
         "release": "1.0",
         "tensorImageSize": "3D",
-        "modality": {f"{i}": f"modality {i}" for i in range(len(image_glob))},
+        "modality": {f"{i}": f"modality {i}" for i in range(len(image_glob) + len(series))},
         "labels": {f"{i}": f"label {i}" for i in range(n_classes + 1)},
         "numTraining": len(train_paths),
         "numTest": len(test_paths),
@@ -212,6 +440,12 @@ def main(
     with open(output / "dataset.json", "w") as out_file:
         json.dump(data_description, out_file, indent=4)
 
+    # The finished cases are kept, so the next run only converts the failed ones
+    if len(failed) > 0:
+        for name, error in sorted(failed.items()):
+            print(f"Could not convert {name}: {error}")
+        raise click.ClickException(f"{len(failed)} cases failed, and were left out of the dataset")
+
     print("\nDone!")
 
 
@@ -0,0 +1,217 @@
+"""
+Index of the DICOM series in an archive, kept in a SQLite database.
+
+Every directory that contains files is a series, described by the header of its first
+file (read up to the pixel data). Directories whose modification time and number of
+files did not change since the last scan are not read again, and directories that have
+disappeared are dropped, so keeping the index up to date is cheap. Scripts can then look
+up series by patient and description instead of walking the archive.
+"""
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import click
+from tqdm import tqdm
+
+from nnunetpaper.data.utils import cache_home
+
+SERIES_TAGS = {
+    "series_uid": 0x0020_000E,
+    "description": 0x0008_103E,
+    "modality": 0x0008_0060,
+    "manufacturer": 0x0008_0070,
+    "model": 0x0008_1090,
+    "institution": 0x0008_0080,
+    "date": 0x0008_0020,
+    "birth_date": 0x0010_0030,
+    "sex": 0x0010_0040,
+}
+
+_TAG_COLUMNS = ", ".join(SERIES_TAGS.keys())
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS series (
+    directory TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    relative TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    n_files INTEGER NOT NULL,
+    first_file TEXT NOT NULL,
+    {", ".join(f"{x} TEXT" for x in SERIES_TAGS.keys())}
+);
+CREATE INDEX IF NOT EXISTS series_patient ON series (root, patient);
+"""
+
+
+def default_index() -> Path:
+    return cache_home() / "dicom_series.sqlite"
+
+
+class Series(NamedTuple):
+    directory: Path
+    patient: str
+    # Path of the directory relative to the patient
+    relative: str
+    n_files: int
+    first_file: Path
+    header: dict[str, str | None]
+
+    def matches(self, *keywords: str) -> bool:
+        """
+        Whether every keyword occurs in the series description or the directory path,
+        ignoring case.
+        """
+        names = [self.relative.lower(), (self.header["description"] or "").lower()]
+        return any(all(x.lower() in name for x in keywords) for name in names)
+
+
+def read_series_header(file: Path) -> dict[str, str | None]:
+    import pydicom
+
+    dataset = pydicom.dcmread(file, stop_before_pixels=True, specific_tags=list(SERIES_TAGS.values()))
+    return {name: str(dataset[tag].value) if tag in dataset else None for name, tag in SERIES_TAGS.items()}
+
+
+def _read_or_empty(file: Path) -> tuple[dict[str, str | None], Exception | None]:
+    from pydicom.errors import InvalidDicomError
+
+    # Files that are not DICOM, or are unreadable, are indexed without a header
+    empty = {name: None for name in SERIES_TAGS.keys()}
+    try:
+        return read_series_header(file), None
+    except (OSError, InvalidDicomError):
+        return empty, None
+    except Exception as e:
+        # A corrupt DICOM file can fail to parse in many ways, which must not stop the scan
+        return empty, e
+
+
+def _walk_series(root: Path) -> Iterator[tuple[Path, int, list[str]]]:
+    for directory, _, files in os.walk(root):
+        files = sorted(x for x in files if not x.startswith("."))
+        # Files directly in the root don't belong to a patient
+        if len(files) > 0 and Path(directory) != root:
+            yield Path(directory), os.stat(directory).st_mtime_ns, files
+
+
+class SeriesIndex:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(_SCHEMA)
+
+    def __enter__(self) -> "SeriesIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.close()
+
+    def update(self, root: Path, workers: int = 16) -> tuple[int, int, int]:
+        """
+        Scans root for new or changed series, and drops those that are gone.
+        Returns the number of series that were read, removed and unchanged.
+        """
+        root = root.resolve()
+        known = {
+            directory: (mtime_ns, n_files)
+            for directory, mtime_ns, n_files in self.connection.execute(
+                "SELECT directory, mtime_ns, n_files FROM series WHERE root = ?", (str(root),)
+            )
+        }
+
+        found = set()
+        changed = []
+        for directory, mtime_ns, files in _walk_series(root):
+            found.add(str(directory))
+            if known.get(str(directory)) != (mtime_ns, len(files)):
+                changed.append((directory, mtime_ns, files))
+
+        rows = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            headers = executor.map(lambda x: _read_or_empty(x[0] / x[2][0]), changed)
+            for (directory, mtime_ns, files), (header, error) in tqdm(
+                zip(changed, headers), total=len(changed), desc="Indexing"
+            ):
+                if error is not None:
+                    tqdm.write(f"Could not read the header of {directory / files[0]}: {error}")
+                relative = directory.relative_to(root)
+                rows.append(
+                    (
+                        str(directory),
+                        str(root),
+                        relative.parts[0],
+                        Path(*relative.parts[1:]).as_posix(),
+                        mtime_ns,
+                        len(files),
+                        str(directory / files[0]),
+                        *header.values(),
+                    )
+                )
+
+        removed = [(x,) for x in known.keys() if x not in found]
+        with self.connection:
+            if len(rows) > 0:
+                placeholders = ", ".join("?" * len(rows[0]))
+                self.connection.executemany(f"INSERT OR REPLACE INTO series VALUES ({placeholders})", rows)
+            self.connection.executemany("DELETE FROM series WHERE directory = ?", removed)
+        return len(rows), len(removed), len(found) - len(rows)
+
+    def is_empty(self, root: Path) -> bool:
+        query = "SELECT 1 FROM series WHERE root = ? LIMIT 1"
+        return self.connection.execute(query, (str(root.resolve()),)).fetchone() is None
+
+    def series(self, root: Path, patient: str | None = None) -> list[Series]:
+        """
+        All series of root, or of a single patient in it, ordered by their directory.
+        """
+        query = f"SELECT directory, patient, relative, n_files, first_file, {_TAG_COLUMNS} FROM series"
+        parameters = (str(root.resolve()),)
+        if patient is None:
+            query += " WHERE root = ? ORDER BY directory"
+        else:
+            query += " WHERE root = ? AND patient = ? ORDER BY directory"
+            parameters += (patient,)
+
+        return [
+            Series(Path(x[0]), x[1], x[2], x[3], Path(x[4]), dict(zip(SERIES_TAGS.keys(), x[5:])))
+            for x in self.connection.execute(query, parameters)
+        ]
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--dicom-dir",
+    type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path),
+    required=True,
+    help="Archive with a directory per patient",
+)
+@click.option(
+    "-i",
+    "--index",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=default_index(),
+    show_default=True,
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of headers read concurrently",
+)
+def main(dicom_dir: Path, index: Path, workers: int = 16):
+    with SeriesIndex(index) as series_index:
+        read, removed, unchanged = series_index.update(dicom_dir, workers)
+    print(f"Indexed {read} new or changed series, removed {removed}, {unchanged} unchanged")
+
+
+if __name__ == "__main__":
+    main()
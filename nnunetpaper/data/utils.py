@@ -1,10 +1,257 @@
 import json
+import os
+import re
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator, TextIO
 
-import pandas as pd
+if TYPE_CHECKING:
+    import pandas as pd
 
 
-def read_json(files: list[Path]) -> pd.DataFrame:
+def write_json(path: Path, data, compact: bool = False) -> None:
+    """
+    Writes data to a temporary file next to path, which then replaces path,
+    so an interrupted write never leaves a half-written file behind.
+    """
+    path = Path(path)
+    temp_path = path.with_name(f".tmp-{os.getpid()}-{path.name}")
+    try:
+        with open(temp_path, mode="w") as file:
+            if compact:
+                json.dump(data, file, separators=(",", ":"))
+            else:
+                json.dump(data, file, indent=4)
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def cache_home() -> Path:
+    # Caches that outlive a single run, following the XDG base directory convention
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "nnunetpaper"
+
+
+SCORE_FORMATS = ["json", "jsonl"]
+
+
+def scores_output(output: Path | None, directory: Path, output_format: str | None) -> tuple[Path, str]:
+    """
+    Resolves where to write the scores to, and in which format. Without an explicit
+    format, it follows the extension of the output file.
+    """
+    if output is None:
+        output = directory / f"scores.{output_format or 'json'}"
+    elif output.is_dir():
+        output /= f"scores.{output_format or 'json'}"
+
+    if output_format is None:
+        output_format = "jsonl" if output.suffix == ".jsonl" else "json"
+    return output, output_format
+
+
+class ScoresWriter:
+    """
+    Writes scores either as a single JSON object once all patients are done, or as JSON Lines,
+    with one record per patient (or per class) written as soon as it is added.
+    JSON Lines files can be appended to, and shards can simply be concatenated.
+    """
+
+    def __init__(self, path: Path, output_format: str = "json", multiclass: bool = False):
+        if output_format not in SCORE_FORMATS:
+            raise ValueError(f"Unknown scores format {output_format}")
+
+        self.path = Path(path)
+        self.format = output_format
+        self.multiclass = multiclass
+        self.scores = {}
+        self.file = open(self.path, mode="w") if self.format == "jsonl" else None
+
+    def __enter__(self) -> "ScoresWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.file is not None:
+            self.file.close()
+        elif exc_type is None:
+            write_json(self.path, self.scores)
+
+    def add(self, pt_id: str, record: dict) -> None:
+        if self.file is not None:
+            self.file.write(json.dumps({"pt_id": pt_id, **record}) + "\n")
+            self.file.flush()
+        elif self.multiclass:
+            self.scores[pt_id] = self.scores.get(pt_id, []) + [record]
+        else:
+            self.scores[pt_id] = record
+
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+class _JSONStream:
+    """
+    Decodes JSON values one at a time from a file that is read in chunks.
+    """
+
+    def __init__(self, file: TextIO, chunk_size: int):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def _read_more(self) -> bool:
+        if self.eof:
+            return False
+
+        # Read at least as much as is still buffered, so values that span many chunks
+        # are decoded a logarithmic number of times instead of once per chunk
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer) - self.position))
+        if chunk == "":
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Returns the next non-whitespace character, or an empty string at the end of the file.
+        """
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_more():
+                return ""
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if character == "" or character not in characters:
+            raise json.JSONDecodeError(f"Expecting one of {characters!r}", self.buffer, self.position)
+        self.position += 1
+        return character
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A value that ends at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read_more()
+
+
+def iter_json_object(path: Path, chunk_size: int = 1 << 20) -> Iterator[tuple[str, Any]]:
+    """
+    Yields the members of the top-level JSON object in path one at a time,
+    so only a single value is ever decoded into memory, instead of the whole file.
+    """
+    with open(path, mode="r") as file:
+        stream = _JSONStream(file, chunk_size)
+
+        stream.expect("{")
+        if stream.peek() == "}":
+            stream.expect("}")
+        else:
+            while True:
+                key = stream.value()
+                if not isinstance(key, str):
+                    raise json.JSONDecodeError("Expecting a string key", stream.buffer, stream.position)
+                stream.expect(":")
+                yield key, stream.value()
+
+                if stream.expect(",}") == "}":
+                    break
+
+        # Like json.load, nothing but whitespace may follow the object
+        if stream.peek() != "":
+            raise json.JSONDecodeError("Extra data", stream.buffer, stream.position)
+
+
+def iter_scores(path: Path) -> Iterator[tuple[str, Any]]:
+    """
+    Yields (patient, scores) pairs from either a JSON or a JSON Lines (.jsonl) scores file.
+    For multi-class scores, the consecutive per-class records of a patient are grouped into
+    a list, the same as in the JSON format.
+    """
+    if Path(path).suffix != ".jsonl":
+        yield from iter_json_object(path)
+        return
+
+    with open(path, mode="r") as file:
+        pt_id = None
+        classes = []
+        for line in file:
+            if line.strip() == "":
+                continue
+
+            record = json.loads(line)
+            key = record.pop("pt_id")
+            if "class" not in record:
+                yield key, record
+                continue
+
+            if key != pt_id and len(classes) > 0:
+                yield pt_id, classes
+                classes = []
+            pt_id = key
+            classes.append(record)
+
+        if len(classes) > 0:
+            yield pt_id, classes
+
+
+def read_scores(path: Path) -> dict[str, Any]:
+    """
+    Reads a whole JSON or JSON Lines scores file into a dict, as it would be in the JSON format.
+    """
+    return dict(iter_scores(path))
+
+
+def write_scores(path: Path, scores: dict[str, Any], compact: bool = False) -> None:
+    """
+    Writes scores in the format of the extension of path, as the reverse of read_scores.
+    """
+    path = Path(path)
+    if path.suffix != ".jsonl":
+        write_json(path, scores, compact=compact)
+        return
+
+    temp_path = path.with_name(f".tmp-{os.getpid()}-{path.name}")
+    try:
+        with open(temp_path, mode="w") as file:
+            for pt_id, records in scores.items():
+                # Multi-class scores have a record per class
+                for record in records if isinstance(records, list) else [records]:
+                    file.write(json.dumps({"pt_id": pt_id, **record}) + "\n")
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def center_name(pt_id: str) -> str:
+    # Patients are named after their center, which are anonymized in the article
+    center = pt_id.split(" ")[0]
+    if center == "UMCU":
+        center = "Center A"
+    elif center == "USZ":
+        center = "Center B"
+    return center
+
+
+def read_json(files: list[Path]) -> "pd.DataFrame":
+    import pandas as pd
+
     transformed_dict = {
         "metric": [],
         "metric_name": [],
@@ -16,43 +263,71 @@ def read_json(files: list[Path]) -> pd.DataFrame:
         "pt_id": [],
     }
     for file in files:
-        with open(file, mode="r") as f:
-            d: dict = json.load(f)
-
-        for k in d.keys():
-            for metric in d[k].keys():
+        for k, scores in iter_scores(file):
+            for metric in scores.keys():
                 # Manual skip
                 if metric == "volume" or metric == "segment_volume" or metric == "time":
                     continue
 
-                center = k.split(" ")[0]
-                if center == "UMCU":
-                    center = "Center A"
-                elif center == "USZ":
-                    center = "Center B"
+                center = center_name(k)
 
-                transformed_dict["metric"].append(d[k][metric])
+                transformed_dict["metric"].append(scores[metric])
                 transformed_dict["metric_name"].append(metric)
                 transformed_dict["center"].append("All")
                 transformed_dict["anatomy"].append(file.parent.stem.capitalize())
-                transformed_dict["segment_volume"].append(d[k]["segment_volume"])
-                transformed_dict["image_volume"].append(d[k]["volume"])
-                if "time" in d[k].keys():
-                    transformed_dict["time"].append(d[k]["time"])
+                transformed_dict["segment_volume"].append(scores["segment_volume"])
+                transformed_dict["image_volume"].append(scores["volume"])
+                if "time" in scores.keys():
+                    transformed_dict["time"].append(scores["time"])
                 else:
                     transformed_dict["time"].append(None)
                 transformed_dict["pt_id"].append(k)
 
-                transformed_dict["metric"].append(d[k][metric])
+                transformed_dict["metric"].append(scores[metric])
                 transformed_dict["metric_name"].append(metric)
                 transformed_dict["center"].append(center)
                 transformed_dict["anatomy"].append(file.parent.stem.capitalize())
-                transformed_dict["segment_volume"].append(d[k]["segment_volume"])
-                transformed_dict["image_volume"].append(d[k]["volume"])
-                if "time" in d[k].keys():
-                    transformed_dict["time"].append(d[k]["time"])
+                transformed_dict["segment_volume"].append(scores["segment_volume"])
+                transformed_dict["image_volume"].append(scores["volume"])
+                if "time" in scores.keys():
+                    transformed_dict["time"].append(scores["time"])
                 else:
                     transformed_dict["time"].append(None)
                 transformed_dict["pt_id"].append(k)
 
     return pd.DataFrame(transformed_dict)
+
+
+def read_score_times(files: list[Path]) -> "pd.DataFrame":
+    """
+    Reads only the prediction times from scores files, one row per patient and anatomy,
+    instead of repeating them for every metric and center like read_json.
+    """
+    import pandas as pd
+
+    records = [
+        {"pt_id": k, "anatomy": file.parent.stem.capitalize(), "time": scores.get("time")}
+        for file in files
+        for k, scores in iter_scores(file)
+    ]
+    return pd.DataFrame(records, columns=["pt_id", "anatomy", "time"])
+
+
+def read_timings(files: list[Path]) -> "pd.DataFrame":
+    """
+    Reads timing tables written by collect_timings, one row per patient and anatomy.
+    """
+    import pandas as pd
+
+    frames = []
+    for file in files:
+        with open(file, mode="r") as f:
+            d: dict = json.load(f)
+
+        frame = pd.DataFrame.from_dict(d, orient="index")
+        frame = frame.rename(columns={"mean": "time", "std": "time_std", "min": "time_min"})
+        frame["anatomy"] = file.parent.stem.capitalize()
+        frame["pt_id"] = frame.index
+        frames.append(frame.reset_index(drop=True))
+
+    return pd.concat(frames, ignore_index=True)
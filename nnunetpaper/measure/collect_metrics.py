@@ -1,26 +1,291 @@
-import json
-from math import prod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from math import ceil, prod
 from pathlib import Path
+from typing import Callable
 
 import click
 import numpy as np
-import SimpleITK as sitk
-from monai.metrics import (
-    DiceMetric,
-    HausdorffDistanceMetric,
-    MeanIoU,
-    SurfaceDistanceMetric,
-)
-from torch import Tensor, tensor
 from tqdm import tqdm
 
+from nnunetpaper.data.audit_dataset import read_geometry, same_geometry
+from nnunetpaper.data.utils import SCORE_FORMATS, ScoresWriter, scores_output
+from nnunetpaper.measure.metrics import (
+    BACKENDS,
+    BOUNDARY_WIDTH,
+    NSD_TOLERANCES,
+    Reference,
+    array_spacing,
+    boundary_band,
+    compute_metrics,
+    edges,
+    iou_from_counts,
+    metrics_from_distances,
+    overlap_counts,
+    surface_point_distances,
+)
+from nnunetpaper.measure.rle import RLEMask
+from nnunetpaper.measure.shards import SHARD, in_shard
+from nnunetpaper.measure.volume_cache import VolumeCache, default_cache_dir, read_volume
+from nnunetpaper.process.slabs import SlabReader
+
+
+def _read_reference(ref: Path, check_class: int, cache: VolumeCache | None) -> Reference:
+    try:
+        ref_image, _ = cache.read(ref) if cache is not None else read_volume(ref)
+    except RuntimeError as e:
+        raise RuntimeError(f"Refs error: {ref}") from e
+
+    if cache is None:
+        return Reference(ref_image == check_class)
+
+    def store(name: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        return cache.derived(ref, f"class-{check_class}-{name}", compute)
+
+    return Reference(ref_image == check_class, store=store)
+
+
+def _collect_dense(
+    pred: Path,
+    reference: Reference,
+    check_class: int,
+    backend: str,
+    sparse_threshold: float,
+    tolerances: tuple[float, ...],
+    boundary_width: float,
+) -> dict[str, float]:
+    import SimpleITK as sitk
+
+    try:
+        pred_image: sitk.Image = sitk.ReadImage(pred)
+        pred_size = pred_image.GetSize()
+        pred_spacing = array_spacing(pred_image)
+        # Only keep the mask for the class we're checking, 1 byte per voxel
+        pred_image: np.ndarray = sitk.GetArrayViewFromImage(pred_image) == check_class
+    except RuntimeError as e:
+        raise RuntimeError(f"Read error: {pred}") from e
+    if pred_image.shape != reference.mask.shape:
+        raise RuntimeError(f"Shape mismatch: {pred}")
+
+    current_metrics = {
+        "dice": None,
+        "iou": None,
+        "hd95": None,
+        "assd": None,
+        "volume": (prod(pred_size) * prod(pred_spacing))
+        / 1_000_000,  # Image volume in liters
+        "segment_volume": reference.count * prod(pred_spacing),
+    }
+
+    current_metrics.update(
+        compute_metrics(
+            pred_image,
+            reference,
+            spacing=pred_spacing,
+            backend=backend,
+            sparse_threshold=sparse_threshold,
+            tolerances=tolerances,
+            boundary_width=boundary_width,
+        )
+    )
+    return current_metrics
+
+
+def _collect_slabs(
+    pred: Path,
+    ref: Path,
+    check_class: int,
+    slab_size: int,
+    tolerances: tuple[float, ...],
+    boundary_width: float,
+) -> dict[str, float]:
+    try:
+        pred_reader = SlabReader(pred)
+    except RuntimeError as e:
+        raise RuntimeError(f"Read error: {pred}") from e
+    try:
+        ref_reader = SlabReader(ref)
+    except RuntimeError as e:
+        raise RuntimeError(f"Refs error: {pred}") from e
+    if pred_reader.shape != ref_reader.shape:
+        raise RuntimeError(f"Shape mismatch: {pred}")
+
+    # Overlaps are counted per slab. For the distances, only the surface voxels are kept,
+    # one slice of halo is enough to find those at the slab boundaries. The boundary bands
+    # need enough halo to find all background within the boundary width
+    spacing = pred_reader.spacing
+    halo = max(1, ceil(boundary_width / spacing[0]))
+    # Thin slices need more halo than a small slab holds, so the slab grows to the halo
+    slab_size = max(slab_size, halo)
+    n_slices = pred_reader.shape[0]
+
+    counts = np.zeros(3, dtype=np.int64)
+    band_counts = np.zeros(3, dtype=np.int64)
+    pred_surfaces = []
+    ref_surfaces = []
+    for pred_slab, ref_slab in zip(
+        pred_reader.iter_slabs(slab_size, halo=halo), ref_reader.iter_slabs(slab_size, halo=halo)
+    ):
+        pred_mask = pred_slab.data == check_class
+        ref_mask = ref_slab.data == check_class
+        core = slice(pred_slab.halo_before, pred_slab.halo_before + pred_slab.stop - pred_slab.start)
+
+        counts += overlap_counts(pred_mask[core], ref_mask[core])
+        pred_surfaces.append(RLEMask.from_array(edges(pred_mask)[core]))
+        ref_surfaces.append(RLEMask.from_array(edges(ref_mask)[core]))
+
+        # Only the first and last slab end at the border of the image
+        pad_width = [(int(pred_slab.start == 0), int(pred_slab.stop == n_slices)), (1, 1), (1, 1)]
+        band_counts += overlap_counts(
+            boundary_band(pred_mask, boundary_width, spacing, pad_width)[core],
+            boundary_band(ref_mask, boundary_width, spacing, pad_width)[core],
+        )
+
+    pred_to_ref, ref_to_pred = surface_point_distances(
+        RLEMask.concatenate(pred_surfaces), RLEMask.concatenate(ref_surfaces), spacing
+    )
+
+    current_metrics = {
+        "dice": None,
+        "iou": None,
+        "hd95": None,
+        "assd": None,
+        "volume": (prod(pred_reader.shape) * prod(spacing)) / 1_000_000,
+        "segment_volume": int(counts[1]) * prod(spacing),
+    }
+    current_metrics.update(
+        metrics_from_distances(tuple(int(x) for x in counts), pred_to_ref, ref_to_pred, tolerances)
+    )
+    current_metrics["biou"] = iou_from_counts(*(int(x) for x in band_counts))
+    return current_metrics
+
+
+def case_collector(
+    ref: Path,
+    check_class: int,
+    cache: VolumeCache | None,
+    slab_size: int | None,
+    backend: str,
+    sparse_threshold: float,
+    tolerances: tuple[float, ...],
+    boundary_width: float,
+) -> Callable[[Path], dict[str, float]]:
+    """
+    Returns a function that scores a prediction against ref, which is only read once
+    for all sets of predictions (unless it is streamed in slabs).
+    """
+    if slab_size is not None:
+        return partial(
+            _collect_slabs,
+            ref=ref,
+            check_class=check_class,
+            slab_size=slab_size,
+            tolerances=tolerances,
+            boundary_width=boundary_width,
+        )
+
+    return partial(
+        _collect_dense,
+        reference=_read_reference(ref, check_class, cache),
+        check_class=check_class,
+        backend=backend,
+        sparse_threshold=sparse_threshold,
+        tolerances=tolerances,
+        boundary_width=boundary_width,
+    )
+
+
+def _pair_problem(pred: Path, ref: Path, geometries: dict[Path, dict | None]) -> str | None:
+    if not ref.is_file():
+        return f"Missing ref: {ref}"
+    if geometries[ref] is None:
+        return f"Refs error: {ref}"
+    if geometries[pred] is None:
+        return f"Read error: {pred}"
+    if geometries[pred]["size"] != geometries[ref]["size"]:
+        return f"Shape mismatch: {pred}"
+    if not same_geometry(geometries[pred], geometries[ref]):
+        return f"Geometry mismatch: {pred}"
+    return None
+
+
+def preflight(refs: Path, preds: list[Path], names: list[str], workers: int = 16) -> dict[tuple[Path, str], str]:
+    """
+    Reads only the headers of all predictions and their references, and returns the problem of
+    every prediction that cannot be scored, keyed by its directory and name: a missing reference,
+    an unreadable file, or a size, spacing, origin or direction that differs from the reference.
+    """
+    pairs = [(pred_dir, name) for name in names for pred_dir in preds if (pred_dir / name).is_file()]
+    files = {pred_dir / name for pred_dir, name in pairs} | {refs / name for name in names if (refs / name).is_file()}
+
+    geometries = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {x: executor.submit(read_geometry, x) for x in files}
+        for path, future in futures.items():
+            try:
+                geometries[path] = future.result()
+            except RuntimeError:
+                geometries[path] = None
+
+    problems = {}
+    for pred_dir, name in pairs:
+        problem = _pair_problem(pred_dir / name, refs / name, geometries)
+        if problem is not None:
+            problems[(pred_dir, name)] = problem
+    return problems
+
+
+def _preflight(
+    refs: Path, preds: list[Path], names: list[str], workers: int, strict: bool
+) -> dict[tuple[Path, str], str]:
+    problems = preflight(refs, preds, names, workers)
+    if len(problems) > 0:
+        print(f"Pre-flight found {len(problems)} predictions that cannot be scored:")
+        for problem in problems.values():
+            print(f"\t- {problem}")
+    if strict and len(problems) > 0:
+        raise click.ClickException("The pre-flight found problems, see above")
+    return problems
+
+
+def _check_options(backend: str, slab_size: int | None, cache_dir: Path | None) -> None:
+    if slab_size is not None and backend != "numpy":
+        raise click.UsageError("--slab-size is only supported by the numpy backend")
+    if slab_size is not None and cache_dir is not None:
+        raise click.UsageError("--cache-dir cannot be combined with --slab-size, which streams the references")
+
+
+def _case_names(preds: list[Path], shard: tuple[int, int] | None) -> list[str]:
+    names = sorted({x.name for pred_dir in preds for x in pred_dir.glob("*") if x.is_file()})
+    if shard is not None:
+        names = [x for x in names if in_shard(x, shard)]
+    return names
+
+
+def _outputs(preds: list[Path], output: Path | None, output_format: str | None) -> list[tuple[Path, str]]:
+    if len(preds) == 1:
+        return [scores_output(output, preds[0], output_format)]
+
+    # Every set of predictions gets its own scores, in its own directory
+    if output is not None and output.exists() and not output.is_dir():
+        raise click.UsageError("With multiple --preds, --output has to be a directory")
+    outputs = []
+    for pred_dir in preds:
+        if output is not None:
+            (output / pred_dir.name).mkdir(parents=True, exist_ok=True)
+        outputs.append(scores_output(None if output is None else output / pred_dir.name, pred_dir, output_format))
+    return outputs
+
 
 @click.command()
 @click.option(
     "-p",
     "--preds",
     required=True,
+    multiple=True,
     type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path),
+    help="Can be given multiple times, to score several methods against the same references in one pass",
 )
 @click.option(
     "-r",
@@ -37,80 +302,150 @@ from tqdm import tqdm
     ),
 )
 @click.option("-c", "--class", "check_class", required=False, type=int, default=1)
-def main(preds: Path, refs: Path, output: Path = None, check_class: int = 1):
-    skipped = []
-    metrics = {}
-
-    if output is None:
-        output = preds / "scores.json"
-    elif output.is_dir():
-        output /= "scores.json"
-
-    use_background: bool = False
-    dsc = DiceMetric(include_background=use_background)
-    iou = MeanIoU(include_background=use_background)
-    hd95 = HausdorffDistanceMetric(include_background=use_background, percentile=95)
-    assd = SurfaceDistanceMetric(include_background=use_background, symmetric=True)
-
-    pred: Path
-    for pred in (
-        progress_bar := tqdm(
-            [x.resolve() for x in preds.glob("*") if x.is_file()],
-            desc="Processing patients",
-        )
-    ):
-        progress_bar.set_description(f"Processing {pred.name}")
-
-        try:
-            pred_image: sitk.Image = sitk.ReadImage(pred)
-            pred_size = pred_image.GetSize()
-            pred_spacing = pred_image.GetSpacing()
-            pred_image: np.ndarray = sitk.GetArrayFromImage(pred_image)
-        except RuntimeError:
-            skipped.append(f"Read error: {pred}")
-            continue
-
-        try:
-            ref_image: np.ndarray = sitk.GetArrayFromImage(
-                sitk.ReadImage(refs / pred.name)
-            )
-        except RuntimeError:
-            skipped.append(f"Refs error: {pred}")
-            continue
-
-        pred_image: np.ndarray = np.where(pred_image == check_class, 1, 0)
-        ref_image: np.ndarray = np.where(ref_image == check_class, 1, 0)
-
-        current_metrics = {
-            "dice": None,
-            "iou": None,
-            "hd95": None,
-            "assd": None,
-            "volume": (prod(pred_size) * prod(pred_spacing))
-            / 1_000_000,  # Image volume in liters
-            "segment_volume": np.count_nonzero(ref_image) * prod(pred_spacing),
-        }
-
-        pred_image: Tensor = tensor(pred_image[np.newaxis, np.newaxis, ...])
-        ref_image: Tensor = tensor(ref_image[np.newaxis, np.newaxis, ...])
-
-        progress_bar.set_description(f"Processing {pred.name}: DSC")
-        current_metrics["dice"] = dsc(pred_image, ref_image).item()
-
-        progress_bar.set_description(f"Processing {pred.name}: IOU")
-        current_metrics["iou"] = iou(pred_image, ref_image).item()
-
-        progress_bar.set_description(f"Processing {pred.name}: HD95")
-        current_metrics["hd95"] = hd95(pred_image, ref_image, spacing=pred_spacing).item()
-
-        progress_bar.set_description(f"Processing {pred.name}: ASSD")
-        current_metrics["assd"] = assd(pred_image, ref_image, spacing=pred_spacing).item()
-
-        metrics[pred.name] = current_metrics
-
-    with open(output, mode="w") as file:
-        j = json.dumps(metrics, indent=4)
-        file.write(j)
+@click.option(
+    "-b",
+    "--backend",
+    required=False,
+    type=click.Choice(BACKENDS),
+    default="numpy",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--sparse-threshold",
+    required=False,
+    type=click.FloatRange(0.0, 1.0),
+    default=0.01,
+    show_default=True,
+    help="Run-length encode masks that cover less than this fraction of the image",
+)
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stream NIfTI volumes through in slabs of this many slices, to bound memory use",
+)
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    required=False,
+    type=click.Choice(SCORE_FORMATS),
+    default=None,
+    help="Output format, by default based on the extension of the output file. "
+    "jsonl writes every record as soon as it is computed",
+)
+@click.option(
+    "--shard",
+    required=False,
+    type=SHARD,
+    default=None,
+    help="Only process shard i of N (0-based), see `measure shards`",
+)
+@click.option(
+    "--nsd-tolerance",
+    "tolerances",
+    required=False,
+    multiple=True,
+    type=click.FloatRange(min=0.0),
+    default=NSD_TOLERANCES,
+    show_default=True,
+    help="Tolerance for the normalized surface Dice, can be given multiple times",
+)
+@click.option(
+    "--boundary-width",
+    required=False,
+    type=click.FloatRange(min=0.0),
+    default=BOUNDARY_WIDTH,
+    show_default=True,
+    help="Width of the boundary for the boundary IoU",
+)
+@click.option(
+    "--cache-dir",
+    required=False,
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+    default=None,
+    help=f"Keep decoded references here, so later runs can skip decompressing them (e.g. {default_cache_dir()})",
+)
+@click.option(
+    "--cache-size",
+    required=False,
+    type=click.FloatRange(min=0.0),
+    default=20.0,
+    show_default=True,
+    help="Size limit of the reference cache in GB",
+)
+@click.option(
+    "--preflight/--no-preflight",
+    default=True,
+    show_default=True,
+    help="Check the headers of all predictions and references before reading any voxels",
+)
+@click.option("--strict", is_flag=True, default=False, help="Stop if the pre-flight finds any problem")
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of headers read concurrently in the pre-flight",
+)
+def main(
+    preds: list[Path],
+    refs: Path,
+    output: Path = None,
+    check_class: int = 1,
+    backend: str = "numpy",
+    sparse_threshold: float = 0.01,
+    slab_size: int | None = None,
+    output_format: str | None = None,
+    shard: tuple[int, int] | None = None,
+    tolerances: tuple[float, ...] = NSD_TOLERANCES,
+    boundary_width: float = BOUNDARY_WIDTH,
+    cache_dir: Path | None = None,
+    cache_size: float = 20.0,
+    preflight: bool = True,
+    strict: bool = False,
+    workers: int = 16,
+):
+    _check_options(backend, slab_size, cache_dir)
+
+    cache = VolumeCache(cache_dir, int(cache_size * 1e9)) if cache_dir is not None else None
+    names = _case_names(preds, shard)
+
+    problems = _preflight(refs, preds, names, workers, strict) if preflight else {}
+    skipped = list(problems.values())
+
+    with ExitStack() as stack:
+        writers = [stack.enter_context(ScoresWriter(*x)) for x in _outputs(preds, output, output_format)]
+
+        for name in (progress_bar := tqdm(names, desc="Processing patients")):
+            progress_bar.set_description(f"Processing {name}")
+            pending = [
+                (pred_dir, writer)
+                for pred_dir, writer in zip(preds, writers)
+                if (pred_dir / name).is_file() and (pred_dir, name) not in problems
+            ]
+            if len(pending) == 0:
+                continue
+
+            try:
+                collect = case_collector(
+                    refs / name, check_class, cache, slab_size, backend, sparse_threshold, tolerances, boundary_width
+                )
+            except RuntimeError as e:
+                skipped.append(str(e))
+                continue
+
+            for pred_dir, writer in pending:
+                try:
+                    writer.add(name, collect((pred_dir / name).resolve()))
+                except RuntimeError as e:
+                    skipped.append(str(e))
+                except ValueError as e:
+                    skipped.append(f"{pred_dir / name}: {e}")
 
     print("Skipped:")
     for s in skipped:
@@ -1,19 +1,34 @@
-import json
 from math import prod
 from pathlib import Path
 
 import click
 import numpy as np
-import SimpleITK as sitk
-from monai.metrics import (
-    DiceMetric,
-    HausdorffDistanceMetric,
-    MeanIoU,
-    SurfaceDistanceMetric,
-)
-from torch import Tensor, tensor
 from tqdm import tqdm
 
+from nnunetpaper.data.utils import SCORE_FORMATS, ScoresWriter, scores_output
+from nnunetpaper.measure.metrics import (
+    BACKENDS,
+    BOUNDARY_WIDTH,
+    NSD_TOLERANCES,
+    array_spacing,
+    compute_metrics,
+    nsd_name,
+)
+from nnunetpaper.measure.shards import SHARD, select_shard
+
+
+def _empty_mask_metrics(both_empty: bool, tolerances: tuple[float, ...], backend: str) -> dict[str, float]:
+    # Both masks empty is a perfect score, only one of them empty the worst possible one
+    score = 1.0 if both_empty else 0.0
+    distance = 0.0 if both_empty else np.inf
+
+    metrics = {"dice": score, "iou": score, "hd95": distance, "assd": distance}
+    metrics.update({nsd_name(x): score for x in tolerances})
+    # The same metrics as compute_metrics, which only reports the boundary IoU with numpy
+    if backend == "numpy":
+        metrics["biou"] = score
+    return metrics
+
 
 @click.command()
 @click.option(
@@ -37,114 +52,150 @@ from tqdm import tqdm
     ),
 )
 @click.option("-c", "--n-classes", required=False, type=int, default=None)
-def main(preds: Path, refs: Path, output: Path | None = None, n_classes: int | None = None):
-    skipped = []
-    metrics = {}
-
-    if output is None:
-        output = preds / "scores.json"
-    elif output.is_dir():
-        output /= "scores.json"
+@click.option(
+    "-b",
+    "--backend",
+    required=False,
+    type=click.Choice(BACKENDS),
+    default="numpy",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--sparse-threshold",
+    required=False,
+    type=click.FloatRange(0.0, 1.0),
+    default=0.01,
+    show_default=True,
+    help="Run-length encode masks that cover less than this fraction of the image",
+)
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    required=False,
+    type=click.Choice(SCORE_FORMATS),
+    default=None,
+    help="Output format, by default based on the extension of the output file. "
+    "jsonl writes every record as soon as it is computed",
+)
+@click.option(
+    "--shard",
+    required=False,
+    type=SHARD,
+    default=None,
+    help="Only process shard i of N (0-based), see `measure shards`",
+)
+@click.option(
+    "--nsd-tolerance",
+    "tolerances",
+    required=False,
+    multiple=True,
+    type=click.FloatRange(min=0.0),
+    default=NSD_TOLERANCES,
+    show_default=True,
+    help="Tolerance for the normalized surface Dice, can be given multiple times",
+)
+@click.option(
+    "--boundary-width",
+    required=False,
+    type=click.FloatRange(min=0.0),
+    default=BOUNDARY_WIDTH,
+    show_default=True,
+    help="Width of the boundary for the boundary IoU",
+)
+def main(
+    preds: Path,
+    refs: Path,
+    output: Path | None = None,
+    n_classes: int | None = None,
+    backend: str = "numpy",
+    sparse_threshold: float = 0.01,
+    output_format: str | None = None,
+    shard: tuple[int, int] | None = None,
+    tolerances: tuple[float, ...] = NSD_TOLERANCES,
+    boundary_width: float = BOUNDARY_WIDTH,
+):
+    import SimpleITK as sitk
 
-    use_background: bool = False
-    dsc = DiceMetric(include_background=use_background)
-    iou = MeanIoU(include_background=use_background)
-    hd95 = HausdorffDistanceMetric(include_background=use_background, percentile=95)
-    assd = SurfaceDistanceMetric(include_background=use_background, symmetric=True)
+    skipped = []
+    output, output_format = scores_output(output, preds, output_format)
 
     pred: Path
-    for pred in (
-        progress_bar := tqdm(
-            [x.resolve() for x in preds.glob("*") if x.is_file()],
-            desc="Processing patients",
-            position=0,
-        )
-    ):
-        progress_bar.set_description(f"Processing {pred.name}")
-
-        try:
-            pred_image: sitk.Image = sitk.ReadImage(pred)
-            pred_size = pred_image.GetSize()
-            pred_spacing = pred_image.GetSpacing()
-            pred_image: np.ndarray = sitk.GetArrayFromImage(pred_image)
-        except RuntimeError:
-            skipped.append(f"Read error: {pred}")
-            continue
-
-        try:
-            ref_image: np.ndarray = sitk.GetArrayFromImage(
-                sitk.ReadImage(refs / pred.name)
-            )
-        except RuntimeError:
-            skipped.append(f"Refs error: {pred}")
-            continue
-
-        if n_classes is None:
-            current_n_classes = np.max(pred_image)
-        else:
-            current_n_classes = n_classes
-
-        for check_class in (
-            sub_bar := tqdm(
-                range(1, current_n_classes + 1),
-                desc="Processing classes",
-                leave=False,
-                position=1,
+    with ScoresWriter(output, output_format, multiclass=True) as writer:
+        for pred in (
+            progress_bar := tqdm(
+                select_shard(sorted(x.resolve() for x in preds.glob("*") if x.is_file()), shard),
+                desc="Processing patients",
+                position=0,
             )
         ):
-            sub_bar.set_description(f"Class {check_class}/{current_n_classes}")
-            class_image: np.ndarray = np.where(pred_image == check_class, 1, 0)
-            class_ref: np.ndarray = np.where(ref_image == check_class, 1, 0)
-
-            current_metrics = {
-                "dice": None,
-                "iou": None,
-                "hd95": None,
-                "assd": None,
-                "class": check_class,
-                "volume": (prod(pred_size) * prod(pred_spacing)),
-                "segment_volume": np.count_nonzero(class_ref) * prod(pred_spacing),
-            }
-
-            # Edge cases: empty prediction and/or empty reference
-            if np.count_nonzero(class_image) == 0:
-                if np.count_nonzero(class_ref) == 0:
-                    current_metrics["dice"] = 1.0
-                    current_metrics["iou"] = 1.0
-                    current_metrics["hd95"] = 0.0
-                    current_metrics["assd"] = 0.0
-                else:
-                    current_metrics["dice"] = 0.0
-                    current_metrics["iou"] = 0.0
-                    current_metrics["hd95"] = np.inf
-                    current_metrics["assd"] = np.inf
+            progress_bar.set_description(f"Processing {pred.name}")
+
+            try:
+                pred_sitk: sitk.Image = sitk.ReadImage(pred)
+                pred_size = pred_sitk.GetSize()
+                pred_spacing = array_spacing(pred_sitk)
+                # Views keep the labels in the (usually uint8) buffer SimpleITK decoded them into
+                pred_image: np.ndarray = sitk.GetArrayViewFromImage(pred_sitk)
+            except RuntimeError:
+                skipped.append(f"Read error: {pred}")
+                continue
+
+            try:
+                ref_sitk: sitk.Image = sitk.ReadImage(refs / pred.name)
+                ref_image: np.ndarray = sitk.GetArrayViewFromImage(ref_sitk)
+            except RuntimeError:
+                skipped.append(f"Refs error: {pred}")
+                continue
+
+            if n_classes is None:
+                current_n_classes = np.max(pred_image)
             else:
-                if np.count_nonzero(class_ref) == 0:
-                    current_metrics["dice"] = 0.0
-                    current_metrics["iou"] = 0.0
-                    current_metrics["hd95"] = np.inf
-                    current_metrics["assd"] = np.inf
+                current_n_classes = n_classes
+
+            for check_class in (
+                sub_bar := tqdm(
+                    range(1, current_n_classes + 1),
+                    desc="Processing classes",
+                    leave=False,
+                    position=1,
+                )
+            ):
+                sub_bar.set_description(f"Class {check_class}/{current_n_classes}")
+                class_image: np.ndarray = pred_image == check_class
+                class_ref: np.ndarray = ref_image == check_class
+                image_count = np.count_nonzero(class_image)
+                ref_count = np.count_nonzero(class_ref)
+
+                current_metrics = {
+                    "dice": None,
+                    "iou": None,
+                    "hd95": None,
+                    "assd": None,
+                    "class": check_class,
+                    "volume": (prod(pred_size) * prod(pred_spacing)),
+                    "segment_volume": ref_count * prod(pred_spacing),
+                }
+
+                # Edge cases: empty prediction and/or empty reference
+                if image_count == 0 or ref_count == 0:
+                    current_metrics.update(_empty_mask_metrics(image_count == ref_count, tolerances, backend))
                 else:
-                    class_image: Tensor = tensor(class_image[np.newaxis, np.newaxis, ...])
-                    class_ref: Tensor = tensor(class_ref[np.newaxis, np.newaxis, ...])
-
-                    sub_bar.set_description(f"Class {check_class}/{current_n_classes}: DSC")
-                    current_metrics["dice"] = dsc(class_image, class_ref).item()
-
-                    sub_bar.set_description(f"Class {check_class}/{current_n_classes}: IOU")
-                    current_metrics["iou"] = iou(class_image, class_ref).item()
-
-                    sub_bar.set_description(f"Class {check_class}/{current_n_classes}: HD95")
-                    current_metrics["hd95"] = hd95(class_image, class_ref).item()
-
-                    sub_bar.set_description(f"Class {check_class}/{current_n_classes}: ASSD")
-                    current_metrics["assd"] = assd(class_image, class_ref).item()
-
-            metrics[pred.name] = metrics.get(pred.name, []) + [current_metrics]
-
-    with open(output, mode="w") as file:
-        j = json.dumps(metrics, indent=4)
-        file.write(j)
+                    sub_bar.set_description(f"Class {check_class}/{current_n_classes}: metrics ({backend})")
+                    current_metrics.update(
+                        compute_metrics(
+                            class_image,
+                            class_ref,
+                            spacing=pred_spacing,
+                            backend=backend,
+                            sparse_threshold=sparse_threshold,
+                            tolerances=tolerances,
+                            boundary_width=boundary_width,
+                        )
+                    )
+
+                writer.add(pred.name, current_metrics)
 
     print("Skipped:")
     for s in skipped:
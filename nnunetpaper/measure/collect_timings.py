@@ -1,9 +1,68 @@
-import json
+"""
+Collects the prediction times of all runs into a timing table, and merges the mean
+time per patient into the scores.
+
+Prediction times are stored as `patient/run/model/prediction_time.txt`, with any
+number of runs. The table is keyed the same way as the scores, and holds the mean,
+standard deviation, minimum and the times of the individual runs.
+"""
+import os
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
 from tqdm import tqdm
 
+from nnunetpaper.data.utils import read_scores, write_json, write_scores
+
+
+def _find_patients(directory: Path, patient_ids) -> dict[str, Path]:
+    subdirs = {}
+    for entry in os.scandir(directory):
+        patient_id = entry.name.split("_")[0] + ".nii.gz"
+        if entry.is_dir() and patient_id in patient_ids:
+            subdirs[patient_id] = Path(entry.path).resolve()
+    return subdirs
+
+
+def _read_runs(subdir: Path, model: int) -> list[float]:
+    # Runs are numbered directories, read in run order
+    runs = sorted((x for x in os.scandir(subdir) if x.is_dir() and x.name.isdigit()), key=lambda x: int(x.name))
+
+    times = []
+    for run in runs:
+        try:
+            with open(Path(run.path) / f"{model}" / "prediction_time.txt", "r") as f:
+                times.append(float(f.read()))
+        except FileNotFoundError:
+            continue
+    return times
+
+
+def _timing_entry(times: list[float]) -> dict[str, float | list[float]]:
+    return {
+        "mean": statistics.fmean(times),
+        "std": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "min": min(times),
+        "runs": times,
+    }
+
+
+def _print_incomplete(timings: dict[str, dict], missing: list[str]) -> None:
+    if len(missing) > 0:
+        print("No prediction times found for:")
+        for patient_id in sorted(missing):
+            print(f"\t- {patient_id}")
+
+    # Runs without a prediction time are left out, so patients with fewer runs than most are less precise
+    n_runs = max(statistics.multimode(len(x["runs"]) for x in timings.values()), default=0)
+    incomplete = {x: len(y["runs"]) for x, y in timings.items() if len(y["runs"]) < n_runs}
+    if len(incomplete) > 0:
+        print(f"Fewer than {n_runs} runs found for:")
+        for patient_id, count in sorted(incomplete.items()):
+            print(f"\t- {patient_id}: {count}")
+
 
 @click.command()
 @click.option(
@@ -35,34 +94,59 @@ from tqdm import tqdm
     ),
     default=None,
 )
-def main(directory: Path, scores: Path, model: int, output: Path = None):
+@click.option(
+    "-t",
+    "--table",
+    required=False,
+    type=click.Path(exists=False, dir_okay=False, writable=True, path_type=Path),
+    default=None,
+    help="Where to write the timing table, defaults to timings.json next to the output",
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of concurrent reads, mostly useful on network storage",
+)
+def main(
+    directory: Path,
+    scores: Path,
+    model: int,
+    output: Path = None,
+    table: Path = None,
+    workers: int = 16,
+):
     if output is None:
         output = scores
     elif output.is_dir():
-        output /= "scores.json"
+        output /= "scores.jsonl" if scores.suffix == ".jsonl" else "scores.json"
 
-    with open(scores, "r") as f:
-        scores = json.load(f)
+    if table is None:
+        table = output.parent / "timings.json"
 
-    subdirs = [x.resolve() for x in directory.iterdir() if x.is_dir()]
-    for subdir in (prog_bar := tqdm(subdirs, desc="Processing patients")):
-        patient_id = subdir.name.split("_")[0] + ".nii.gz"
-        prog_bar.set_description(f"Processing {patient_id}")
-
-        if patient_id not in scores.keys():
-            continue
+    scores = read_scores(scores)
 
-        time = 0
-        for run in range(1, 4):
-            with open(subdir / f"{run}" / f"{model}" / "prediction_time.txt", "r") as f:
-                time += float(f.read())
-        time /= 3
+    subdirs = _find_patients(directory, scores.keys())
+    timings = {}
+    missing = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda x: _read_runs(x, model), subdirs.values())
+        for patient_id, times in tqdm(zip(subdirs.keys(), results), total=len(subdirs), desc="Reading times"):
+            if len(times) == 0:
+                missing.append(patient_id)
+                continue
+            timings[patient_id] = _timing_entry(times)
 
-        scores[patient_id]["time"] = time
+    for patient_id, entry in timings.items():
+        scores[patient_id]["time"] = entry["mean"]
 
-    with open(output, mode="w") as file:
-        j = json.dumps(scores, indent=4)
-        file.write(j)
+    write_json(table, dict(sorted(timings.items())))
+    # In the same format as the output name, which defaults to that of the scores
+    write_scores(output, scores)
+    _print_incomplete(timings, missing)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+"""
+Scores several methods against the same references in one pass.
+
+Every reference is read once per case, after which all methods are scored against it,
+and cases are spread over worker processes. The output is the same long-format table
+that `convert scores-csv` makes from the separate scores files, with one row per
+patient, anatomy, method and center.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import click
+import pandas as pd
+from tqdm import tqdm
+
+from nnunetpaper.data.utils import center_name
+from nnunetpaper.measure.collect_metrics import case_collector
+from nnunetpaper.measure.metrics import BACKENDS, BOUNDARY_WIDTH, NSD_TOLERANCES
+from nnunetpaper.measure.volume_cache import VolumeCache, default_cache_dir
+
+# Same as read_json, which skips everything that is not a metric
+_NOT_METRICS = ["volume", "segment_volume", "time"]
+
+
+def _score_case(
+    name: str,
+    refs: Path,
+    methods: list[tuple[str, Path]],
+    check_class: int,
+    cache: VolumeCache | None,
+    backend: str,
+    sparse_threshold: float,
+    tolerances: tuple[float, ...],
+    boundary_width: float,
+) -> tuple[list[tuple[str, str, Path, dict[str, float]]], list[str]]:
+    try:
+        collect = case_collector(
+            refs / name,
+            check_class,
+            cache,
+            slab_size=None,
+            backend=backend,
+            sparse_threshold=sparse_threshold,
+            tolerances=tolerances,
+            boundary_width=boundary_width,
+        )
+    except RuntimeError as e:
+        return [], [str(e)]
+
+    scores = []
+    skipped = []
+    for method, pred_dir in methods:
+        if not (pred_dir / name).is_file():
+            continue
+        try:
+            scores.append((name, method, pred_dir, collect((pred_dir / name).resolve())))
+        except RuntimeError as e:
+            skipped.append(str(e))
+    return scores, skipped
+
+
+def _long_table(rows: list[dict]) -> pd.DataFrame:
+    # The same layout as the pivot table of scores_to_csv
+    index = ["pt_id", "anatomy", "methods", "center"]
+    data = pd.DataFrame(rows).set_index(index).sort_index()
+    data = data[sorted(data.columns)]
+    data.columns.name = "metric_name"
+    return data
+
+
+@click.command()
+@click.option(
+    "-m",
+    "--method",
+    "methods",
+    required=True,
+    multiple=True,
+    type=click.Tuple([str, click.Path(exists=True, file_okay=False, readable=True, path_type=Path)]),
+    help="Name and predictions of a method, can be given multiple times",
+)
+@click.option(
+    "-r",
+    "--refs",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path),
+)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    type=click.Path(exists=False, file_okay=True, dir_okay=True, writable=True, path_type=Path),
+)
+@click.option(
+    "-a",
+    "--anatomy",
+    required=False,
+    type=str,
+    default=None,
+    help="Defaults to the name of the predictions directory of every method",
+)
+@click.option("-c", "--class", "check_class", required=False, type=int, default=1)
+@click.option(
+    "-b",
+    "--backend",
+    required=False,
+    type=click.Choice(BACKENDS),
+    default="numpy",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--sparse-threshold",
+    required=False,
+    type=click.FloatRange(0.0, 1.0),
+    default=0.01,
+    show_default=True,
+    help="Run-length encode masks that cover less than this fraction of the image",
+)
+@click.option(
+    "--nsd-tolerance",
+    "tolerances",
+    required=False,
+    multiple=True,
+    type=click.FloatRange(min=0.0),
+    default=NSD_TOLERANCES,
+    show_default=True,
+    help="Tolerance for the normalized surface Dice, can be given multiple times",
+)
+@click.option(
+    "--boundary-width",
+    required=False,
+    type=click.FloatRange(min=0.0),
+    default=BOUNDARY_WIDTH,
+    show_default=True,
+    help="Width of the boundary for the boundary IoU",
+)
+@click.option(
+    "--cache-dir",
+    required=False,
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+    default=None,
+    help=f"Keep decoded references here, so later runs can skip decompressing them (e.g. {default_cache_dir()})",
+)
+@click.option(
+    "--cache-size",
+    required=False,
+    type=click.FloatRange(min=0.0),
+    default=20.0,
+    show_default=True,
+    help="Size limit of the reference cache in GB",
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of cases scored in parallel",
+)
+def main(
+    methods: list[tuple[str, Path]],
+    refs: Path,
+    output: Path,
+    anatomy: str | None = None,
+    check_class: int = 1,
+    backend: str = "numpy",
+    sparse_threshold: float = 0.01,
+    tolerances: tuple[float, ...] = NSD_TOLERANCES,
+    boundary_width: float = BOUNDARY_WIDTH,
+    cache_dir: Path | None = None,
+    cache_size: float = 20.0,
+    workers: int | None = None,
+):
+    if output.is_dir():
+        output /= "scores.csv"
+
+    cache = VolumeCache(cache_dir, int(cache_size * 1e9)) if cache_dir is not None else None
+    names = sorted({x.name for _, pred_dir in methods for x in pred_dir.glob("*") if x.is_file()})
+    score_case = partial(
+        _score_case,
+        refs=refs,
+        methods=methods,
+        check_class=check_class,
+        cache=cache,
+        backend=backend,
+        sparse_threshold=sparse_threshold,
+        tolerances=tolerances,
+        boundary_width=boundary_width,
+    )
+
+    rows = []
+    skipped = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(score_case, names)
+        for scores, case_skipped in tqdm(results, total=len(names), desc="Processing patients"):
+            skipped += case_skipped
+            rows += [
+                {
+                    "pt_id": name,
+                    "anatomy": anatomy or pred_dir.name.capitalize(),
+                    "methods": method,
+                    "center": center_name(name),
+                    **{k: v for k, v in metrics.items() if k not in _NOT_METRICS},
+                }
+                for name, method, pred_dir, metrics in scores
+            ]
+
+    if len(rows) > 0:
+        _long_table(rows).to_csv(output)
+
+    print("Skipped:")
+    for s in skipped:
+        print(f"\t- {s}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+"""
+Segmentation metrics implemented with NumPy and SciPy.
+
+These follow the definitions used by MONAI (DiceMetric, MeanIoU, HausdorffDistanceMetric,
+SurfaceDistanceMetric and SurfaceDiceMetric with include_background=False), but operate
+directly on bool/uint8 masks, so no copy to an int64 torch tensor is needed.
+
+Boundary IoU (Cheng et al., 2021) is the IoU of the parts of both masks that lie within a
+given distance of their own background, which weighs errors along the boundary equally
+for large and small structures.
+"""
+from math import ceil
+from typing import TYPE_CHECKING, Callable, Sequence
+
+import numpy as np
+from scipy.ndimage import binary_erosion, distance_transform_edt
+from scipy.spatial import cKDTree
+
+from nnunetpaper.measure.rle import RLEMask
+
+if TYPE_CHECKING:
+    import SimpleITK as sitk
+
+BACKENDS = ["numpy", "monai"]
+
+# Tolerances for the normalized surface Dice and the width of the boundary for the
+# boundary IoU, in mm (or voxels without a spacing)
+NSD_TOLERANCES = (1.0, 2.0, 3.0, 5.0, 10.0)
+BOUNDARY_WIDTH = 2.0
+# Distances to the surface of a reference are kept for this far around it, in mm (or voxels).
+# Predictions that reach further out need their own distance transform
+REFERENCE_MARGIN = 30.0
+
+
+def array_spacing(image: "sitk.Image") -> tuple[float, ...]:
+    """
+    Returns the voxel spacing of image in the axis order of its array. GetSpacing is in
+    (x, y, z) order, while GetArrayFromImage returns (z, y, x) arrays.
+    """
+    return tuple(image.GetSpacing()[::-1])
+
+
+# Overlaps are counted per slab along the first axis, so the only temporary
+# allocated is a bool buffer of this many slices
+_SLAB_SIZE = 16
+
+
+def overlap_counts(pred: np.ndarray, ref: np.ndarray) -> tuple[int, int, int]:
+    """
+    Returns the number of voxels in pred, in ref, and in both.
+    """
+    pred_count = np.count_nonzero(pred)
+    ref_count = np.count_nonzero(ref)
+
+    intersection = 0
+    if pred_count > 0 and ref_count > 0:
+        buffer = np.empty((min(_SLAB_SIZE, pred.shape[0]),) + pred.shape[1:], dtype=bool)
+        for start in range(0, pred.shape[0], _SLAB_SIZE):
+            stop = min(start + _SLAB_SIZE, pred.shape[0])
+            both = np.logical_and(pred[start:stop], ref[start:stop], out=buffer[: stop - start])
+            intersection += np.count_nonzero(both)
+
+    return pred_count, ref_count, intersection
+
+
+def dice_from_counts(pred_count: int, ref_count: int, intersection: int) -> float:
+    # MONAI ignores empty references, which shows up as NaN
+    if ref_count == 0:
+        return np.nan
+    return float(2.0 * intersection / (pred_count + ref_count))
+
+
+def iou_from_counts(pred_count: int, ref_count: int, intersection: int) -> float:
+    if ref_count == 0:
+        return np.nan
+    return float(intersection / (pred_count + ref_count - intersection))
+
+
+def dice(pred: np.ndarray, ref: np.ndarray) -> float:
+    return dice_from_counts(*overlap_counts(pred, ref))
+
+
+def iou(pred: np.ndarray, ref: np.ndarray) -> float:
+    return iou_from_counts(*overlap_counts(pred, ref))
+
+
+def _bounding_box(pred: np.ndarray, ref: np.ndarray) -> tuple[slice, ...]:
+    box = []
+    for axis in range(pred.ndim):
+        other_axes = tuple(x for x in range(pred.ndim) if x != axis)
+        indices = np.flatnonzero(
+            np.logical_or(np.any(pred, axis=other_axes), np.any(ref, axis=other_axes))
+        )
+        box.append(slice(indices[0], indices[-1] + 1))
+    return tuple(box)
+
+
+def _union_box(boxes: list[tuple[slice, ...]]) -> tuple[slice, ...]:
+    return tuple(slice(min(x.start for x in s), max(x.stop for x in s)) for s in zip(*boxes))
+
+
+def _embed(array: np.ndarray, box: tuple[slice, ...], frame: tuple[slice, ...]) -> np.ndarray:
+    # Places array, which covers box, in a new array covering frame
+    embedded = np.zeros(tuple(x.stop - x.start for x in frame), dtype=array.dtype)
+    embedded[tuple(slice(b.start - f.start, b.stop - f.start) for b, f in zip(box, frame))] = array
+    return embedded
+
+
+def edges(mask: np.ndarray) -> np.ndarray:
+    # Voxels on the border of the (cropped) volume are counted as edges as well
+    return np.logical_xor(binary_erosion(mask), mask)
+
+
+def surface_distances(
+    pred: np.ndarray, ref: np.ndarray, spacing: Sequence[float] | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the distances from every pred surface voxel to the ref surface,
+    and from every ref surface voxel to the pred surface.
+    """
+    if not np.any(pred) and not np.any(ref):
+        return np.empty(0), np.empty(0)
+
+    # Everything outside the bounding box of both masks is irrelevant for the
+    # surface distances, so crop the volumes before running the distance transforms
+    box = _bounding_box(pred, ref)
+    return _edge_distances(edges(pred[box]), edges(ref[box]), spacing)
+
+
+def _edge_distances(
+    pred_edges: np.ndarray,
+    ref_edges: np.ndarray,
+    spacing: Sequence[float] | None,
+    ref_distances: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    # ref_distances are the distances to ref_edges, if these are already known
+    if not np.any(ref_edges):
+        pred_to_ref = np.full(np.count_nonzero(pred_edges), np.inf)
+    else:
+        if ref_distances is None:
+            ref_distances = distance_transform_edt(~ref_edges, sampling=spacing)
+        pred_to_ref = ref_distances[pred_edges]
+
+    if not np.any(pred_edges):
+        ref_to_pred = np.full(np.count_nonzero(ref_edges), np.inf)
+    else:
+        ref_to_pred = distance_transform_edt(~pred_edges, sampling=spacing)[ref_edges]
+
+    return pred_to_ref, ref_to_pred
+
+
+def sparse_surface_distances(
+    pred: RLEMask, ref: RLEMask, spacing: Sequence[float] | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Same as surface_distances, but for run-length encoded masks. Nearest surface points
+    are found with a KD-tree, so no dense distance map of the image is needed.
+    """
+    return surface_point_distances(pred.surface(), ref.surface(), spacing)
+
+
+def surface_point_distances(
+    pred_surface: RLEMask, ref_surface: RLEMask, spacing: Sequence[float] | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Distances between the voxels of two already extracted surfaces.
+    """
+    return _point_distances(_scaled_points(pred_surface, spacing), _scaled_points(ref_surface, spacing))
+
+
+def _scaled_points(surface: RLEMask, spacing: Sequence[float] | None) -> np.ndarray:
+    scale = np.ones(len(surface.shape)) if spacing is None else np.asarray(spacing)
+    return surface.coordinates() * scale
+
+
+def _point_distances(
+    pred_points: np.ndarray, ref_points: np.ndarray, ref_tree: cKDTree | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    if len(ref_points) == 0:
+        pred_to_ref = np.full(len(pred_points), np.inf)
+    else:
+        if ref_tree is None:
+            ref_tree = cKDTree(ref_points)
+        pred_to_ref = ref_tree.query(pred_points)[0]
+
+    if len(pred_points) == 0:
+        ref_to_pred = np.full(len(ref_points), np.inf)
+    else:
+        ref_to_pred = cKDTree(pred_points).query(ref_points)[0]
+
+    return pred_to_ref, ref_to_pred
+
+
+def hd95(pred: np.ndarray, ref: np.ndarray, spacing: Sequence[float] | None = None) -> float:
+    pred_to_ref, ref_to_pred = surface_distances(pred, ref, spacing)
+    return hd95_from_distances(pred_to_ref, ref_to_pred)
+
+
+def assd(pred: np.ndarray, ref: np.ndarray, spacing: Sequence[float] | None = None) -> float:
+    pred_to_ref, ref_to_pred = surface_distances(pred, ref, spacing)
+    return assd_from_distances(pred_to_ref, ref_to_pred)
+
+
+def _percentile(distances: np.ndarray, percentile: float) -> float:
+    if len(distances) == 0:
+        return np.nan
+    return float(np.percentile(distances, percentile))
+
+
+def hd95_from_distances(pred_to_ref: np.ndarray, ref_to_pred: np.ndarray) -> float:
+    # Python's max, like MONAI, so an empty pred surface gives NaN and an empty ref surface inf
+    return max(_percentile(pred_to_ref, 95), _percentile(ref_to_pred, 95))
+
+
+def assd_from_distances(pred_to_ref: np.ndarray, ref_to_pred: np.ndarray) -> float:
+    distances = np.concatenate([pred_to_ref, ref_to_pred])
+    if len(distances) == 0:
+        return np.nan
+    return float(distances.mean())
+
+
+def nsd_name(tolerance: float) -> str:
+    return f"nsd_{tolerance:g}"
+
+
+def nsd_from_distances(pred_to_ref: np.ndarray, ref_to_pred: np.ndarray, tolerance: float) -> float:
+    n_surface = len(pred_to_ref) + len(ref_to_pred)
+    if n_surface == 0:
+        return np.nan
+
+    # The same plain <= as MONAI's compute_surface_dice, which compares float32 distances
+    tolerance = np.float32(tolerance)
+    return float(
+        (
+            np.count_nonzero(pred_to_ref.astype(np.float32, copy=False) <= tolerance)
+            + np.count_nonzero(ref_to_pred.astype(np.float32, copy=False) <= tolerance)
+        )
+        / n_surface
+    )
+
+
+def boundary_band(
+    mask: np.ndarray,
+    width: float,
+    spacing: Sequence[float] | None = None,
+    pad_width: int | Sequence[tuple[int, int]] = 1,
+) -> np.ndarray:
+    """
+    Returns the voxels of mask within width of its background. The padding is counted as
+    background, by default on all sides, so the border of the image is part of the boundary.
+    """
+    padded = np.pad(mask, pad_width)
+    band = distance_transform_edt(padded, sampling=spacing) <= width
+    band &= padded
+
+    pad_width = np.broadcast_to(pad_width, (mask.ndim, 2))
+    return band[tuple(slice(before, before + n) for (before, _), n in zip(pad_width, mask.shape))]
+
+
+def _cropped_boundary_iou(
+    pred: np.ndarray, ref: np.ndarray, width: float, spacing: Sequence[float] | None
+) -> float:
+    # Everything outside the bounding box is background, so padding the box is exact
+    return iou_from_counts(
+        *overlap_counts(boundary_band(pred, width, spacing), boundary_band(ref, width, spacing))
+    )
+
+
+def boundary_iou(
+    pred: np.ndarray | RLEMask,
+    ref: np.ndarray | RLEMask,
+    width: float = BOUNDARY_WIDTH,
+    spacing: Sequence[float] | None = None,
+) -> float:
+    if isinstance(pred, RLEMask) and isinstance(ref, RLEMask):
+        if len(ref) == 0:
+            return np.nan
+        box = _union_box([x.bounding_box() for x in (pred, ref) if len(x) > 0])
+        return _cropped_boundary_iou(pred.crop(box), ref.crop(box), width, spacing)
+
+    if not np.any(ref):
+        return np.nan
+    box = _bounding_box(pred, ref)
+    return _cropped_boundary_iou(pred[box], ref[box], width, spacing)
+
+
+class Reference:
+    """
+    A reference mask, along with everything the metrics only need to know about the reference:
+    its surface, the distances to its surface and its boundary band. These are computed on first
+    use and then reused for every prediction scored against it.
+
+    store(name, compute) can keep these arrays somewhere else as well, e.g. in a VolumeCache,
+    so later runs can reuse them too.
+    """
+
+    def __init__(self, mask: np.ndarray, store: Callable[[str, Callable[[], np.ndarray]], np.ndarray] | None = None):
+        self.mask = mask
+        self.count = int(np.count_nonzero(mask))
+        self.box = _bounding_box(mask, mask) if self.count > 0 else None
+        self.store = store
+        self._arrays: dict[str, np.ndarray] = {}
+        self._trees: dict[str, cKDTree] = {}
+
+    def _array(self, name: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = compute() if self.store is None else self.store(name, compute)
+        return self._arrays[name]
+
+    def edges(self) -> np.ndarray:
+        # Everything outside the bounding box is background, so the edges within it are exact
+        return self._array("edges", lambda: edges(self.mask[self.box]))
+
+    def _distance_frame(self, spacing: Sequence[float] | None) -> tuple[slice, ...]:
+        margin = [REFERENCE_MARGIN] * self.mask.ndim if spacing is None else [REFERENCE_MARGIN / x for x in spacing]
+        return tuple(
+            slice(max(0, x.start - ceil(m)), min(n, x.stop + ceil(m)))
+            for x, m, n in zip(self.box, margin, self.mask.shape)
+        )
+
+    def distances(self, box: tuple[slice, ...], spacing: Sequence[float] | None) -> np.ndarray | None:
+        """
+        Distances to the reference surface within box, or None if box reaches further than
+        REFERENCE_MARGIN beyond the reference.
+        """
+        frame = self._distance_frame(spacing)
+        if any(b.start < f.start or b.stop > f.stop for b, f in zip(box, frame)):
+            return None
+
+        distances = self._array(
+            f"distances-{_spacing_name(spacing)}",
+            lambda: distance_transform_edt(~_embed(self.edges(), self.box, frame), sampling=spacing),
+        )
+        return distances[tuple(slice(b.start - f.start, b.stop - f.start) for b, f in zip(box, frame))]
+
+    def surface_points(self, spacing: Sequence[float] | None) -> tuple[np.ndarray, cKDTree]:
+        name = f"points-{_spacing_name(spacing)}"
+        points = self._array(name, lambda: _scaled_points(RLEMask.from_array(self.mask).surface(), spacing))
+        if name not in self._trees:
+            self._trees[name] = cKDTree(points)
+        return points, self._trees[name]
+
+    def band(self, width: float, spacing: Sequence[float] | None) -> np.ndarray:
+        # Like the edges, the band within the bounding box does not depend on the size of the box
+        return self._array(
+            f"band-{width:g}-{_spacing_name(spacing)}", lambda: boundary_band(self.mask[self.box], width, spacing)
+        )
+
+    def _box_with(self, pred: np.ndarray) -> tuple[slice, ...] | None:
+        # Bounding box of pred and the reference, without going over the reference again
+        boxes = [x for x in (_bounding_box(pred, pred) if np.any(pred) else None, self.box) if x is not None]
+        return _union_box(boxes) if len(boxes) > 0 else None
+
+    def surface_distances(
+        self, pred: np.ndarray, spacing: Sequence[float] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as surface_distances(pred, self.mask, spacing).
+        """
+        box = self._box_with(pred)
+        if box is None:
+            return np.empty(0), np.empty(0)
+
+        ref_edges = _embed(self.edges(), self.box, box) if self.count > 0 else np.zeros(pred[box].shape, dtype=bool)
+        ref_distances = self.distances(box, spacing) if self.count > 0 else None
+        return _edge_distances(edges(pred[box]), ref_edges, spacing, ref_distances)
+
+    def sparse_surface_distances(
+        self, pred: np.ndarray, spacing: Sequence[float] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as sparse_surface_distances(RLEMask.from_array(pred), RLEMask.from_array(self.mask), spacing).
+        """
+        pred_points = _scaled_points(RLEMask.from_array(pred).surface(), spacing)
+        return _point_distances(pred_points, *self.surface_points(spacing))
+
+    def boundary_iou(self, pred: np.ndarray, width: float, spacing: Sequence[float] | None = None) -> float:
+        """
+        Same as boundary_iou(pred, self.mask, width, spacing).
+        """
+        if self.count == 0:
+            return np.nan
+        box = self._box_with(pred)
+        return iou_from_counts(
+            *overlap_counts(boundary_band(pred[box], width, spacing), _embed(self.band(width, spacing), self.box, box))
+        )
+
+
+def _spacing_name(spacing: Sequence[float] | None) -> str:
+    return "voxels" if spacing is None else "x".join(f"{x!r}" for x in spacing)
+
+
+def _numpy_metrics(
+    pred: np.ndarray | RLEMask,
+    ref: np.ndarray | RLEMask | Reference,
+    spacing: Sequence[float] | None,
+    sparse_threshold: float | None,
+    tolerances: Sequence[float],
+    boundary_width: float,
+) -> dict[str, float]:
+    if isinstance(ref, Reference):
+        return _reference_metrics(pred, ref, spacing, sparse_threshold, tolerances, boundary_width)
+
+    if isinstance(pred, RLEMask) and isinstance(ref, RLEMask):
+        counts = (pred.count(), ref.count(), pred.overlap_count(ref))
+        pred_to_ref, ref_to_pred = sparse_surface_distances(pred, ref, spacing)
+    else:
+        counts = overlap_counts(pred, ref)
+        # Thin or small structures are cheaper to handle run-length encoded
+        if sparse_threshold is not None and max(counts[:2]) < sparse_threshold * pred.size:
+            pred_to_ref, ref_to_pred = sparse_surface_distances(
+                RLEMask.from_array(pred), RLEMask.from_array(ref), spacing
+            )
+        else:
+            pred_to_ref, ref_to_pred = surface_distances(pred, ref, spacing)
+
+    metrics = metrics_from_distances(counts, pred_to_ref, ref_to_pred, tolerances)
+    metrics["biou"] = boundary_iou(pred, ref, boundary_width, spacing)
+    return metrics
+
+
+def _reference_metrics(
+    pred: np.ndarray,
+    ref: Reference,
+    spacing: Sequence[float] | None,
+    sparse_threshold: float | None,
+    tolerances: Sequence[float],
+    boundary_width: float,
+) -> dict[str, float]:
+    # The same as for a dense ref, but the reference side comes from ref
+    counts = overlap_counts(pred, ref.mask)
+    if sparse_threshold is not None and max(counts[:2]) < sparse_threshold * pred.size:
+        pred_to_ref, ref_to_pred = ref.sparse_surface_distances(pred, spacing)
+    else:
+        pred_to_ref, ref_to_pred = ref.surface_distances(pred, spacing)
+
+    metrics = metrics_from_distances(counts, pred_to_ref, ref_to_pred, tolerances)
+    metrics["biou"] = ref.boundary_iou(pred, boundary_width, spacing)
+    return metrics
+
+
+def metrics_from_distances(
+    counts: tuple[int, int, int],
+    pred_to_ref: np.ndarray,
+    ref_to_pred: np.ndarray,
+    tolerances: Sequence[float] = NSD_TOLERANCES,
+) -> dict[str, float]:
+    metrics = {
+        "dice": dice_from_counts(*counts),
+        "iou": iou_from_counts(*counts),
+        "hd95": hd95_from_distances(pred_to_ref, ref_to_pred),
+        "assd": assd_from_distances(pred_to_ref, ref_to_pred),
+    }
+    # All tolerances share the same surface distances
+    for tolerance in tolerances:
+        metrics[nsd_name(tolerance)] = nsd_from_distances(pred_to_ref, ref_to_pred, tolerance)
+    return metrics
+
+
+def _as_uint8(mask: np.ndarray) -> np.ndarray:
+    # Bool masks can be reinterpreted as uint8 without a copy
+    if mask.dtype == bool:
+        mask = mask.view(np.uint8)
+    return np.ascontiguousarray(mask, dtype=np.uint8)
+
+
+def _monai_metrics(
+    pred: np.ndarray | RLEMask,
+    ref: np.ndarray | RLEMask | Reference,
+    spacing: Sequence[float] | None,
+    tolerances: Sequence[float],
+) -> dict[str, float]:
+    # MONAI pulls in torch, so only import it when it is actually asked for
+    from monai.metrics import (
+        compute_average_surface_distance,
+        compute_dice,
+        compute_hausdorff_distance,
+        compute_iou,
+        compute_surface_dice,
+    )
+    from torch import from_numpy
+
+    if isinstance(pred, RLEMask):
+        pred = pred.to_array()
+    if isinstance(ref, RLEMask):
+        ref = ref.to_array()
+    elif isinstance(ref, Reference):
+        ref = ref.mask
+
+    pred = from_numpy(_as_uint8(pred)[np.newaxis, np.newaxis, ...])
+    ref = from_numpy(_as_uint8(ref)[np.newaxis, np.newaxis, ...])
+
+    metrics = {
+        "dice": compute_dice(pred, ref, include_background=False).item(),
+        "iou": compute_iou(pred, ref, include_background=False).item(),
+        "hd95": compute_hausdorff_distance(
+            pred, ref, include_background=False, percentile=95, spacing=spacing
+        ).item(),
+        "assd": compute_average_surface_distance(
+            pred, ref, include_background=False, symmetric=True, spacing=spacing
+        ).item(),
+    }
+    for tolerance in tolerances:
+        metrics[nsd_name(tolerance)] = compute_surface_dice(
+            pred, ref, [tolerance], include_background=False, spacing=spacing
+        ).item()
+    return metrics
+
+
+def compute_metrics(
+    pred: np.ndarray | RLEMask,
+    ref: np.ndarray | RLEMask | Reference,
+    spacing: Sequence[float] | None = None,
+    backend: str = "numpy",
+    sparse_threshold: float | None = None,
+    tolerances: Sequence[float] = NSD_TOLERANCES,
+    boundary_width: float = BOUNDARY_WIDTH,
+) -> dict[str, float]:
+    """
+    pred and ref are either both dense masks, or both run-length encoded. With the numpy
+    backend, dense masks where neither covers more than sparse_threshold of the image are
+    run-length encoded before computing surface distances.
+    A dense pred can also be scored against a Reference, which reuses the work on the
+    reference side for every prediction.
+    MONAI has no boundary IoU, so only the numpy backend reports it.
+    """
+    if backend == "numpy":
+        return _numpy_metrics(pred, ref, spacing, sparse_threshold, tolerances, boundary_width)
+    elif backend == "monai":
+        return _monai_metrics(pred, ref, spacing, tolerances)
+    else:
+        raise ValueError(f"Unknown metric backend: {backend}")
@@ -0,0 +1,211 @@
+"""
+Run-length encoded binary masks.
+
+Thin or small structures (skin, tumors) only occupy a tiny fraction of the image.
+Storing them as runs along the last axis of every row makes the memory and the time
+spent on overlaps and surfaces scale with the size of the structure instead of the
+size of the image.
+"""
+from math import prod
+
+import numpy as np
+
+# Dense arrays are encoded in slabs along the first axis, to bound the temporaries
+_SLAB_SIZE = 16
+
+
+class RLEMask:
+    """
+    A binary mask stored as half-open runs [begin, end) of flat (C-order) voxel indices.
+    Runs are sorted, never touch each other and never cross the end of a row.
+    """
+
+    def __init__(self, shape: tuple[int, ...], begins: np.ndarray, ends: np.ndarray):
+        self.shape = tuple(int(x) for x in shape)
+        self.begins = np.asarray(begins, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    @classmethod
+    def from_array(cls, mask: np.ndarray, label: int | None = None) -> "RLEMask":
+        """
+        Encodes the non-zero voxels of mask, or if a label is given, the voxels equal to it.
+        """
+        row_length = mask.shape[-1]
+        begins = []
+        ends = []
+        slab_voxels = prod(mask.shape[1:])
+
+        # Slabs contain whole rows, so runs never cross a slab boundary
+        for start in range(0, mask.shape[0], _SLAB_SIZE):
+            slab = mask[start:start + _SLAB_SIZE]
+            if label is not None:
+                slab = slab == label
+            indices = np.flatnonzero(slab) + start * slab_voxels
+            if len(indices) == 0:
+                continue
+
+            # A new run starts where indices are not consecutive, or where a new row starts
+            breaks = np.flatnonzero((np.diff(indices) != 1) | (indices[1:] % row_length == 0)) + 1
+            begins.append(indices[np.concatenate([[0], breaks])])
+            ends.append(indices[np.concatenate([breaks - 1, [len(indices) - 1]])] + 1)
+
+        if len(begins) == 0:
+            return cls.empty(mask.shape)
+        return cls(mask.shape, np.concatenate(begins), np.concatenate(ends))
+
+    @classmethod
+    def empty(cls, shape: tuple[int, ...]) -> "RLEMask":
+        return cls(shape, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+    @classmethod
+    def concatenate(cls, masks: list["RLEMask"]) -> "RLEMask":
+        """
+        Stacks masks along the first axis, e.g. masks that were encoded slab by slab.
+        """
+        offset = 0
+        begins = []
+        ends = []
+        for mask in masks:
+            if mask.shape[1:] != masks[0].shape[1:]:
+                raise ValueError(f"Cannot concatenate masks of shape {mask.shape} and {masks[0].shape}")
+            begins.append(mask.begins + offset)
+            ends.append(mask.ends + offset)
+            offset += prod(mask.shape)
+
+        shape = (sum(x.shape[0] for x in masks),) + masks[0].shape[1:]
+        return cls(shape, np.concatenate(begins), np.concatenate(ends))
+
+    def __len__(self) -> int:
+        return len(self.begins)
+
+    @property
+    def size(self) -> int:
+        return prod(self.shape)
+
+    def count(self) -> int:
+        return int(np.sum(self.ends - self.begins))
+
+    def fill_fraction(self) -> float:
+        return self.count() / self.size
+
+    def flat_indices(self) -> np.ndarray:
+        lengths = self.ends - self.begins
+        run_offsets = np.repeat(self.begins - (np.cumsum(lengths) - lengths), lengths)
+        return np.arange(int(np.sum(lengths)), dtype=np.int64) + run_offsets
+
+    def coordinates(self) -> np.ndarray:
+        """
+        Returns the (N, ndim) voxel indices of all voxels in the mask.
+        """
+        return np.stack(np.unravel_index(self.flat_indices(), self.shape), axis=-1)
+
+    def bounding_box(self) -> tuple[slice, ...]:
+        """
+        Returns the smallest box that contains all voxels of the (non-empty) mask.
+        """
+        if len(self) == 0:
+            raise ValueError("An empty mask has no bounding box")
+        # Runs never cross a row, so only the last coordinate differs between their ends
+        first = np.stack(np.unravel_index(self.begins, self.shape), axis=-1)
+        last = np.stack(np.unravel_index(self.ends - 1, self.shape), axis=-1)
+        return tuple(slice(int(a), int(b) + 1) for a, b in zip(first.min(axis=0), last.max(axis=0)))
+
+    def crop(self, box: tuple[slice, ...]) -> np.ndarray:
+        """
+        Returns the part of the mask inside box as a dense array.
+        """
+        starts = np.array([x.start for x in box])
+        stops = np.array([x.stop for x in box])
+        coordinates = self.coordinates()
+        inside = np.all((coordinates >= starts) & (coordinates < stops), axis=1)
+
+        array = np.zeros(tuple(stops - starts), dtype=bool)
+        array[tuple((coordinates[inside] - starts).T)] = True
+        return array
+
+    def to_array(self) -> np.ndarray:
+        delta = np.zeros(self.size + 1, dtype=np.int8)
+        # Runs can end where the run on the next row begins, so subtract first
+        delta[self.ends] -= 1
+        delta[self.begins] += 1
+        return np.cumsum(delta[:-1], dtype=np.int8).astype(bool).reshape(self.shape)
+
+    def paint(self, array: np.ndarray, value) -> None:
+        """
+        Sets all voxels of this mask to value in array, in place.
+        """
+        if array.shape != self.shape:
+            raise ValueError(f"Cannot paint a mask of shape {self.shape} into {array.shape}")
+        array.reshape(-1)[self.flat_indices()] = value
+
+    def intersection(self, other: "RLEMask") -> "RLEMask":
+        return self._combine(other, keep=(3,))
+
+    def union(self, other: "RLEMask") -> "RLEMask":
+        return self._combine(other, keep=(1, 2, 3))
+
+    def difference(self, other: "RLEMask") -> "RLEMask":
+        return self._combine(other, keep=(1,))
+
+    def overlap_count(self, other: "RLEMask") -> int:
+        return self.intersection(other).count()
+
+    def _combine(self, other: "RLEMask", keep: tuple[int, ...]) -> "RLEMask":
+        if self.shape != other.shape:
+            raise ValueError(f"Shape mismatch: {self.shape} and {other.shape}")
+
+        # Sweep over all run boundaries, self counts as 1 and other as 2, so the
+        # coverage between two boundaries tells us which of the masks are present
+        positions = np.concatenate([self.begins, self.ends, other.begins, other.ends])
+        deltas = np.concatenate(
+            [
+                np.full(len(self), 1, dtype=np.int8),
+                np.full(len(self), -1, dtype=np.int8),
+                np.full(len(other), 2, dtype=np.int8),
+                np.full(len(other), -2, dtype=np.int8),
+            ]
+        )
+        order = np.argsort(positions, kind="stable")
+        positions = positions[order]
+        coverage = np.cumsum(deltas[order])
+
+        selected = np.isin(coverage[:-1], keep) & (positions[1:] > positions[:-1])
+        return RLEMask(self.shape, positions[:-1][selected], positions[1:][selected])._merged()
+
+    def _merged(self) -> "RLEMask":
+        # Join runs that touch, unless the second one starts a new row
+        if len(self) == 0:
+            return self
+        joined = (self.begins[1:] == self.ends[:-1]) & (self.begins[1:] % self.shape[-1] != 0)
+        keep_begin = np.concatenate([[True], ~joined])
+        keep_end = np.concatenate([~joined, [True]])
+        return RLEMask(self.shape, self.begins[keep_begin], self.ends[keep_end])
+
+    def _shifted(self, axis: int, step: int) -> "RLEMask":
+        """
+        Returns the mask that covers a voxel if this mask covers its neighbour
+        at +step along axis. The last axis is not supported.
+        """
+        stride = prod(self.shape[axis + 1:])
+        coordinate = (self.begins // stride) % self.shape[axis] - step
+        valid = (coordinate >= 0) & (coordinate < self.shape[axis])
+        return RLEMask(
+            self.shape,
+            self.begins[valid] - step * stride,
+            self.ends[valid] - step * stride,
+        )
+
+    def surface(self) -> "RLEMask":
+        """
+        Returns the voxels of the mask with at least one face neighbour outside the mask
+        (or outside the image), the same as XOR-ing the mask with its binary erosion.
+        """
+        # Along a row, only the first and last voxel of a run can have a background neighbour,
+        # so the interior voxels are only kept if all neighbouring rows cover them
+        long_runs = self.ends - self.begins > 2
+        interior = RLEMask(self.shape, self.begins[long_runs] + 1, self.ends[long_runs] - 1)
+        for axis in range(len(self.shape) - 1):
+            for step in (-1, 1):
+                interior = interior.intersection(self._shifted(axis, step))
+
+        return self.difference(interior)
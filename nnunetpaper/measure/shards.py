@@ -0,0 +1,168 @@
+"""
+Splits metric collection over several processes or machines.
+
+Cases are assigned to a shard by a stable hash of their file name, so every node
+can work out its own part of the case list without any coordination. The shard
+outputs are merged into a single scores file, identical to that of a single run.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zlib
+from pathlib import Path
+
+import click
+
+from nnunetpaper.data.utils import SCORE_FORMATS, ScoresWriter, iter_scores, scores_output
+
+
+class ShardType(click.ParamType):
+    name = "i/N"
+
+    def convert(self, value, param, ctx) -> tuple[int, int]:
+        if isinstance(value, tuple):
+            return value
+
+        try:
+            index, count = (int(x) for x in value.split("/"))
+        except ValueError:
+            self.fail(f"{value!r} is not of the form i/N", param, ctx)
+        if count < 1 or not 0 <= index < count:
+            self.fail(f"The shard index of {value!r} should be in [0, {count})", param, ctx)
+        return index, count
+
+
+SHARD = ShardType()
+
+
+def in_shard(name: str, shard: tuple[int, int]) -> bool:
+    index, count = shard
+    # crc32 is stable across processes and machines, unlike hash()
+    return zlib.crc32(name.encode("utf-8")) % count == index
+
+
+def select_shard(files: list[Path], shard: tuple[int, int] | None) -> list[Path]:
+    if shard is None:
+        return files
+    return [x for x in files if in_shard(x.name, shard)]
+
+
+def merge_scores(inputs: list[Path], output: Path, output_format: str) -> int:
+    scores = {}
+    for path in inputs:
+        for pt_id, value in iter_scores(path):
+            if pt_id in scores:
+                raise click.ClickException(f"{pt_id} is in more than one shard")
+            scores[pt_id] = value
+
+    # The collectors process cases sorted by file name
+    multiclass = any(isinstance(x, list) for x in scores.values())
+    with ScoresWriter(output, output_format, multiclass=multiclass) as writer:
+        for pt_id in sorted(scores.keys()):
+            for record in scores[pt_id] if multiclass else [scores[pt_id]]:
+                writer.add(pt_id, record)
+
+    return len(scores)
+
+
+@click.group()
+def main():
+    ...
+
+
+@main.command()
+@click.argument(
+    "inputs",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path),
+)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    type=click.Path(exists=False, file_okay=True, dir_okay=True, writable=True, path_type=Path),
+)
+@click.option("-f", "--format", "output_format", required=False, type=click.Choice(SCORE_FORMATS), default=None)
+def merge(inputs: list[Path], output: Path, output_format: str | None = None):
+    output, output_format = scores_output(output, output, output_format)
+    n_cases = merge_scores(inputs, output, output_format)
+    print(f"Merged {n_cases} cases from {len(inputs)} shards into {output}")
+
+
+@main.command(context_settings={"ignore_unknown_options": True})
+@click.argument("command", type=click.Choice(["metrics", "multiclass-metrics"]))
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.option(
+    "-n",
+    "--shards",
+    "n_shards",
+    required=False,
+    type=click.IntRange(min=1),
+    default=os.cpu_count(),
+    show_default=True,
+)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    type=click.Path(exists=False, file_okay=True, dir_okay=True, writable=True, path_type=Path),
+)
+@click.option("-f", "--format", "output_format", required=False, type=click.Choice(SCORE_FORMATS), default=None)
+@click.option("--keep-shards", is_flag=True, default=False, help="Keep the per-shard outputs next to the output")
+def launch(
+    command: str,
+    args: list[str],
+    n_shards: int,
+    output: Path,
+    output_format: str | None = None,
+    keep_shards: bool = False,
+):
+    """
+    Runs `measure COMMAND ARGS` as one local process per shard, and merges the results.
+    """
+    # With several --preds, every shard would write a directory of scores instead of a single file
+    n_preds = sum(x in ("-p", "--preds") or x.startswith("--preds=") for x in args)
+    if n_preds > 1:
+        raise click.UsageError("launch merges a single scores file per shard, give only one --preds")
+
+    output, output_format = scores_output(output, output, output_format)
+    shard_dir = Path(tempfile.mkdtemp(prefix=f".shards-{output.stem}-", dir=output.parent))
+
+    processes = []
+    shard_outputs = []
+    for index in range(n_shards):
+        shard_output = shard_dir / f"shard-{index}-of-{n_shards}.jsonl"
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "nnunetpaper",
+                    "measure",
+                    command,
+                    *args,
+                    "--shard",
+                    f"{index}/{n_shards}",
+                    "--output",
+                    str(shard_output),
+                ]
+            )
+        )
+        shard_outputs.append(shard_output)
+
+    failed = [i for i, x in enumerate(processes) if x.wait() != 0]
+    if len(failed) > 0:
+        raise click.ClickException(f"Shards {failed} failed, outputs are kept in {shard_dir}")
+
+    n_cases = merge_scores(shard_outputs, output, output_format)
+    print(f"Merged {n_cases} cases from {n_shards} shards into {output}")
+
+    if not keep_shards:
+        shutil.rmtree(shard_dir)
+
+
+if __name__ == "__main__":
+    main()
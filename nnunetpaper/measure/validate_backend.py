@@ -0,0 +1,78 @@
+"""
+Compares the NumPy metric backend against MONAI on a set of predictions.
+
+Both backends are run on every pred/ref pair, and any metric that differs by more
+than the given tolerance is reported. Requires MONAI (and thus torch) to be installed.
+"""
+from pathlib import Path
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+from nnunetpaper.measure.metrics import array_spacing, compute_metrics
+
+
+@click.command()
+@click.option(
+    "-p",
+    "--preds",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path),
+)
+@click.option(
+    "-r",
+    "--refs",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path),
+)
+@click.option("-c", "--class", "check_class", required=False, type=int, default=1)
+@click.option("--rtol", required=False, type=float, default=1e-5, show_default=True)
+@click.option("--atol", required=False, type=float, default=1e-6, show_default=True)
+@click.option("-n", "--limit", required=False, type=int, default=None)
+def main(
+    preds: Path,
+    refs: Path,
+    check_class: int = 1,
+    rtol: float = 1e-5,
+    atol: float = 1e-6,
+    limit: int | None = None,
+):
+    import SimpleITK as sitk
+
+    files = sorted(x.resolve() for x in preds.glob("*") if x.is_file())
+    if limit is not None:
+        files = files[:limit]
+
+    mismatches = []
+    for pred in (progress_bar := tqdm(files, desc="Validating")):
+        progress_bar.set_description(f"Validating {pred.name}")
+
+        try:
+            pred_image = sitk.ReadImage(pred)
+            spacing = array_spacing(pred_image)
+            pred_image = sitk.GetArrayFromImage(pred_image) == check_class
+            ref_image = sitk.GetArrayFromImage(sitk.ReadImage(refs / pred.name)) == check_class
+        except RuntimeError:
+            print(f"Could not read {pred.name}, skipping")
+            continue
+
+        numpy_metrics = compute_metrics(pred_image, ref_image, spacing=spacing, backend="numpy")
+        monai_metrics = compute_metrics(pred_image, ref_image, spacing=spacing, backend="monai")
+
+        for name, expected in monai_metrics.items():
+            actual = numpy_metrics[name]
+            if not np.isclose(actual, expected, rtol=rtol, atol=atol, equal_nan=True):
+                mismatches.append((pred.name, name, actual, expected))
+
+    if len(mismatches) > 0:
+        print(f"Found {len(mismatches)} mismatches:")
+        for name, metric, actual, expected in mismatches:
+            print(f"\t- {name} {metric}: numpy={actual:.6g}, monai={expected:.6g}")
+        raise SystemExit(1)
+
+    print(f"All {len(files)} cases agree within rtol={rtol}, atol={atol}")
+
+
+if __name__ == "__main__":
+    main()
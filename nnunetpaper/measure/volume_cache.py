@@ -0,0 +1,126 @@
+"""
+Cache of decoded volumes, to avoid decompressing the same references over and over.
+
+When several methods are scored against the same references, every run would otherwise
+read and gzip-decode all of them again. Decoded volumes are stored as uncompressed .npy
+files, which are memory-mapped when they are read again. Arrays derived from a volume,
+such as the distance map of a reference, can be kept alongside it.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from nnunetpaper.data.utils import cache_home, write_json
+from nnunetpaper.measure.metrics import array_spacing
+
+
+def read_volume(path: Path) -> tuple[np.ndarray, tuple[float, ...]]:
+    """
+    Reads an image with SimpleITK, returns its array and its spacing in array order.
+    """
+    import SimpleITK as sitk
+
+    image = sitk.ReadImage(path)
+    return sitk.GetArrayFromImage(image), array_spacing(image)
+
+
+def default_cache_dir() -> Path:
+    return cache_home() / "volumes"
+
+
+class VolumeCache:
+    """
+    Entries are keyed by the path, modification time and size of the source file, so a
+    changed source is decoded again. Once the cache grows past max_bytes, the least
+    recently used entries are removed.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def _key(self, path: Path) -> str:
+        stat = path.stat()
+        source = f"{path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def read(self, path: Path) -> tuple[np.ndarray, tuple[float, ...]]:
+        """
+        Same as read_volume, but served from the cache when possible.
+        Raises a RuntimeError if the file cannot be read, like SimpleITK does.
+        """
+        path = Path(path)
+        try:
+            key = self._key(path)
+        except OSError as e:
+            raise RuntimeError(f"Could not read {path}") from e
+        array_path = self.directory / f"{key}.npy"
+        meta_path = self.directory / f"{key}.json"
+
+        try:
+            with open(meta_path, "r") as f:
+                spacing = tuple(json.load(f)["spacing"])
+            array = np.load(array_path, mmap_mode="r")
+            # The modification time of an entry doubles as its last use
+            os.utime(array_path)
+            return array, spacing
+        except (OSError, ValueError, KeyError):
+            pass
+
+        array, spacing = read_volume(path)
+        self._store(key, array, {"source": str(path.resolve()), "spacing": list(spacing)})
+        self._evict()
+        return array, spacing
+
+    def derived(self, path: Path, name: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Returns an array computed from the file at path, such as the distance map of a reference.
+        It is cached under name, and invalidated along with the decoded volume.
+        """
+        path = Path(path)
+        key = hashlib.sha1(f"{self._key(path)}:{name}".encode("utf-8")).hexdigest()
+        array_path = self.directory / f"{key}.npy"
+
+        try:
+            array = np.load(array_path, mmap_mode="r")
+            os.utime(array_path)
+            return array
+        except (OSError, ValueError):
+            pass
+
+        array = compute()
+        self._store(key, array, {"source": str(path.resolve()), "name": name})
+        self._evict()
+        return array
+
+    def _store(self, key: str, array: np.ndarray, meta: dict) -> None:
+        # The array is moved into place last, so an entry is never read without its metadata
+        write_json(self.directory / f"{key}.json", meta)
+
+        temp_path = self.directory / f".tmp-{os.getpid()}-{key}.npy"
+        try:
+            np.save(temp_path, array)
+            os.replace(temp_path, self.directory / f"{key}.npy")
+        except OSError:
+            # A full disk only means the volume is not cached
+            temp_path.unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy") and not entry.name.startswith(".tmp-"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+
+        total = sum(x[1] for x in entries)
+        for _, size, array_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            array_path.unlink(missing_ok=True)
+            array_path.with_suffix(".json").unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,145 @@
+"""
+Box plots drawn from pre-aggregated statistics.
+
+Seaborn computes the quartiles, whiskers and fliers of every box from the raw rows, which is
+slow and memory hungry for the long tables of large evaluations. box_stats computes them for
+all boxes at once with a groupby, after which the boxes are drawn with Axes.bxp, so drawing
+no longer depends on the number of rows. Fliers can be subsampled, as those are the only part
+of a box that grows with its data.
+"""
+from math import ceil
+
+import numpy as np
+import pandas as pd
+
+_STAT_COLUMNS = ["med", "q1", "q3", "whislo", "whishi", "fliers"]
+
+
+def box_stats(
+    data: pd.DataFrame,
+    by: list[str],
+    value: str = "metric",
+    whis: float = 1.5,
+    max_fliers: int | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Returns a row per group of by, with the median, quartiles, whiskers and fliers of value,
+    as matplotlib would compute them. Groups keep the order in which they first appear. At
+    most max_fliers fliers are kept per group, chosen at random.
+    """
+    values = data[by + [value]].replace([np.inf, -np.inf], np.nan).dropna(subset=[value])
+    grouped = values.groupby(by, sort=False, observed=True)[value]
+
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats.columns = ["q1", "med", "q3"]
+    stats["n"] = grouped.size()
+
+    # Whiskers reach the most extreme values within whis times the IQR of the box
+    bounds = values.join(stats, on=by)
+    iqr = bounds["q3"] - bounds["q1"]
+    inside = bounds[value].between(bounds["q1"] - whis * iqr, bounds["q3"] + whis * iqr)
+    stats["whislo"] = values[inside].groupby(by, sort=False, observed=True)[value].min()
+    stats["whishi"] = values[inside].groupby(by, sort=False, observed=True)[value].max()
+
+    fliers = values[~inside]
+    if max_fliers is not None:
+        fliers = fliers.sample(frac=1.0, random_state=seed).groupby(by, sort=False, observed=True).head(max_fliers)
+    fliers = fliers.groupby(by, sort=False, observed=True)[value].agg(list)
+    stats["fliers"] = [fliers.get(x, []) for x in stats.index]
+    return stats.reset_index()
+
+
+def draw_boxes(
+    ax,
+    stats: pd.DataFrame,
+    x: str,
+    hue: str | None = None,
+    palette: list | None = None,
+    order: list | None = None,
+    hue_order: list | None = None,
+    width: float = 0.8,
+    linewidth: float | None = None,
+    fliersize: float = 5.0,
+) -> list[str]:
+    """
+    Draws the boxes of box_stats on ax, the same way as seaborn's boxplot: categories of x
+    in order of appearance, with the boxes of every hue level dodged next to each other.
+    order and hue_order fix the categories and hue levels, so that they keep their position
+    and color across axes that miss some of them. Returns the hue levels, in the order of
+    their colors.
+    """
+    if order is None:
+        order = list(dict.fromkeys(stats[x]))
+    if hue is None:
+        levels = [None]
+    else:
+        levels = hue_order if hue_order is not None else list(dict.fromkeys(stats[hue]))
+    colors = palette if palette is not None else [f"C{i}" for i in range(len(levels))]
+    box_width = width / len(levels)
+
+    for i, level in enumerate(levels):
+        boxes = stats if level is None else stats[stats[hue] == level]
+        boxes = boxes[boxes[x].isin(order)]
+        if len(boxes) == 0:
+            continue
+        offset = (i - (len(levels) - 1) / 2) * box_width
+        ax.bxp(
+            boxes[_STAT_COLUMNS].to_dict("records"),
+            positions=[order.index(x) + offset for x in boxes[x]],
+            widths=box_width * 0.8,
+            patch_artist=True,
+            manage_ticks=False,
+            boxprops={"facecolor": colors[i % len(colors)], "linewidth": linewidth},
+            whiskerprops={"linewidth": linewidth},
+            capprops={"linewidth": linewidth},
+            medianprops={"color": "0.2", "linewidth": linewidth},
+            flierprops={"marker": "d", "markersize": fliersize, "markerfacecolor": "0.2"},
+        )
+
+    ax.set_xticks(range(len(order)), order)
+    ax.set_xlim(-0.5, len(order) - 0.5)
+    ax.set_xlabel(x)
+    return levels
+
+
+def box_grid(
+    stats: pd.DataFrame,
+    col: str,
+    x: str,
+    hue: str | None = None,
+    col_wrap: int = 1,
+    palette: list | None = None,
+    height: float = 5.0,
+    aspect: float = 1.0,
+    legend: bool = True,
+) -> dict:
+    """
+    Draws a grid of box plots, one per value of col, like seaborn's catplot with kind="box".
+    Returns the axes by value of col, like FacetGrid.axes_dict.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
+    names = list(dict.fromkeys(stats[col]))
+    # Like seaborn, all axes share the categories and hue levels of the whole grid
+    order = list(dict.fromkeys(stats[x]))
+    levels = list(dict.fromkeys(stats[hue])) if hue is not None else []
+    n_rows = ceil(len(names) / col_wrap)
+    fig, axes = plt.subplots(
+        n_rows, col_wrap, figsize=(col_wrap * height * aspect, n_rows * height), squeeze=False
+    )
+
+    axes_dict = {}
+    for ax, name in zip(axes.flat, names):
+        draw_boxes(ax, stats[stats[col] == name], x, hue, palette, order=order, hue_order=levels)
+        ax.set_title(str(name))
+        axes_dict[name] = ax
+    for ax in axes.flat[len(names):]:
+        ax.remove()
+
+    if legend and hue is not None:
+        colors = palette if palette is not None else [f"C{i}" for i in range(len(levels))]
+        handles = [Patch(facecolor=colors[i % len(colors)], edgecolor="k", label=x) for i, x in enumerate(levels)]
+        fig.legend(handles=handles, title=hue, loc="center right")
+    return axes_dict
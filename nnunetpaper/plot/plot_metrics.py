@@ -11,17 +11,17 @@ from itertools import combinations
 from pathlib import Path
 
 import click
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import statsmodels.api as sm
-from matplotlib.gridspec import GridSpec, GridSpecFromSubplotSpec
-from matplotlib.patches import Patch
-from matplotlib.ticker import LogLocator, FuncFormatter, NullFormatter
 
 from nnunetpaper._utils import get_multi_method_dataframe
 from nnunetpaper.data import read_json
+from nnunetpaper.data.utils import write_json
+from nnunetpaper.plot.box_stats import box_grid, box_stats, draw_boxes
+
+
+# Lower is better for these, and they are plotted on a log scale
+DISTANCE_METRICS = ["hd95", "assd"]
 
 
 def metric_formatter(metric_name: str) -> str:
@@ -33,6 +33,10 @@ def metric_formatter(metric_name: str) -> str:
         return "HD95"
     elif metric_name == "assd":
         return "ASSD"
+    elif metric_name.startswith("nsd_"):
+        return f"NSD$_{{{metric_name.removeprefix('nsd_')}mm}}$"
+    elif metric_name == "biou":
+        return "BIoU"
     else:
         raise ValueError(f"Unknown metric name: {metric_name}")
 
@@ -47,29 +51,51 @@ def main():
 @click.option(
     "-o", "--output", required=True, type=click.Path(writable=True, path_type=Path)
 )
-def metrics(files: list[Path], output: Path):
+@click.option(
+    "--aggregate",
+    is_flag=True,
+    default=False,
+    help="Draw the boxes from statistics computed in one pass, instead of from every row",
+)
+@click.option(
+    "--max-fliers",
+    required=False,
+    type=click.IntRange(min=0),
+    default=None,
+    help="With --aggregate, draw at most this many randomly chosen fliers per box",
+)
+def metrics(files: list[Path], output: Path, aggregate: bool = False, max_fliers: int | None = None):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     data = read_json(files)
+    data = data[data["center"] != "All"]
 
     sns.set_style("whitegrid")
     sns.set_context("paper")
-    g = sns.catplot(
-        data=data[data["center"] != "All"],
-        x="anatomy",
-        y="metric",
-        hue="center",
-        col="metric_name",
-        col_wrap=2,
-        kind="box",
-        sharey=False,
-    )
-    g.set_titles(col_template="{col_name}", row_template="{row_name}")
+    if aggregate:
+        stats = box_stats(data, ["metric_name", "anatomy", "center"], max_fliers=max_fliers)
+        axes_dict = box_grid(stats, col="metric_name", x="anatomy", hue="center", col_wrap=2)
+    else:
+        g = sns.catplot(
+            data=data,
+            x="anatomy",
+            y="metric",
+            hue="center",
+            col="metric_name",
+            col_wrap=2,
+            kind="box",
+            sharey=False,
+        )
+        g.set_titles(col_template="{col_name}", row_template="{row_name}")
+        axes_dict = g.axes_dict
 
-    for col, ax in g.axes_dict.items():
-        if col in ["dice", "iou"]:
+    for col, ax in axes_dict.items():
+        if col not in DISTANCE_METRICS:
             ax.set_ylabel("Score")
             # ax.set_ylim((0.0, 1.1))
-        elif col in ["hd95", "assd"]:
-            ax.set_ylabel("Distance (voxels)")
+        else:
+            ax.set_ylabel("Distance (mm)")
             ax.set_yscale("log")
             # ax.set_ylim((None, None))
 
@@ -84,6 +110,9 @@ def metrics(files: list[Path], output: Path):
     "-o", "--output", required=True, type=click.Path(writable=True, path_type=Path)
 )
 def volume(files: list[Path], output: Path):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     data = read_json(files)
     data["segment_volume"] = data["segment_volume"].div(1_000)
 
@@ -103,17 +132,218 @@ def volume(files: list[Path], output: Path):
     p.set_xlabels(label="Segmentation Volume ($cm^3$)")
 
     for col, ax in p.axes_dict.items():
-        if col[0] in ["dice", "iou"]:
+        if col[0] not in DISTANCE_METRICS:
             ax.set_ylabel("Score")
             # ax.set_ylim((None, 1.0))
-        elif col[0] in ["hd95", "assd"]:
-            ax.set_ylabel("Distance (voxels)")
+        else:
+            ax.set_ylabel("Distance (mm)")
             ax.set_yscale("log")
             # ax.set_ylim((None, None))
 
     plt.savefig(output, dpi=300)
 
 
+METHOD_DPI = 300
+
+
+def _set_method_style() -> None:
+    import seaborn as sns
+
+    sns.set_style("whitegrid")
+    sns.set_context(
+        "paper",
+        font_scale=0.5,
+        rc={
+            "figure.figsize": (32, 32),
+            "lines.linewidth": 0.5,
+        }
+    )
+
+
+def _draw_method_panel(
+    ax,
+    panel: pd.DataFrame,
+    anatomy: str,
+    metric: str,
+    row: int,
+    col: int,
+    layout: tuple[int, int, int],
+    categories: tuple[list[str], list[str]],
+) -> None:
+    import seaborn as sns
+    from matplotlib.ticker import FuncFormatter, LogLocator, NullFormatter
+
+    n_anatomies, n_overlap_metrics, n_metrics = layout
+    # Every panel has all methods and centers of the figure, so colors match the legend
+    methods, centers = categories
+    if "med" in panel.columns:
+        # Statistics of box_stats rather than rows
+        draw_boxes(
+            ax, panel, x="methods", hue="center", order=methods, hue_order=centers, linewidth=1.0, fliersize=2.5
+        )
+    else:
+        sns.boxplot(
+            data=panel,
+            x="methods",
+            y="metric",
+            hue="center",
+            order=methods,
+            hue_order=centers,
+            fliersize=2.5,
+            ax=ax,
+            legend=False,
+            linewidth=1.0,
+        )
+
+    ax.tick_params(axis="both", which="major", pad=-2.5)
+    ax.tick_params(axis="both", which="minor", pad=-0.5)
+
+    # Set the metric names to the top row
+    if row == 0:
+        ax.set_title(metric_formatter(metric), fontweight="bold")
+
+    # Set the methods label to the bottom row
+    if row != n_anatomies - 1:
+        ax.set_xlabel("")
+    else:
+        ax.set_xlabel("Method")
+
+    # Set the y-axis to log for distance metrics
+    if metric in DISTANCE_METRICS:
+        ax.set_yscale("log")
+
+        formatter = FuncFormatter(lambda y, _: "{:.16g}".format(y))
+        locator = LogLocator(subs=[1.0, 2.5, 5.0])
+
+        ax.yaxis.set_major_formatter(formatter)
+        ax.yaxis.set_major_locator(locator)
+
+        ax.yaxis.set_minor_formatter(NullFormatter())
+
+    # Turn off y-axis labels for all but the first column
+    # in a given metric type
+    if col == 0:
+        ax.set_ylabel("Score")
+    elif col == n_overlap_metrics:
+        ax.set_ylabel("Distance (mm)")
+    elif col == n_metrics - 1:
+        ax.yaxis.set_label_position("right")
+        ax.set_ylabel(f"$\\bf{{{anatomy}}}$", rotation=-90, labelpad=10)
+    else:
+        ax.set_ylabel("")
+
+
+def _center_legend() -> list:
+    from matplotlib.patches import Patch
+
+    return [
+        Patch(facecolor="C0", edgecolor="k", label="All"),
+        Patch(facecolor="C1", edgecolor="k", label="Center A"),
+        Patch(facecolor="C2", edgecolor="k", label="Center B"),
+    ]
+
+
+def _init_panel_worker() -> None:
+    import matplotlib
+
+    # Workers only write files, and must not open windows
+    matplotlib.use("Agg")
+    _set_method_style()
+
+
+def _render_method_panel(
+    panel: pd.DataFrame,
+    anatomy: str,
+    metric: str,
+    row: int,
+    col: int,
+    layout: tuple[int, int, int],
+    categories: tuple[list[str], list[str]],
+    size: tuple[float, float],
+    path: Path,
+) -> Path:
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=size)
+    _draw_method_panel(ax, panel, anatomy, metric, row, col, layout, categories)
+    fig.tight_layout()
+    fig.savefig(path, dpi=METHOD_DPI)
+    plt.close(fig)
+    return path
+
+
+def _render_center_legend(path: Path) -> Path:
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(1, 1))
+    fig.legend(handles=_center_legend(), loc="center")
+    fig.savefig(path, dpi=METHOD_DPI, bbox_inches="tight")
+    plt.close(fig)
+    return path
+
+
+def _composite_panels(grid: list[list[Path]], output: Path, legend: Path | None = None) -> None:
+    from PIL import Image
+
+    # All panels have the same size, the legend goes to the right, centered vertically
+    with Image.open(grid[0][0]) as first:
+        width, height = first.size
+    legend_image = Image.open(legend) if legend is not None else None
+    legend_width = legend_image.size[0] if legend_image is not None else 0
+
+    figure = Image.new("RGB", (width * len(grid[0]) + legend_width, height * len(grid)), "white")
+    for row, paths in enumerate(grid):
+        for col, path in enumerate(paths):
+            with Image.open(path) as panel:
+                figure.paste(panel.convert("RGB"), (col * width, row * height))
+    if legend_image is not None:
+        figure.paste(legend_image.convert("RGB"), (width * len(grid[0]), (figure.size[1] - legend_image.size[1]) // 2))
+        legend_image.close()
+    figure.save(output, dpi=(METHOD_DPI, METHOD_DPI))
+
+
+def _render_method_panels(
+    panels: dict[tuple[str, str], pd.DataFrame],
+    anatomies: list[str],
+    metric_names: list[str],
+    layout: tuple[int, int, int],
+    categories: tuple[list[str], list[str]],
+    output: Path,
+    plot_centers: bool,
+    workers: int | None,
+) -> None:
+    from concurrent.futures import ProcessPoolExecutor
+
+    import matplotlib.pyplot as plt
+
+    panel_dir = output / "panels"
+    panel_dir.mkdir(parents=True, exist_ok=True)
+    # Panels divide the figure that would otherwise be drawn at once between them
+    _set_method_style()
+    width, height = plt.rcParams["figure.figsize"]
+    size = (width / len(metric_names), height / len(anatomies))
+
+    index = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_panel_worker) as executor:
+        futures = []
+        for row, anatomy in enumerate(anatomies):
+            for col, metric in enumerate(metric_names):
+                path = panel_dir / f"{row:02d}_{col:02d}_{anatomy}_{metric}.png"
+                panel = panels.get((anatomy, metric), pd.DataFrame(columns=["methods", "metric", "center"]))
+                futures.append(
+                    executor.submit(
+                        _render_method_panel, panel, anatomy, metric, row, col, layout, categories, size, path
+                    )
+                )
+                index.append({"anatomy": anatomy, "metric": metric, "row": row, "col": col, "file": path.name})
+        legend = executor.submit(_render_center_legend, panel_dir / "legend.png") if plot_centers else None
+        paths = [x.result() for x in futures]
+
+    grid = [paths[x:x + len(metric_names)] for x in range(0, len(paths), len(metric_names))]
+    _composite_panels(grid, output / "methods_plot.png", legend.result() if legend is not None else None)
+    write_json(panel_dir / "index.json", {"figure": "../methods_plot.png", "panels": index})
+
+
 @main.command()
 @click.option(
     "-m",
@@ -146,112 +376,106 @@ def volume(files: list[Path], output: Path):
     default=False,
     show_default=True,
 )
+@click.option(
+    "-p",
+    "--panels",
+    is_flag=True,
+    default=False,
+    help="Render every panel in its own process, into panels/ with an index, and stitch them together",
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of panels rendered in parallel with --panels, defaults to the number of CPUs",
+)
+@click.option(
+    "--aggregate",
+    is_flag=True,
+    default=False,
+    help="Draw the boxes from statistics computed in one pass, instead of from every row",
+)
+@click.option(
+    "--max-fliers",
+    required=False,
+    type=click.IntRange(min=0),
+    default=None,
+    help="With --aggregate, draw at most this many randomly chosen fliers per box",
+)
 def method(
-    methods: list[tuple[str, Path]], output: Path, auto_collect_anatomies: bool = False, plot_centers: bool = False
+    methods: list[tuple[str, Path]],
+    output: Path,
+    auto_collect_anatomies: bool = False,
+    plot_centers: bool = False,
+    panels: bool = False,
+    workers: int | None = None,
+    aggregate: bool = False,
+    max_fliers: int | None = None,
 ):
+    import matplotlib.pyplot as plt
+    from matplotlib.gridspec import GridSpec, GridSpecFromSubplotSpec
+
     data = get_multi_method_dataframe(methods, auto_collect_anatomies)
-    data["method_and_center"] = data["methods"] + " " + data["center"]
 
     if not plot_centers:
         data = data[data["center"] == "All"]
 
-    anatomies = data["anatomy"].unique()
-    metric_names = data["metric_name"].unique()
+    anatomies = list(data["anatomy"].unique())
+    # Overlap metrics on the left, distance metrics on the right
+    overlap_metrics = [x for x in data["metric_name"].unique() if x not in DISTANCE_METRICS]
+    distance_metrics = [x for x in data["metric_name"].unique() if x in DISTANCE_METRICS]
+    metric_names = overlap_metrics + distance_metrics
+    layout = (len(anatomies), len(overlap_metrics), len(metric_names))
+    categories = (list(data["methods"].unique()), list(data["center"].unique()))
+
+    # Split the data into panels once, instead of filtering it for every panel
+    columns = ["methods", "metric", "center"]
+    if aggregate:
+        data = box_stats(data, ["anatomy", "metric_name", "methods", "center"], max_fliers=max_fliers)
+        columns = ["methods", "center", "med", "q1", "q3", "whislo", "whishi", "fliers"]
+    grouped = {key: panel[columns] for key, panel in data.groupby(["anatomy", "metric_name"], sort=False)}
 
-    sns.set_style("whitegrid")
-    sns.set_context(
-        "paper",
-        font_scale=0.5,
-        rc={
-            "figure.figsize": (32, 32),
-            "lines.linewidth": 0.5,
-        }
-    )
+    if not output.exists():
+        output.mkdir(parents=True)
+
+    if panels:
+        _render_method_panels(grouped, anatomies, metric_names, layout, categories, output, plot_centers, workers)
+        return
+
+    _set_method_style()
 
     fig = plt.figure()
     outer_gs = GridSpec(1, 2, figure=fig, wspace=0.2, hspace=0.25)
-    overlap_gs = GridSpecFromSubplotSpec(len(anatomies), len(metric_names) - 2, subplot_spec=outer_gs[0, 0], wspace=0.2)
-    distance_gs = GridSpecFromSubplotSpec(len(anatomies), len(metric_names) - 2, subplot_spec=outer_gs[0, 1], wspace=0.2)
-
-    axs = []
-    for row, anatomy in enumerate(anatomies):
-        for col, metric in enumerate(metric_names):
-            if metric in ["dice", "iou"]:
-                axs.append(fig.add_subplot(overlap_gs[row, col]))
-            elif metric in ["hd95", "assd"]:
-                axs.append(fig.add_subplot(distance_gs[row, col - 2]))
+    overlap_gs = GridSpecFromSubplotSpec(
+        len(anatomies), len(overlap_metrics), subplot_spec=outer_gs[0, 0], wspace=0.2
+    )
+    distance_gs = GridSpecFromSubplotSpec(
+        len(anatomies), len(distance_metrics), subplot_spec=outer_gs[0, 1], wspace=0.2
+    )
 
     for row, anatomy in enumerate(anatomies):
         for col, metric in enumerate(metric_names):
-            print(f"{anatomy} - {metric}: {row} - {col}")
-            ax = axs[row * len(metric_names) + col]
-            sns.boxplot(
-                data=data[(data["anatomy"] == anatomy) & (data["metric_name"] == metric)],
-                x="methods",
-                y="metric",
-                hue="center",
-                fliersize=2.5,
-                ax=ax,
-                legend=False,
-                linewidth=1.0,
-            )
-
-            ax.tick_params(axis="both", which="major", pad=-2.5)
-            ax.tick_params(axis="both", which="minor", pad=-0.5)
-
-            # Set the metric names to the top row
-            if row == 0:
-                ax.set_title(f"$\\bf{{{metric_formatter(metric)}}}$")
-
-            # Set the methods label to the bottom row
-            if row != len(anatomies) - 1:
-                ax.set_xlabel("")
+            if metric not in DISTANCE_METRICS:
+                ax = fig.add_subplot(overlap_gs[row, col])
             else:
-                ax.set_xlabel("Method")
-
-            # Set the y-axis to log for distance metrics
-            if metric in ["hd95", "assd"]:
-                ax.set_yscale("log")
-
-                formatter = FuncFormatter(lambda y, _: "{:.16g}".format(y))
-                locator = LogLocator(subs=[1.0, 2.5, 5.0])
-
-                ax.yaxis.set_major_formatter(formatter)
-                ax.yaxis.set_major_locator(locator)
-
-                ax.yaxis.set_minor_formatter(NullFormatter())
-
-            # Turn off y-axis labels for all but the first column
-            # in a given metric type
-            if col == 0:
-                ax.set_ylabel("Score")
-            elif col == 2:
-                ax.set_ylabel("Distance (mm)")
-            elif col == 3:
-                print("Setting anatomy label")
-                ax.yaxis.set_label_position("right")
-                ax.set_ylabel(f"$\\bf{{{anatomy}}}$", rotation=-90, labelpad=10)
-            else:
-                ax.set_ylabel("")
+                ax = fig.add_subplot(distance_gs[row, col - len(overlap_metrics)])
 
-    if not output.exists():
-        output.mkdir(parents=True)
+            print(f"{anatomy} - {metric}: {row} - {col}")
+            panel = grouped.get((anatomy, metric), pd.DataFrame(columns=["methods", "metric", "center"]))
+            _draw_method_panel(ax, panel, anatomy, metric, row, col, layout, categories)
 
     if plot_centers:
         # Add the legend for the entire figure
-        legend_elements = [
-            Patch(facecolor="C0", edgecolor="k", label="All"),
-            Patch(facecolor="C1", edgecolor="k", label="Center A"),
-            Patch(facecolor="C2", edgecolor="k", label="Center B"),
-        ]
         fig.legend(
-            handles=legend_elements,
+            handles=_center_legend(),
             loc="center right",
         )
 
     plt.tight_layout()
-    plot_output = output / f"methods_plot.png"
-    plt.savefig(plot_output, dpi=300)
+    plot_output = output / "methods_plot.png"
+    plt.savefig(plot_output, dpi=METHOD_DPI)
 
 
 @main.command()
@@ -260,6 +484,9 @@ def method(
     "-o", "--output", required=True, type=click.Path(writable=True, path_type=Path)
 )
 def correlation(files: list[Path], output: Path):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     if output.is_dir():
         output /= "correlation_plot.png"
 
@@ -279,7 +506,7 @@ def correlation(files: list[Path], output: Path):
     sns.pairplot(
         data=data,
         hue="anatomy",
-        vars=["dice", "iou", "hd95", "assd"],
+        vars=[x for x in data.columns if x not in ["pt_id", "anatomy"]],
         markers=["o", "s", "D", "P"],
         kind="scatter",
         diag_kind="auto",
@@ -302,13 +529,14 @@ def correlation(files: list[Path], output: Path):
     type=click.Path(writable=True, file_okay=True, path_type=Path),
 )
 def blandaltman(methods: list[tuple[str, Path]], output: Path):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import statsmodels.api as sm
+
     data = get_multi_method_dataframe(methods)
     data["method_and_center"] = data["methods"] + " " + data["center"]
 
-    data.loc[data["metric_name"] == "dice", "metric_name"] = "DSC"
-    data.loc[data["metric_name"] == "iou", "metric_name"] = "IoU"
-    data.loc[data["metric_name"] == "hd95", "metric_name"] = "HD95"
-    data.loc[data["metric_name"] == "assd", "metric_name"] = "ASSD"
+    data["metric_name"] = data["metric_name"].map(metric_formatter)
 
     combos = []
     for a, b in combinations(data["methods"].unique(), 2):
@@ -4,8 +4,9 @@ from pathlib import Path
 import click
 import numpy as np
 import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
+
+from nnunetpaper.data.utils import iter_scores
+from nnunetpaper.plot.box_stats import box_grid, box_stats
 
 
 @click.command()
@@ -29,7 +30,29 @@ from matplotlib import pyplot as plt
     required=True,
     type=click.Path(exists=True, readable=True, path_type=Path),
 )
-def main(methods: list[tuple[str, Path]], output: Path, dataset_file: Path) -> None:
+@click.option(
+    "--aggregate",
+    is_flag=True,
+    default=False,
+    help="Draw the boxes from statistics computed in one pass, instead of from every row",
+)
+@click.option(
+    "--max-fliers",
+    required=False,
+    type=click.IntRange(min=0),
+    default=None,
+    help="With --aggregate, draw at most this many randomly chosen fliers per box",
+)
+def main(
+    methods: list[tuple[str, Path]],
+    output: Path,
+    dataset_file: Path,
+    aggregate: bool = False,
+    max_fliers: int | None = None,
+) -> None:
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     data = {
         "pt_id": [],
         "method": [],
@@ -48,10 +71,7 @@ def main(methods: list[tuple[str, Path]], output: Path, dataset_file: Path) -> N
 
     print("Reading scores")
     for method, path in methods:
-        with path.open("r") as f:
-            scores = json.load(f)
-
-        for pt_id, pt_scores in scores.items():
+        for pt_id, pt_scores in iter_scores(path):
             for score in pt_scores:
                 for name in ["dice", "hd95"]:
                     data["method"].append(method)
@@ -68,29 +88,42 @@ def main(methods: list[tuple[str, Path]], output: Path, dataset_file: Path) -> N
     print("Plotting")
     sns.set_style("whitegrid")
     sns.set_context("paper", font_scale=3)
-    p = sns.catplot(
-        data=data,
-        x="anatomy",
-        y="metric",
-        hue="method",
-        kind="box",
-        col="metric_name",
-        col_wrap=1,
-        sharey=False,
-        palette=sns.color_palette("colorblind"),
-        legend=True,
-        height=16,
-        aspect=2,
-    )
-
-    p.set_titles(col_template="{col_name}", row_template="{row_name}")
+    if aggregate:
+        stats = box_stats(data, ["metric_name", "anatomy", "method"], max_fliers=max_fliers)
+        axes_dict = box_grid(
+            stats,
+            col="metric_name",
+            x="anatomy",
+            hue="method",
+            col_wrap=1,
+            palette=sns.color_palette("colorblind"),
+            height=16,
+            aspect=2,
+        )
+    else:
+        p = sns.catplot(
+            data=data,
+            x="anatomy",
+            y="metric",
+            hue="method",
+            kind="box",
+            col="metric_name",
+            col_wrap=1,
+            sharey=False,
+            palette=sns.color_palette("colorblind"),
+            legend=True,
+            height=16,
+            aspect=2,
+        )
+        p.set_titles(col_template="{col_name}", row_template="{row_name}")
+        axes_dict = p.axes_dict
 
-    for col, ax in p.axes_dict.items():
+    for col, ax in axes_dict.items():
         if col in ["dice", "iou"]:
             ax.set_ylabel("Score")
             # ax.set_ylim((0.0, 1.1))
         elif col in ["hd95", "assd"]:
-            ax.set_ylabel("Distance (voxels)")
+            ax.set_ylabel("Distance (mm)")
             ax.set_yscale("log")
             # ax.set_ylim((None, None))
 
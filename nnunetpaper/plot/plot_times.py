@@ -1,11 +1,42 @@
 from pathlib import Path
 
 import click
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
 
-from nnunetpaper._utils import get_multi_method_dataframe
+from nnunetpaper._utils import get_multi_method_timings
+from nnunetpaper.plot.box_stats import box_grid, box_stats
+
+
+def method_times(data: pd.DataFrame, sum_methods: list[str]) -> pd.DataFrame:
+    """
+    Returns the time per patient of every method, a row per method and patient. The times of
+    methods in sum_methods are summed over all anatomies, the other methods predict all
+    anatomies at once, so only the times of the first anatomy are used.
+    """
+    summed = data["methods"].isin(sum_methods)
+    times = pd.concat(
+        [
+            data[summed].groupby(["methods", "pt_id"], sort=False)["time"].sum().reset_index(),
+            data.loc[~summed & (data["anatomy"] == data["anatomy"].iloc[0]), ["methods", "pt_id", "time"]],
+        ],
+        ignore_index=True,
+    )
+    # Methods in the order in which they were given
+    order = pd.Categorical(times["methods"], categories=data["methods"].unique(), ordered=True)
+    times = times.iloc[order.argsort(kind="stable")]
+    return times.rename(columns={"methods": "method"}).reset_index(drop=True)
+
+
+def print_summed_times(times: pd.DataFrame, sum_methods: list[str]) -> None:
+    summary = (
+        times[times["method"].isin(sum_methods)]
+        .groupby("method", sort=False)["time"]
+        .agg(["mean", "std", lambda x: x.quantile(0.025), lambda x: x.quantile(0.975)])
+    )
+    for method, (mean, std, low, high) in summary.iterrows():
+        print(method)
+        print(f"{'mean':<10} {'std':<10} {'5th':<10} {'95th':<10}")
+        print(f"{mean:<10.5g} {std:<10.5g} {low:<10.5g} {high:<10.5g}")
 
 
 @click.group()
@@ -28,56 +59,70 @@ def main():
     multiple=True,
     type=str,
 )
+@click.option(
+    "-t",
+    "--timings",
+    multiple=True,
+    type=click.Tuple([str, click.Path(exists=True, readable=True, path_type=Path)]),
+    help="Timing tables written by `measure timings`, used instead of the times in the scores",
+)
 @click.option(
     "-o",
     "--output",
     required=True,
     type=click.Path(writable=True, file_okay=True, path_type=Path),
 )
-def times(methods: list[tuple[str, Path]], sum_methods: list[str], output: Path):
-    data = get_multi_method_dataframe(methods)
-
-    time_data = {
-        "method": [],
-        "time": [],
-    }
-
-    data = data[data["metric_name"] == "dice"]
-    data = data[data["center"] == "All"]
-
-    for method in data["methods"].unique():
-        print(method)
-        if method in sum_methods:
-            values = data[data["methods"] == method].groupby(["pt_id"])["time"].sum()
-
-            print(f"{'mean':<10} {'std':<10} {'5th':<10} {'95th':<10}")
-            print(
-                f"{values.mean():<10.5g} {values.std():<10.5g} "
-                f"{values.quantile(0.025):<10.5g} {values.quantile(0.975):<10.5g}"
-            )
-        else:
-            values = data.loc[
-                (data["methods"] == method)
-                & (data["anatomy"] == data["anatomy"].unique()[0]),
-                "time",
-            ]
-
-        for value in values:
-            time_data["method"].append(method)
-            time_data["time"].append(value)
-
-    data = pd.DataFrame(time_data)
+@click.option(
+    "--aggregate",
+    is_flag=True,
+    default=False,
+    help="Draw the boxes from statistics computed in one pass, instead of from every row",
+)
+@click.option(
+    "--max-fliers",
+    required=False,
+    type=click.IntRange(min=0),
+    default=None,
+    help="With --aggregate, draw at most this many randomly chosen fliers per box",
+)
+def times(
+    methods: list[tuple[str, Path]],
+    sum_methods: list[str],
+    output: Path,
+    timings: list[tuple[str, Path]] = (),
+    aggregate: bool = False,
+    max_fliers: int | None = None,
+):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    if len(timings) > 0:
+        data = get_multi_method_timings(timings)
+    elif len(methods) > 0:
+        data = get_multi_method_timings(methods, from_scores=True)
+    else:
+        raise click.UsageError("Either --method or --timings is required")
+
+    data = method_times(data, sum_methods)
+    print_summed_times(data, sum_methods)
 
     sns.set_style("whitegrid")
     sns.set_context("paper", font_scale=1.5)
-    g = sns.catplot(
-        data=data,
-        x="method",
-        y="time",
-        kind="box",
-    )
-    g.set_xlabels("Method")
-    g.set_ylabels("Time (s)")
+    if aggregate:
+        stats = box_stats(data.assign(plot="time"), ["plot", "method"], value="time", max_fliers=max_fliers)
+        (ax,) = box_grid(stats, col="plot", x="method").values()
+        ax.set_title("")
+        ax.set_xlabel("Method")
+        ax.set_ylabel("Time (s)")
+    else:
+        g = sns.catplot(
+            data=data,
+            x="method",
+            y="time",
+            kind="box",
+        )
+        g.set_xlabels("Method")
+        g.set_ylabels("Time (s)")
     sns.despine(trim=True, left=True)
 
     plt.suptitle("Prediction time")
@@ -2,26 +2,53 @@ from pathlib import Path
 
 import click
 import numpy as np
-import SimpleITK as sitk
 from tqdm import tqdm
 
+from nnunetpaper.measure.rle import RLEMask
+from nnunetpaper.process.slabs import SlabReader, SlabWriter
 
-def _process_patient(input_files: list[Path], output_file: Path):
-    images = [sitk.ReadImage(f) for f in input_files]
-    arrays = [sitk.GetArrayFromImage(i) for i in images]
 
-    output = np.zeros_like(arrays[0])
-    for idx, im in (
-        prog_bar := tqdm(enumerate(arrays), total=len(arrays), leave=False, position=1)
+def _process_patient(input_files: list[Path], output_file: Path, sparse_threshold: float = 0.01):
+    import SimpleITK as sitk
+
+    reference = sitk.ReadImage(input_files[0])
+    output = np.zeros_like(sitk.GetArrayViewFromImage(reference))
+
+    # Read the labels one at a time, so only one input volume is in memory at once
+    for idx, file in (
+        prog_bar := tqdm(enumerate(input_files), total=len(input_files), leave=False, position=1)
     ):
         prog_bar.set_description(f"{idx}")
-        output = np.where(im == 1, idx + 1, output)
+        image = reference if idx == 0 else sitk.ReadImage(file)
+        array = sitk.GetArrayViewFromImage(image)
+
+        # Small structures only need their own voxels written, so only those are run-length encoded
+        foreground = array == 1
+        if np.count_nonzero(foreground) / array.size < sparse_threshold:
+            RLEMask.from_array(foreground).paint(output, idx + 1)
+        else:
+            np.copyto(output, idx + 1, where=foreground)
 
     output = sitk.GetImageFromArray(output)
-    output.CopyInformation(images[0])
+    output.CopyInformation(reference)
     sitk.WriteImage(output, output_file)
 
 
+def _process_patient_slabs(input_files: list[Path], output_file: Path, slab_size: int):
+    readers = [SlabReader(f) for f in input_files]
+    for reader, file in zip(readers[1:], input_files[1:]):
+        if reader.shape != readers[0].shape:
+            raise RuntimeError(f"{file} does not have the same shape as {input_files[0]}")
+
+    # Merging labels is voxel-wise, so the slabs don't need a halo
+    with SlabWriter(output_file, readers[0].header) as writer:
+        for slabs in zip(*[r.iter_slabs(slab_size) for r in readers]):
+            output = np.zeros_like(slabs[0].data)
+            for idx, slab in enumerate(slabs):
+                np.copyto(output, idx + 1, where=slab.data == 1)
+            writer.write(output)
+
+
 @click.command()
 @click.option(
     "-i",
@@ -37,7 +64,28 @@ def _process_patient(input_files: list[Path], output_file: Path):
     required=True,
     type=click.Path(file_okay=False, writable=True, path_type=Path),
 )
-def main(input_dirs: list[Path], output: Path):
+@click.option(
+    "-s",
+    "--sparse-threshold",
+    required=False,
+    type=click.FloatRange(0.0, 1.0),
+    default=0.01,
+    show_default=True,
+    help="Write labels covering less than this fraction of the image run by run",
+)
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stream NIfTI volumes through in slabs of this many slices, to bound memory use",
+)
+def main(
+    input_dirs: list[Path],
+    output: Path,
+    sparse_threshold: float = 0.01,
+    slab_size: int | None = None,
+):
     if not output.exists():
         output.mkdir(parents=True)
 
@@ -47,7 +95,14 @@ def main(input_dirs: list[Path], output: Path):
     for file in (prog_bar := tqdm(files)):
         prog_bar.set_description(f"{file.name}")
         try:
-            _process_patient([p / file.name for p in input_dirs], output / file.name)
+            if slab_size is not None:
+                _process_patient_slabs(
+                    [p / file.name for p in input_dirs], output / file.name, slab_size
+                )
+            else:
+                _process_patient(
+                    [p / file.name for p in input_dirs], output / file.name, sparse_threshold
+                )
         except RuntimeError:
             skipped.append(file)
 
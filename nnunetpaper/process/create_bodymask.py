@@ -1,10 +1,11 @@
 from pathlib import Path
 
 import click
-import SimpleITK as sitk
 
 
 def _process_patient(input_file: Path, output_file: Path, axis: str = "z"):
+    import SimpleITK as sitk
+
     image = sitk.ReadImage(input_file)
 
     # Find the Otsu Threshold
@@ -1,11 +1,15 @@
 from pathlib import Path
 
 import click
-import SimpleITK as sitk
+import numpy as np
 from tqdm import tqdm
 
+from nnunetpaper.process.slabs import SlabReader, SlabWriter, find_components, iter_components
+
 
 def _process_patient(input_file: Path, output_file: Path):
+    import SimpleITK as sitk
+
     image = sitk.ReadImage(input_file)
 
     # Initial closing pass
@@ -13,6 +17,26 @@ def _process_patient(input_file: Path, output_file: Path):
     sitk.WriteImage(output, output_file)
 
 
+def _process_patient_slabs(input_file: Path, output_file: Path, slab_size: int):
+    reader = SlabReader(input_file)
+
+    # Same as BinaryFillhole with fullyConnected=True: holes are the background
+    # components (26-connected) that don't touch the image border
+    def background(x: np.ndarray) -> np.ndarray:
+        return x != 1
+
+    structure = np.ones((3, 3, 3), dtype=bool)
+
+    components = find_components(reader, background, structure, slab_size)
+    with SlabWriter(output_file, reader.header) as writer:
+        for slab, selected, component in iter_components(
+            reader, background, structure, slab_size, components
+        ):
+            output = slab.data.copy()
+            output[selected & ~components.on_border[component]] = 1
+            writer.write(output)
+
+
 @click.group()
 def main():
     ...
@@ -33,8 +57,21 @@ def main():
     required=False,
     type=click.Path(dir_okay=False, writable=True, path_type=Path),
 )
-def file(input_file: Path, output_file: Path = None):
-    _process_patient(input_file, output_file)
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stream NIfTI volumes through in slabs of this many slices, to bound memory use",
+)
+def file(input_file: Path, output_file: Path = None, slab_size: int | None = None):
+    if output_file is None:
+        output_file = input_file
+
+    if slab_size is not None:
+        _process_patient_slabs(input_file, output_file, slab_size)
+    else:
+        _process_patient(input_file, output_file)
 
 
 @main.command()
@@ -45,13 +82,23 @@ def file(input_file: Path, output_file: Path = None):
     required=True,
     type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path),
 )
-def directory(input_dir: Path):
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stream NIfTI volumes through in slabs of this many slices, to bound memory use",
+)
+def directory(input_dir: Path, slab_size: int | None = None):
     skipped = []
     files = [x.resolve() for x in input_dir.glob("*") if x.is_file()]
     for pat in (prog_bar := tqdm(files)):
         prog_bar.set_description(f"{pat.name}")
         try:
-            _process_patient(pat, pat)
+            if slab_size is not None:
+                _process_patient_slabs(pat, pat, slab_size)
+            else:
+                _process_patient(pat, pat)
         except RuntimeError:
             skipped.append(pat)
 
@@ -1,11 +1,20 @@
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import click
-import SimpleITK as sitk
+import numpy as np
+from scipy.ndimage import generate_binary_structure
 from tqdm import tqdm
 
+from nnunetpaper.process.slabs import SlabReader, SlabWriter, find_components, iter_components
+
+if TYPE_CHECKING:
+    import SimpleITK as sitk
+
+
+def _process_patient(image: Path | str) -> "sitk.Image":
+    import SimpleITK as sitk
 
-def _process_patient(image: Path | str) -> sitk.Image:
     image = sitk.ReadImage(image)
 
     # Relabel each separate component
@@ -16,6 +25,24 @@ def _process_patient(image: Path | str) -> sitk.Image:
     return image == 1
 
 
+def _process_patient_slabs(input_file: Path, output_file: Path, slab_size: int):
+    reader = SlabReader(input_file)
+
+    # Same as ConnectedComponent (face connectivity) followed by keeping the largest label
+    def foreground(x: np.ndarray) -> np.ndarray:
+        return x != 0
+
+    structure = generate_binary_structure(3, 1)
+
+    components = find_components(reader, foreground, structure, slab_size)
+    largest = np.argmax(components.sizes)
+    with SlabWriter(output_file, reader.header, dtype=np.uint8) as writer:
+        for _, selected, component in iter_components(
+            reader, foreground, structure, slab_size, components
+        ):
+            writer.write(selected & (component == largest))
+
+
 @click.group()
 def main():
     ...
@@ -37,7 +64,18 @@ def main():
     type=click.Path(file_okay=False, writable=True, path_type=Path),
     default=None,
 )
-def directory(input_path: Path, output_path: Path | None = None):
+@click.option(
+    "--slab-size",
+    required=False,
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stream NIfTI volumes through in slabs of this many slices, to bound memory use",
+)
+def directory(
+    input_path: Path, output_path: Path | None = None, slab_size: int | None = None
+):
+    import SimpleITK as sitk
+
     if output_path is not None and not output_path.exists():
         output_path.mkdir(parents=True)
 
@@ -48,6 +86,14 @@ def directory(input_path: Path, output_path: Path | None = None):
         prog_bar := tqdm([x.resolve() for x in input_path.glob("*") if x.is_file()])
     ):
         prog_bar.set_description(f"Processing {patient.name}")
+        if slab_size is not None:
+            try:
+                target = output_path / patient.name if output_path is not None else patient
+                _process_patient_slabs(patient, target, slab_size)
+            except RuntimeError:
+                skipped_files.append(patient)
+            continue
+
         try:
             image = sitk.ReadImage(patient)
         except RuntimeError:
@@ -79,6 +125,8 @@ def directory(input_path: Path, output_path: Path | None = None):
     type=click.Path(dir_okay=False, writable=True, path_type=Path),
 )
 def single(input_path: Path, output_path: Path = None):
+    import SimpleITK as sitk
+
     if not output_path.parent.exists():
         output_path.parent.mkdir(parents=True)
 
@@ -0,0 +1,223 @@
+"""
+Slab-wise (out-of-core) processing of NIfTI volumes.
+
+Volumes are streamed through in chunks of z-slices, so memory stays bounded regardless
+of the size of the scan. Slabs are returned in the same (z, y, x) axis order as
+SimpleITK's GetArrayFromImage. NIfTI stores z as the slowest axis, so every slab is a
+contiguous block of the file, for both reading and writing.
+"""
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterator, NamedTuple
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+if TYPE_CHECKING:
+    import nibabel as nib
+
+
+class Slab(NamedTuple):
+    start: int
+    stop: int
+    # Slices [start - halo_before, stop + halo_after) of the volume
+    data: np.ndarray
+    halo_before: int
+
+    @property
+    def core(self) -> np.ndarray:
+        return self.data[self.halo_before:self.halo_before + self.stop - self.start]
+
+
+class SlabReader:
+    def __init__(self, path: Path):
+        import nibabel as nib
+
+        # Keeping the file open lets gzipped files be read front to back only once
+        try:
+            self.image = nib.load(path, keep_file_open=True)
+        except (OSError, nib.filebasedimages.ImageFileError) as e:
+            raise RuntimeError(f"Could not read {path}") from e
+        if len(self.image.shape) != 3:
+            raise RuntimeError(f"Only 3D volumes can be read in slabs, {path} has shape {self.image.shape}")
+
+        self.header = self.image.header
+        self.shape = self.image.shape[::-1]
+        # In the same (z, y, x) axis order as the slabs
+        self.spacing = tuple(float(x) for x in self.header.get_zooms()[::-1])
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return np.asanyarray(self.image.dataobj[:, :, start:stop]).T
+
+    def iter_slabs(self, slab_size: int, halo: int = 0) -> Iterator[Slab]:
+        if halo > slab_size:
+            raise ValueError(f"The halo ({halo}) cannot be larger than the slab size ({slab_size})")
+
+        bounds = [(x, min(x + slab_size, self.shape[0])) for x in range(0, self.shape[0], slab_size)]
+
+        # Every slice is read once, the halos are taken from the neighbouring slabs
+        previous = None
+        current = self.read(*bounds[0])
+        for idx, (start, stop) in enumerate(bounds):
+            following = self.read(*bounds[idx + 1]) if idx + 1 < len(bounds) else None
+
+            parts = [current]
+            halo_before = 0
+            if halo > 0 and previous is not None:
+                parts.insert(0, previous[-halo:])
+                halo_before = halo
+            if halo > 0 and following is not None:
+                parts.append(following[:halo])
+
+            data = np.concatenate(parts) if len(parts) > 1 else current
+            yield Slab(start, stop, data, halo_before)
+
+            previous, current = current, following
+
+
+class SlabWriter:
+    """
+    Streams slabs, in order, into a (possibly gzipped) NIfTI file.
+    The file is written next to path and only moved into place once complete,
+    so a volume can be processed in place.
+    """
+
+    def __init__(self, path: Path, header: "nib.Nifti1Header", dtype: np.dtype | None = None):
+        import nibabel as nib
+
+        self.header = header.copy()
+        if dtype is not None:
+            self.header.set_data_dtype(dtype)
+        # Slabs are written as-is
+        self.header.set_slope_inter(1.0, 0.0)
+        self.dtype = self.header.get_data_dtype()
+        self.shape = self.header.get_data_shape()[::-1]
+        self.written = 0
+
+        self.path = Path(path)
+        # Keep the extensions, so a .nii.gz is still gzipped
+        self.temp_path = self.path.with_name(f".tmp-{os.getpid()}-{self.path.name}")
+        self.file = nib.openers.ImageOpener(self.temp_path, "wb")
+        self.header.write_to(self.file)
+        offset = int(self.header.get_data_offset())
+        self.file.write(b"\x00" * (offset - self.file.tell()))
+
+    def __enter__(self) -> "SlabWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.file.close()
+        if exc_type is not None or self.written != self.shape[0]:
+            self.temp_path.unlink()
+            if exc_type is None:
+                raise RuntimeError(f"Wrote {self.written} slices, expected {self.shape[0]}")
+            return
+
+        os.replace(self.temp_path, self.path)
+
+    def write(self, slab: np.ndarray) -> None:
+        if slab.shape[1:] != self.shape[1:]:
+            raise ValueError(f"Slab of shape {slab.shape} does not fit a volume of shape {self.shape}")
+
+        # C-order (z, y, x) is the Fortran-order (x, y, z) that NIfTI expects
+        self.file.write(np.ascontiguousarray(slab, dtype=self.dtype).tobytes())
+        self.written += slab.shape[0]
+
+
+class Components(NamedTuple):
+    # First global label of every slab
+    offsets: list[int]
+    # Component of every global label, label 0 is the unselected voxels
+    component_of: np.ndarray
+    sizes: np.ndarray
+    on_border: np.ndarray
+
+
+def _plane_pairs(previous: np.ndarray, current: np.ndarray, structure: np.ndarray) -> np.ndarray:
+    # Pairs of labels in two consecutive planes that are connected under the structure
+    pairs = []
+    height, width = previous.shape
+    for dy, dx in np.argwhere(structure[2]) - 1:
+        a = previous[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)]
+        b = current[max(0, dy):height - max(0, -dy), max(0, dx):width - max(0, -dx)]
+        both = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[both], b[both]], axis=-1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def _label_slab(
+    slab: np.ndarray, select: Callable[[np.ndarray], np.ndarray], structure: np.ndarray, offset: int
+) -> tuple[np.ndarray, int]:
+    labels, n_labels = ndimage.label(select(slab), structure=structure)
+    labels = labels.astype(np.int64)
+    labels[labels > 0] += offset
+    return labels, n_labels
+
+
+def find_components(
+    reader: SlabReader,
+    select: Callable[[np.ndarray], np.ndarray],
+    structure: np.ndarray,
+    slab_size: int,
+) -> Components:
+    """
+    Connected components of the selected voxels, labelled per slab and merged across
+    slab boundaries, along with their sizes and whether they touch the image border.
+    """
+    offsets = []
+    sizes = [np.zeros(1, dtype=np.int64)]
+    border_labels = []
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    n_labels = 0
+    previous_plane = None
+
+    for slab in reader.iter_slabs(slab_size):
+        labels, n_slab_labels = _label_slab(slab.data, select, structure, n_labels)
+        offsets.append(n_labels)
+        sizes.append(np.bincount(labels[labels > 0] - n_labels, minlength=n_slab_labels + 1)[1:])
+
+        faces = [labels[:, 0, :], labels[:, -1, :], labels[:, :, 0], labels[:, :, -1]]
+        if slab.start == 0:
+            faces.append(labels[0])
+        if slab.stop == reader.shape[0]:
+            faces.append(labels[-1])
+        border_labels.append(np.unique(np.concatenate([x.ravel() for x in faces])))
+
+        if previous_plane is not None:
+            pairs.append(_plane_pairs(previous_plane, labels[0], structure))
+        previous_plane = labels[-1]
+        n_labels += n_slab_labels
+
+    pairs = np.concatenate(pairs)
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n_labels + 1, n_labels + 1)
+    )
+    n_components, component_of = connected_components(graph, directed=False)
+
+    # Label 0 is its own component, but it is never selected
+    sizes = np.bincount(component_of, weights=np.concatenate(sizes), minlength=n_components).astype(np.int64)
+    on_border = np.zeros(n_components, dtype=bool)
+    on_border[component_of[np.concatenate(border_labels)]] = True
+    on_border[component_of[0]] = False
+    sizes[component_of[0]] = 0
+
+    return Components(offsets, component_of, sizes, on_border)
+
+
+def iter_components(
+    reader: SlabReader,
+    select: Callable[[np.ndarray], np.ndarray],
+    structure: np.ndarray,
+    slab_size: int,
+    components: Components,
+) -> Iterator[tuple[Slab, np.ndarray, np.ndarray]]:
+    """
+    Second pass over the volume, yields every slab with a mask of the selected voxels
+    and the component each of them belongs to.
+    """
+    for slab, offset in zip(reader.iter_slabs(slab_size), components.offsets):
+        labels, _ = _label_slab(slab.data, select, structure, offset)
+        selected = labels > 0
+        yield slab, selected, components.component_of[labels]
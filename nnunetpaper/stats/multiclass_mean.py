@@ -4,19 +4,18 @@ from pathlib import Path
 import click
 import pandas as pd
 
+from nnunetpaper.data.utils import iter_scores
 
-def read_json(file: Path) -> pd.DataFrame:
-    with file.open('r') as f:
-        d: dict = json.load(f)
 
+def read_json(file: Path) -> pd.DataFrame:
     transformed_dict = {
         "metric": [],
         "metric_name": [],
         "class": [],
     }
 
-    for k in d.keys():
-        for c in d[k]:
+    for _, classes in iter_scores(file):
+        for c in classes:
             dsc = c["dice"]
             if not (dsc == float("nan") or dsc == float("inf") or dsc == float("-inf")):
                 transformed_dict["metric"].append(c["dice"])
@@ -2,7 +2,6 @@ from itertools import combinations
 from pathlib import Path
 
 import click
-from scipy.stats import mannwhitneyu
 
 from nnunetpaper._utils import get_multi_method_dataframe
 from nnunetpaper.data import read_json
@@ -16,6 +15,8 @@ def main():
 @main.command()
 @click.argument("files", nargs=-1, type=click.Path(readable=True, path_type=Path))
 def center(files: list[Path]):
+    from scipy.stats import mannwhitneyu
+
     data = read_json(files)
 
     anatomies = data["anatomy"].unique()
@@ -82,6 +83,8 @@ def method(
     center_to_check: str = "All",
     auto_collect_anatomies: bool = False,
 ):
+    from scipy.stats import mannwhitneyu
+
     data = get_multi_method_dataframe(methods, auto_collect_anatomies)
 
     test_data = data[data["center"] == center_to_check]